@@ -0,0 +1,1078 @@
+import asyncio
+import os
+import time
+
+from dotenv import load_dotenv
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.asyncio_handler_backends import BaseMiddleware
+
+import async_weather
+from user_store import create_user_store
+from user_state import UserStateRegistry
+from conversation_state import create_conversation_store
+from notification_scheduler import NotificationScheduler
+from daily_digest import (
+    DigestScheduler,
+    DIGEST_PRESET_TIMES,
+    digest_bucket,
+    digest_local_date,
+    parse_digest_time,
+    format_digest_time
+)
+from message_dispatcher import AsyncSendLimiter
+from forecast_views import ForecastViewCache
+from user_throttle import UserThrottle
+from city_index import city_index
+from weather_app import (
+    Deadline,
+    parse_location_cell,
+    get_location_cell,
+    snapshot_cache_size,
+    get_location_snapshot,
+    get_observation_store
+)
+from webhook_server import HealthServer
+from metrics import metrics
+from tracing import (
+    KIND_SERVER,
+    tracing_enabled,
+    start_span,
+    span,
+    trace_handlers,
+    trace_async_telegram_api,
+    update_attributes
+)
+from weather_alerts import ALERT_MESSAGES, classify_weather_alert, alert_state_changed, subscriber_cell
+from render import (
+    WELCOME_TEXT,
+    MAIN_MENU_TEXT,
+    get_main_menu,
+    get_back_menu,
+    get_location_menu,
+    build_notifications_status,
+    build_digest_status,
+    format_digest_message,
+    format_weather_message,
+    format_extended_weather_message,
+    build_compare_prompt,
+    build_compare_reply,
+    build_throttled_text,
+    build_inline_results,
+    format_history_message,
+    split_city_list,
+    build_forecast_views,
+    format_stats_message,
+    render_cache
+)
+
+# Асинхронная версия бота: те же команды и ответы, что в bot.py, но обработчики
+# не занимают поток на время запросов к погодным API (запуск: python async_bot.py)
+
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+if not BOT_TOKEN:
+    raise ValueError("BOT_TOKEN не установлен в файле .env!")
+
+bot = AsyncTeleBot(BOT_TOKEN)
+
+
+class HandlerLatencyMiddleware(BaseMiddleware):
+    """Замеряет время обработки сообщений и нажатий кнопок (p95 в /stats)"""
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query", "inline_query"]
+
+    async def pre_process(self, message, data):
+        data["started_at"] = time.perf_counter()
+
+    async def post_process(self, message, data, exception):
+        metrics.handler_latency.observe(time.perf_counter() - data["started_at"])
+        if exception:
+            metrics.incr("handler_errors")
+
+
+bot.setup_middleware(HandlerLatencyMiddleware())
+
+
+class UpdateTracingMiddleware(BaseMiddleware):
+    """Корневой спан трассировки на каждое обновление (TRACE_FILE, см. tracing.py)"""
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query", "inline_query"]
+
+    async def pre_process(self, message, data):
+        data["trace_span"] = start_span("telegram.update", KIND_SERVER, **update_attributes(message))
+
+    async def post_process(self, message, data, exception):
+        data["trace_span"].end(exception)
+
+
+if tracing_enabled():
+    bot.setup_middleware(UpdateTracingMiddleware())
+    trace_async_telegram_api()
+
+# Только отложенная запись: изменения из обработчиков не пишутся на диск в цикле событий
+user_store = create_user_store(write_behind=True)
+users = UserStateRegistry(user_store, index_key=subscriber_cell)
+
+# Отрисованные виды прогноза по сообщениям для навигации без повторных запросов
+forecast_views = ForecastViewCache(int(os.getenv("FORECAST_VIEW_CACHE_SIZE", "1000")))
+
+# Ожидаемые шаги диалогов (общие с bot.py хранилища, см. conversation_state.py)
+conversations = create_conversation_store()
+
+
+def get_user_id_str(user_id):
+    """Преобразует ID пользователя в строку для использования в словаре"""
+    return str(user_id)
+
+
+# Лимит запросов к погодным API на пользователя (как в bot.py); ответы из кэша его не расходуют
+user_throttle = UserThrottle(
+    rate=float(os.getenv("THROTTLE_RATE", "0.2")),
+    burst=float(os.getenv("THROTTLE_BURST", "5")),
+    max_users=int(os.getenv("THROTTLE_MAX_USERS", "10000"))
+)
+
+
+async def send_throttled(chat_id, retry_after):
+    """Просит пользователя подождать вместо нового запроса к API"""
+    metrics.incr("throttled")
+    await bot.send_message(chat_id, build_throttled_text(retry_after), reply_markup=get_main_menu())
+
+
+async def get_snapshot_part(user_id, lat, lon, part):
+    """Часть снимка места: из кэша - сразу, запрос к API - за токен пользователя. (data, retry_after)"""
+    if await async_weather.cached_part(get_location_snapshot(lat, lon), part) is None:
+        retry_after = user_throttle.try_acquire(user_id)
+        if retry_after:
+            return None, retry_after
+    return await async_weather.get_snapshot_part(lat, lon, part), 0
+
+
+async def get_city_weather(user_id, city):
+    """Погода по названию города: сохраненный город - из кэша, иначе запрос за токен. (data, retry_after)"""
+    location = (users.get(user_id) or {}).get("location")
+    if location and location.get("city", "").lower() == city.lower():
+        weather_data = await async_weather.cached_part(get_location_snapshot(location["lat"], location["lon"]),
+                                                       "current")
+        if weather_data:
+            return weather_data, 0
+    retry_after = user_throttle.try_acquire(user_id)
+    if retry_after:
+        return None, retry_after
+    weather_data = await async_weather.get_weather(city)
+    await async_weather.remember_weather(weather_data)
+    return weather_data, 0
+
+
+async def set_next_step(chat_id, step, data=None):
+    """Назначает обработчик следующего сообщения в чате (имя из CONVERSATION_STEPS)"""
+    # Запись в SQLite выполняется в потоке, не блокируя цикл событий
+    await asyncio.to_thread(conversations.set, chat_id, step, data)
+
+
+# ==================== СЛЕДУЮЩИЙ ШАГ ДИАЛОГА ====================
+
+async def has_next_step(message) -> bool:
+    """Фильтр: чат ждет ответа на шаг (чтение SQLite - в потоке, не в цикле событий)"""
+    return await asyncio.to_thread(conversations.get, message.chat.id) is not None
+
+
+# Регистрируется первым: сообщение с ожидаемым шагом не попадает в другие обработчики
+@bot.message_handler(func=has_next_step, content_types=["text", "location"])
+async def process_next_step(message):
+    """Передает сообщение обработчику ожидаемого шага"""
+    state = await asyncio.to_thread(conversations.pop, message.chat.id)
+    if state is None:
+        # Шаг уже забрал другой процесс или истек срок ожидания
+        return
+    handler = CONVERSATION_STEPS.get(state["step"])
+    if handler:
+        with span(f"step.{state['step']}"):
+            await handler(message)
+
+
+# ==================== КОМАНДЫ БОТА ====================
+
+@bot.message_handler(commands=["start", "help"])
+async def send_welcome(message):
+    """Приветственное сообщение и меню"""
+    users.ensure(get_user_id_str(message.from_user.id))
+    await bot.send_message(message.chat.id, WELCOME_TEXT, parse_mode="HTML", reply_markup=get_main_menu())
+
+
+# ==================== ОБРАБОТЧИКИ КНОПОК МЕНЮ ====================
+
+@bot.message_handler(func=lambda message: message.text == "◀️ Главное меню")
+async def back_to_main_menu(message):
+    """Возврат в главное меню"""
+    await bot.send_message(message.chat.id, MAIN_MENU_TEXT, parse_mode="HTML", reply_markup=get_main_menu())
+
+
+@bot.message_handler(func=lambda message: message.text == "🏙️ Погода в городе")
+async def menu_weather(message):
+    """Обработчик кнопки 'Погода в городе'"""
+    await bot.send_message(
+        message.chat.id,
+        "🏙️ Введите название города на русском или английском языке:",
+        reply_markup=get_back_menu()
+    )
+    await set_next_step(message.chat.id, "weather_city")
+
+
+@bot.message_handler(func=lambda message: message.text == "📅 Прогноз на 5 дней")
+async def menu_forecast(message):
+    """Обработчик кнопки 'Прогноз на 5 дней'"""
+    await forecast_command(message)
+
+
+@bot.message_handler(func=lambda message: message.text == "📍 Моё местоположение")
+async def menu_location(message):
+    """Обработчик кнопки 'Моё местоположение'"""
+    await location_command(message)
+
+
+@bot.message_handler(func=lambda message: message.text == "🔔 Уведомления")
+async def menu_notifications(message):
+    """Обработчик кнопки 'Уведомления'"""
+    await notifications_command(message)
+
+
+@bot.message_handler(func=lambda message: message.text == "⚖️ Сравнить города")
+async def menu_compare(message):
+    """Обработчик кнопки 'Сравнить города'"""
+    await bot.send_message(
+        message.chat.id,
+        build_compare_prompt(COMPARE_MAX_CITIES),
+        parse_mode="HTML",
+        reply_markup=get_back_menu()
+    )
+    await set_next_step(message.chat.id, "compare_cities")
+
+
+@bot.message_handler(func=lambda message: message.text == "📊 Расширенные данные")
+async def menu_extended(message):
+    """Обработчик кнопки 'Расширенные данные'"""
+    await bot.send_message(
+        message.chat.id,
+        "📊 <b>Расширенные данные о погоде</b>\n\nВведите название города или покажите местоположение:",
+        parse_mode="HTML",
+        reply_markup=get_back_menu()
+    )
+    await set_next_step(message.chat.id, "extended_data")
+
+
+@bot.message_handler(func=lambda message: message.text == "📈 История погоды")
+async def menu_history(message):
+    """Обработчик кнопки 'История погоды'"""
+    await history_command(message)
+
+
+@bot.message_handler(func=lambda message: message.text == "❓ Помощь")
+async def menu_help(message):
+    """Обработчик кнопки 'Помощь'"""
+    await send_welcome(message)
+
+
+# ==================== КОМАНДЫ БОТА ====================
+
+@bot.message_handler(commands=["menu"])
+async def show_menu_command(message):
+    """Команда для принудительного показа меню"""
+    await bot.send_message(
+        message.chat.id,
+        "📱 Меню отображено! Кнопки должны появиться внизу экрана.",
+        reply_markup=get_main_menu()
+    )
+
+
+@bot.message_handler(commands=["weather"])
+async def weather_command(message):
+    """Команда для получения погоды по городу"""
+    await bot.send_message(message.chat.id, "🏙️ Введите название города на русском или английском языке:")
+    await set_next_step(message.chat.id, "weather_city")
+
+
+async def process_weather_city(message):
+    """Обрабатывает название города и отправляет погоду"""
+    if message.text == "◀️ Главное меню":
+        await back_to_main_menu(message)
+        return
+
+    city = (message.text or "").strip()
+    if not city:
+        await bot.send_message(message.chat.id, "❌ Вы не ввели название города!", reply_markup=get_main_menu())
+        return
+
+    await bot.send_chat_action(message.chat.id, "typing")
+    user_id = get_user_id_str(message.from_user.id)
+    weather_data, retry_after = await get_city_weather(user_id, city)
+    if retry_after:
+        await send_throttled(message.chat.id, retry_after)
+        return
+
+    if weather_data:
+        coord = weather_data.get("coord", {})
+        if coord:
+            user_info = users.update(user_id, location={
+                "lat": coord.get("lat"),
+                "lon": coord.get("lon"),
+                "city": weather_data.get("name", city)
+            }, alert_state=None, tz_offset=weather_data.get("timezone", 0))
+            schedule_subscriber_check(user_info)
+            digest_scheduler.set(user_id, digest_bucket(user_info))
+
+        await bot.send_message(message.chat.id, format_weather_message(weather_data),
+                               parse_mode="HTML", reply_markup=get_main_menu())
+    else:
+        await bot.send_message(
+            message.chat.id,
+            f"❌ Не удалось найти город '{city}'. Проверьте правильность написания.",
+            reply_markup=get_main_menu()
+        )
+
+
+@bot.message_handler(commands=["forecast"])
+async def forecast_command(message):
+    """Команда для получения прогноза на 5 дней"""
+    user_id = get_user_id_str(message.from_user.id)
+    user_info = users.get(user_id)
+
+    if not user_info or not user_info.get("location"):
+        await bot.send_message(
+            message.chat.id,
+            "❌ Сначала покажите своё местоположение через /location или узнайте погоду в городе через /weather"
+        )
+        return
+
+    location = user_info["location"]
+    await bot.send_chat_action(message.chat.id, "typing")
+    forecast_data, retry_after = await get_snapshot_part(user_id, location["lat"], location["lon"], "forecast")
+    if retry_after:
+        await send_throttled(message.chat.id, retry_after)
+        return
+
+    if forecast_data and "list" in forecast_data:
+        await show_forecast_menu(message.chat.id, forecast_data, location.get("city", "Ваше местоположение"))
+    else:
+        await bot.send_message(message.chat.id, "❌ Не удалось получить прогноз погоды")
+
+
+async def show_forecast_menu(chat_id, forecast_data, city_name):
+    """Показывает меню выбора дня прогноза и запоминает отрисованные дни"""
+    views = build_forecast_views(forecast_data, city_name)
+    message_text, markup = views["menu"]
+    sent = await bot.send_message(chat_id, message_text, reply_markup=markup, parse_mode="HTML")
+    forecast_views.put(chat_id, sent.message_id, views)
+
+
+async def get_forecast_view(call, view_key):
+    """
+    Возвращает (text, markup) вида прогноза для сообщения или None (пользователю уже ответили).
+    Если сообщения нет в кэше (например, после перезапуска), прогноз запрашивается заново.
+    """
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    view = forecast_views.get(chat_id, message_id, view_key)
+    if view:
+        return view
+
+    user_info = users.get(get_user_id_str(call.from_user.id))
+    if not user_info or not user_info.get("location"):
+        await bot.answer_callback_query(call.id, "❌ Сначала покажите своё местоположение")
+        return None
+
+    location = user_info["location"]
+    forecast_data, retry_after = await get_snapshot_part(get_user_id_str(call.from_user.id),
+                                                         location["lat"], location["lon"], "forecast")
+    if retry_after:
+        await bot.answer_callback_query(call.id, build_throttled_text(retry_after).split("\n")[0])
+        return None
+    if not forecast_data or "list" not in forecast_data:
+        await bot.answer_callback_query(call.id, "❌ Ошибка получения данных")
+        return None
+
+    views = build_forecast_views(forecast_data, location.get("city", "Ваше местоположение"))
+    forecast_views.put(chat_id, message_id, views)
+    view = views.get(view_key)
+    if not view or not view[0]:
+        await bot.answer_callback_query(call.id, "❌ Данные не найдены")
+        return None
+    return view
+
+
+async def edit_forecast_message(call, view):
+    """Заменяет текст и клавиатуру сообщения прогноза на месте"""
+    message_text, markup = view
+    try:
+        await bot.edit_message_text(message_text, call.message.chat.id, call.message.message_id,
+                                    parse_mode="HTML", reply_markup=markup)
+    except ApiTelegramException as e:
+        # Повторное нажатие на ту же кнопку - сообщение уже такое
+        if "message is not modified" not in str(e.description):
+            raise
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("forecast_"))
+async def forecast_day_callback(call):
+    """Обработчик нажатия на день в прогнозе"""
+    view = await get_forecast_view(call, call.data.replace("forecast_", ""))
+    if not view:
+        return
+
+    await edit_forecast_message(call, view)
+    await bot.answer_callback_query(call.id)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == "back_to_forecast")
+async def back_to_forecast_callback(call):
+    """Возврат к меню выбора дня"""
+    view = await get_forecast_view(call, "menu")
+    if not view:
+        return
+
+    await edit_forecast_message(call, view)
+    await bot.answer_callback_query(call.id)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == "close_forecast")
+async def close_forecast_callback(call):
+    """Закрытие меню прогноза"""
+    forecast_views.discard(call.message.chat.id, call.message.message_id)
+    try:
+        await bot.delete_message(call.message.chat.id, call.message.message_id)
+    except Exception:
+        pass
+    await bot.answer_callback_query(call.id, "✅ Закрыто")
+
+
+# Сколько последних дней показывать в /history
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "5"))
+
+
+@bot.message_handler(commands=["history"])
+async def history_command(message):
+    """История погоды в месте пользователя из локального временного ряда (без запросов к API)"""
+    user_info = users.get(get_user_id_str(message.from_user.id))
+    
+    if not user_info or not user_info.get("location"):
+        await bot.send_message(
+            message.chat.id,
+            "❌ Сначала покажите своё местоположение через /location или узнайте погоду в городе через /weather"
+        )
+        return
+    # Открытие и чтение SQLite - в потоке, чтобы не задерживать цикл событий
+    store = await asyncio.to_thread(get_observation_store)
+    if store is None:
+        await bot.send_message(message.chat.id, "❌ История погоды отключена", reply_markup=get_main_menu())
+        return
+    
+    location = user_info["location"]
+    days = await asyncio.to_thread(
+        store.history, get_location_cell(location["lat"], location["lon"]), HISTORY_DAYS
+    )
+    await bot.send_message(
+        message.chat.id,
+        format_history_message(days, location.get("city", "Ваше местоположение")),
+        parse_mode="HTML",
+        reply_markup=get_main_menu()
+    )
+
+
+@bot.message_handler(commands=["location"])
+async def location_command(message):
+    """Команда для запроса местоположения"""
+    await bot.send_message(
+        message.chat.id,
+        "📍 Нажмите на кнопку ниже, чтобы показать своё местоположение:",
+        reply_markup=get_location_menu()
+    )
+
+
+@bot.message_handler(func=lambda message: message.text and message.text == "❌ Отмена")
+async def cancel_location(message):
+    """Обработчик отмены отправки местоположения"""
+    await bot.send_message(message.chat.id, "❌ Отменено.", reply_markup=get_main_menu())
+
+
+@bot.message_handler(content_types=["location"])
+async def handle_location(message):
+    """Обработчик получения местоположения"""
+    try:
+        lat = message.location.latitude
+        lon = message.location.longitude
+
+        await bot.send_chat_action(message.chat.id, "typing")
+        user_id = get_user_id_str(message.from_user.id)
+        weather_data, retry_after = await get_snapshot_part(user_id, lat, lon, "current")
+        if retry_after:
+            await send_throttled(message.chat.id, retry_after)
+            return
+
+        if weather_data:
+            user_info = users.update(user_id, location={
+                "lat": lat,
+                "lon": lon,
+                "city": weather_data.get("name", "Ваше местоположение")
+            }, alert_state=None, tz_offset=weather_data.get("timezone", 0))
+            schedule_subscriber_check(user_info)
+            digest_scheduler.set(user_id, digest_bucket(user_info))
+
+            await bot.send_message(message.chat.id, format_weather_message(weather_data), parse_mode="HTML")
+            await bot.send_message(
+                message.chat.id,
+                "✅ Ваше местоположение сохранено! Теперь вы можете использовать прогноз на 5 дней.",
+                reply_markup=get_main_menu()
+            )
+        else:
+            await bot.send_message(
+                message.chat.id,
+                "❌ Не удалось получить погоду для данного местоположения.\n\n🔑 Проверьте, что API_KEY установлен в файле .env",
+                reply_markup=get_main_menu()
+            )
+    except Exception as e:
+        print(f"Ошибка при обработке местоположения: {e}")
+        await bot.send_message(
+            message.chat.id,
+            "❌ Произошла ошибка при обработке вашего местоположения. Попробуйте позже.",
+            reply_markup=get_main_menu()
+        )
+
+
+@bot.message_handler(commands=["notifications"])
+async def notifications_command(message):
+    """Управление уведомлениями"""
+    user_info = users.ensure(get_user_id_str(message.from_user.id))
+
+    if not user_info.get("location"):
+        await bot.send_message(message.chat.id, "❌ Сначала покажите местоположение через /location или /weather")
+        return
+
+    status_text, markup = build_notifications_status(user_info.get("notifications", False))
+    await bot.send_message(message.chat.id, status_text, reply_markup=markup, parse_mode="HTML")
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("notif_"))
+async def notification_toggle_callback(call):
+    """Переключатель уведомлений"""
+    user_id = get_user_id_str(call.from_user.id)
+
+    if call.data == "notif_on":
+        user_info = users.update(user_id, notifications=True, last_check=int(time.time()), alert_state=None)
+        schedule_subscriber_check(user_info)
+        await bot.answer_callback_query(call.id, "✅ Уведомления включены!")
+        status_text, markup = build_notifications_status(True)
+    else:
+        users.update(user_id, notifications=False)
+        await bot.answer_callback_query(call.id, "✅ Уведомления отключены!")
+        status_text, markup = build_notifications_status(False)
+
+    await bot.edit_message_text(status_text, call.message.chat.id, call.message.message_id,
+                                parse_mode="HTML", reply_markup=markup)
+
+
+@bot.message_handler(commands=["digest"])
+async def digest_command(message):
+    """Ежедневная сводка погоды: /digest - состояние и выбор времени, /digest 07:30 - задать время"""
+    user_id = get_user_id_str(message.from_user.id)
+    user_info = users.ensure(user_id)
+
+    if not user_info.get("location"):
+        await bot.send_message(message.chat.id, "❌ Сначала покажите местоположение через /location или /weather")
+        return
+
+    argument = message.text.partition(" ")[2].strip()
+    if argument:
+        digest_time = parse_digest_time(argument)
+        if digest_time is None:
+            await bot.send_message(message.chat.id, "❌ Укажите время в формате ЧЧ:ММ, например: /digest 07:30")
+            return
+        user_info = await set_digest_time(user_id, digest_time)
+        if user_info is None:
+            await bot.send_message(message.chat.id, "❌ Не удалось определить часовой пояс вашего места. Попробуйте позже.")
+            return
+
+    status_text, markup = build_digest_status(user_info.get("digest_time"), DIGEST_PRESET_TIMES)
+    await bot.send_message(message.chat.id, status_text, reply_markup=markup, parse_mode="HTML")
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("digest_"))
+async def digest_callback(call):
+    """Выбор времени ежедневной сводки или ее отключение"""
+    user_id = get_user_id_str(call.from_user.id)
+    action = call.data.replace("digest_", "")
+
+    if action == "off":
+        user_info = users.update(user_id, create=False, digest_time=None)
+        digest_scheduler.set(user_id, None)
+        await bot.answer_callback_query(call.id, "✅ Сводка отключена")
+    else:
+        user_info = await set_digest_time(user_id, int(action))
+        if user_info is None:
+            await bot.answer_callback_query(call.id, "❌ Не удалось определить часовой пояс места")
+            return
+        await bot.answer_callback_query(call.id, f"✅ Сводка в {format_digest_time(user_info['digest_time'])}")
+
+    status_text, markup = build_digest_status((user_info or {}).get("digest_time"), DIGEST_PRESET_TIMES)
+    await bot.edit_message_text(status_text, call.message.chat.id, call.message.message_id,
+                                parse_mode="HTML", reply_markup=markup)
+
+
+async def set_digest_time(user_id, digest_time):
+    """
+    Включает сводку в digest_time (минуты от полуночи по местному времени места).
+    Без сохраненного смещения часового пояса берется текущая погода места.
+    Возвращает запись пользователя или None, если часовой пояс узнать не удалось.
+    """
+    user_info = users.get(user_id)
+    if not user_info or not user_info.get("location"):
+        return None
+    tz_offset = user_info.get("tz_offset")
+    if tz_offset is None:
+        location = user_info["location"]
+        weather_data = await async_weather.get_snapshot_part(location["lat"], location["lon"], "current")
+        if not weather_data:
+            return None
+        tz_offset = weather_data.get("timezone", 0)
+    user_info = users.update(user_id, create=False, digest_time=digest_time, tz_offset=tz_offset)
+    digest_scheduler.set(user_id, digest_bucket(user_info))
+    return user_info
+
+
+# Сравнение городов: не больше COMPARE_MAX_CITIES городов, одновременно не больше
+# COMPARE_WORKERS запросов на весь бот, ответ ждем не дольше COMPARE_TIMEOUT секунд
+COMPARE_MAX_CITIES = int(os.getenv("COMPARE_MAX_CITIES", "5"))
+COMPARE_WORKERS = int(os.getenv("COMPARE_WORKERS", "8"))
+COMPARE_TIMEOUT = float(os.getenv("COMPARE_TIMEOUT", "10"))
+
+compare_semaphore = asyncio.Semaphore(COMPARE_WORKERS)
+
+
+@bot.message_handler(commands=["compare"])
+async def compare_command(message):
+    """Команда для сравнения погоды в нескольких городах"""
+    await bot.send_message(message.chat.id, build_compare_prompt(COMPARE_MAX_CITIES), parse_mode="HTML")
+    await set_next_step(message.chat.id, "compare_cities")
+
+
+async def fetch_city_weather(city, deadline):
+    """Запрашивает погоду города с ограничением общего числа одновременных запросов"""
+    async with compare_semaphore:
+        return await async_weather.get_weather(city, deadline)
+
+
+async def fetch_cities_weather(cities):
+    """
+    Запрашивает погоду для городов одновременно и ждет не дольше COMPARE_TIMEOUT.
+    Срок общий: ожидание семафора тоже расходует его.
+    Возвращает (список (город, данные), города без данных, города без ответа вовремя).
+    """
+    deadline = Deadline(COMPARE_TIMEOUT)
+    tasks = {city: asyncio.ensure_future(fetch_city_weather(city, deadline)) for city in cities}
+    await asyncio.wait(tasks.values(), timeout=deadline.remaining())
+
+    results, failed, timed_out = [], [], []
+    for city, task in tasks.items():
+        if not task.done():
+            task.cancel()
+            timed_out.append(city)
+        elif task.exception() is None and task.result():
+            await async_weather.remember_weather(task.result())
+            results.append((city, task.result()))
+        else:
+            failed.append(city)
+    return results, failed, timed_out
+
+
+async def process_compare_cities(message):
+    """Обрабатывает сравнение нескольких городов"""
+    if message.text == "◀️ Главное меню":
+        await back_to_main_menu(message)
+        return
+
+    cities = split_city_list(message.text)
+    if not 2 <= len(cities) <= COMPARE_MAX_CITIES:
+        await bot.send_message(
+            message.chat.id,
+            f"❌ Нужно ввести от 2 до {COMPARE_MAX_CITIES} городов через запятую.\n"
+            "Например: <code>Москва, Санкт-Петербург</code>",
+            parse_mode="HTML",
+            reply_markup=get_main_menu()
+        )
+        return
+
+    # Каждый город - отдельный запрос к API и отдельный токен пользователя
+    retry_after = user_throttle.try_acquire(get_user_id_str(message.from_user.id), cost=len(cities))
+    if retry_after:
+        await send_throttled(message.chat.id, retry_after)
+        return
+
+    await bot.send_chat_action(message.chat.id, "typing")
+    results, failed, timed_out = await fetch_cities_weather(cities)
+    await bot.send_message(message.chat.id, build_compare_reply(results, failed, timed_out),
+                           parse_mode="HTML", reply_markup=get_main_menu())
+
+
+@bot.message_handler(commands=["extended"])
+async def extended_command(message):
+    """Команда для получения расширенных данных"""
+    await bot.send_message(
+        message.chat.id,
+        "📊 <b>Расширенные данные о погоде</b>\n\nВведите название города или покажите местоположение:",
+        parse_mode="HTML"
+    )
+    await set_next_step(message.chat.id, "extended_data")
+
+
+# Общий срок ответа погодных API для /extended по местоположению (секунды)
+EXTENDED_TIMEOUT = float(os.getenv("EXTENDED_TIMEOUT", "10"))
+
+
+async def process_extended_data(message):
+    """Обрабатывает запрос расширенных данных"""
+    if message.content_type == "location":
+        lat = message.location.latitude
+        lon = message.location.longitude
+
+        location_snapshot = get_location_snapshot(lat, lon)
+        if (await async_weather.cached_part(location_snapshot, "current") is None
+                or await async_weather.cached_part(location_snapshot, "pollution") is None):
+            retry_after = user_throttle.try_acquire(get_user_id_str(message.from_user.id))
+            if retry_after:
+                await send_throttled(message.chat.id, retry_after)
+                return
+
+        await bot.send_chat_action(message.chat.id, "typing")
+        # Координаты известны сразу - погода, загрязнение и название места запрашиваются одновременно
+        snapshot = await async_weather.fetch_location_snapshot(lat, lon, deadline=EXTENDED_TIMEOUT)
+        weather_data = snapshot["weather"]
+
+        if weather_data:
+            extended_msg = format_extended_weather_message(weather_data, snapshot["pollution"], snapshot["city_name"])
+            await bot.send_message(message.chat.id, extended_msg, parse_mode="HTML", reply_markup=get_main_menu())
+        else:
+            await bot.send_message(message.chat.id, "❌ Не удалось получить данные о погоде", reply_markup=get_main_menu())
+
+    elif message.content_type == "text":
+        if message.text == "◀️ Главное меню":
+            await back_to_main_menu(message)
+            return
+
+        city = message.text.strip()
+        if not city:
+            await bot.send_message(message.chat.id, "❌ Вы не ввели название города!", reply_markup=get_main_menu())
+            return
+
+        await bot.send_chat_action(message.chat.id, "typing")
+        weather_data, retry_after = await get_city_weather(get_user_id_str(message.from_user.id), city)
+        if retry_after:
+            await send_throttled(message.chat.id, retry_after)
+            return
+
+        if weather_data:
+            coord = weather_data.get("coord", {})
+            lat = coord.get("lat")
+            lon = coord.get("lon")
+
+            pollution_data = None
+            if lat and lon:
+                pollution_data = await async_weather.get_snapshot_part(lat, lon, "pollution")
+
+            await bot.send_message(message.chat.id, format_extended_weather_message(weather_data, pollution_data),
+                                   parse_mode="HTML", reply_markup=get_main_menu())
+        else:
+            await bot.send_message(
+                message.chat.id,
+                f"❌ Не удалось найти город '{city}'. Проверьте правильность написания.",
+                reply_markup=get_main_menu()
+            )
+
+
+# Обработчики шагов диалога по именам, которые сохраняются в хранилище состояния
+CONVERSATION_STEPS = {
+    "weather_city": process_weather_city,
+    "compare_cities": process_compare_cities,
+    "extended_data": process_extended_data
+}
+
+
+# ==================== INLINE-РЕЖИМ ====================
+
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", "5"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_PENDING_CACHE_TIME = int(os.getenv("INLINE_PENDING_CACHE_TIME", "5"))
+
+# Ячейки, погода которых загружается для подсказок (один запрос на место)
+inline_prefetching = set()
+
+
+async def prefetch_inline_weather(cell, lat, lon):
+    """Загружает погоду города из подсказки в кэш снимка места"""
+    try:
+        await async_weather.get_snapshot_part(lat, lon, "current")
+    finally:
+        inline_prefetching.discard(cell)
+
+
+@bot.inline_handler(func=lambda query: True)
+async def inline_weather_query(query):
+    """Подсказывает города по началу названия с погодой из кэша"""
+    rows = []
+    missing = []
+    for name, lat, lon in city_index.search(query.query, INLINE_RESULTS):
+        weather_data = await async_weather.cached_part(get_location_snapshot(lat, lon), "current")
+        rows.append((name, lat, lon, weather_data))
+        if weather_data is None:
+            missing.append((lat, lon))
+
+    # Погода догружается в фоне только для первой подсказки без данных и за токен пользователя
+    if missing:
+        lat, lon = missing[0]
+        cell = get_location_snapshot(lat, lon).cell
+        if cell not in inline_prefetching and not user_throttle.try_acquire(get_user_id_str(query.from_user.id)):
+            inline_prefetching.add(cell)
+            asyncio.ensure_future(prefetch_inline_weather(cell, lat, lon))
+
+    await bot.answer_inline_query(
+        query.id,
+        build_inline_results(rows),
+        cache_time=INLINE_PENDING_CACHE_TIME if missing else INLINE_CACHE_TIME
+    )
+
+
+# ==================== СОСТОЯНИЕ БОТА (/stats, /healthz) ====================
+
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+HEALTH_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+HEALTH_PORT = os.getenv("HEALTH_PORT")
+
+
+def collect_stats():
+    """Собирает показатели бота (отправка идет напрямую, без очереди)"""
+    p95 = metrics.handler_latency.percentile(95)
+    return {
+        "uptime_seconds": round(metrics.uptime()),
+        "users": len(users),
+        "subscribers": users.indexed_count(),
+        "notification_cells": len(notification_scheduler),
+        "snapshot_cache_size": snapshot_cache_size(),
+        "snapshot_hit_ratio": metrics.ratio("snapshot_hits", "snapshot_misses"),
+        "render_cache_size": len(render_cache),
+        "render_hit_ratio": metrics.ratio("render_hits", "render_misses"),
+        "upstream_in_flight": metrics.upstream_in_flight,
+        "upstream_requests": metrics.get("upstream_requests"),
+        "send_queue": broadcast_limiter.pending(),
+        "scheduler_lag_seconds": round(notification_scheduler.last_lag, 3),
+        "digest_users": len(digest_scheduler),
+        "handler_p95_ms": None if p95 is None else round(p95 * 1000, 1),
+        "handler_samples": len(metrics.handler_latency),
+        "handler_errors": metrics.get("handler_errors"),
+        "throttled_requests": metrics.get("throttled"),
+        "throttled_users_tracked": len(user_throttle)
+    }
+
+
+@bot.message_handler(commands=["stats"])
+async def stats_command(message):
+    """Показатели бота для администраторов"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await bot.send_message(message.chat.id, format_stats_message(collect_stats()), parse_mode="HTML")
+
+
+# ==================== СИСТЕМА УВЕДОМЛЕНИЙ ====================
+
+NOTIFY_INTERVAL = int(os.getenv("NOTIFY_INTERVAL", "7200"))
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "4"))
+
+# Цикл событий, в котором работает бот (задается в main)
+event_loop = None
+
+# Темп рассылок (уведомления и сводки): у асинхронной версии нет очереди отправки,
+# поэтому рассылка сама держит общий лимит ниже лимита Telegram и паузу между
+# сообщениями в один чат. BROADCAST_SEND_RATE - сообщений в секунду (раньше DIGEST_SEND_RATE)
+BROADCAST_SEND_RATE = float(os.getenv("BROADCAST_SEND_RATE", os.getenv("DIGEST_SEND_RATE", "25")))
+
+broadcast_limiter = AsyncSendLimiter(BROADCAST_SEND_RATE,
+                                     chat_interval=float(os.getenv("SEND_CHAT_INTERVAL", "1.0")))
+
+
+async def send_alert(chat_id, text):
+    """Отправляет уведомление или сводку в темпе broadcast_limiter; при 429 повторяет после retry_after"""
+    await broadcast_limiter.wait(chat_id)
+    try:
+        await bot.send_message(chat_id, text, parse_mode="HTML")
+    except ApiTelegramException as e:
+        if e.error_code != 429:
+            raise
+        retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+        broadcast_limiter.pause(chat_id, retry_after)
+        await broadcast_limiter.wait(chat_id)
+        await bot.send_message(chat_id, text, parse_mode="HTML")
+
+
+async def check_weather_notifications(cell):
+    """Проверяет погоду в ячейке и рассылает предупреждение ее подписчикам"""
+    subscriber_ids = users.members(cell)
+    if not subscriber_ids:
+        notification_scheduler.unschedule(cell)
+        return
+
+    now = int(time.time())
+    lat, lon = parse_location_cell(cell)
+    weather_data = await async_weather.get_snapshot_part(lat, lon, "current")
+    if not weather_data:
+        return
+    alert_state = classify_weather_alert(weather_data)
+
+    notification_texts = {}
+    for user_id_str in subscriber_ids:
+        user_info = users.get(user_id_str)
+        if not user_info or subscriber_cell(user_info) != cell:
+            continue
+
+        if alert_state_changed(user_info.get("alert_state"), alert_state):
+            city = user_info["location"].get("city", "Ваше местоположение")
+            if city not in notification_texts:
+                notification_texts[city] = f"{ALERT_MESSAGES[alert_state]}\n\n" + format_weather_message(weather_data, city)
+            try:
+                await send_alert(int(user_id_str), notification_texts[city])
+            except Exception as e:
+                print(f"Ошибка отправки уведомления пользователю {user_id_str}: {e}")
+                # Состояние предупреждения не меняем: следующая проверка отправит его снова
+                users.update(user_id_str, create=False, last_check=now)
+                continue
+
+        users.update(user_id_str, create=False, last_check=now, alert_state=alert_state)
+
+
+def run_notification_check(cell):
+    """Выполняет асинхронную проверку ячейки из потока планировщика"""
+    asyncio.run_coroutine_threadsafe(check_weather_notifications(cell), event_loop).result()
+
+
+notification_scheduler = NotificationScheduler(
+    run_notification_check,
+    interval=NOTIFY_INTERVAL,
+    max_workers=NOTIFY_WORKERS
+)
+
+
+def schedule_subscriber_check(user_info):
+    """Назначает скорую проверку ячейки подписчика (если уведомления включены)"""
+    cell = subscriber_cell(user_info) if user_info else None
+    if cell:
+        notification_scheduler.schedule(cell)
+
+
+# ==================== ЕЖЕДНЕВНАЯ СВОДКА ====================
+
+DIGEST_WORKERS = int(os.getenv("DIGEST_WORKERS", "4"))
+
+
+async def deliver_daily_digest(cell, user_ids):
+    """Рассылает сводку корзины (минута, ячейка): один прогноз и один текст на всех получателей"""
+    lat, lon = parse_location_cell(cell)
+    forecast_data = await async_weather.get_snapshot_part(lat, lon, "forecast")
+    if not forecast_data:
+        print(f"Не удалось получить прогноз для сводки ({cell})")
+        return
+    tz_offset = forecast_data.get("city", {}).get("timezone", 0)
+    today = digest_local_date(tz_offset)
+
+    digest_texts = {}
+    for user_id_str in user_ids:
+        user_info = users.get(user_id_str)
+        bucket = digest_bucket(user_info)
+        if bucket is None or bucket[1] != cell:
+            continue
+        # Сводка за сегодня уже отправлена: корзина переехала на более позднюю
+        # минуту того же дня после перехода на зимнее время
+        if user_info.get("last_digest_date") == today:
+            continue
+
+        city = user_info["location"].get("city", "Ваше местоположение")
+        if city not in digest_texts:
+            digest_texts[city] = format_digest_message(forecast_data, city)
+        try:
+            await send_alert(int(user_id_str), digest_texts[city])
+        except Exception as e:
+            print(f"Ошибка отправки сводки пользователю {user_id_str}: {e}")
+
+        # Часовой пояс места сменился (переход на летнее/зимнее время) - со следующей
+        # сводки время в UTC другое; дата отправки не даст повторить сегодняшнюю
+        previous_offset = user_info.get("tz_offset")
+        user_info = users.update(user_id_str, create=False, last_digest_date=today, tz_offset=tz_offset)
+        if previous_offset != tz_offset:
+            digest_scheduler.set(user_id_str, digest_bucket(user_info))
+
+
+def run_daily_digest(cell, user_ids):
+    """Выполняет асинхронную рассылку корзины из потока планировщика"""
+    asyncio.run_coroutine_threadsafe(deliver_daily_digest(cell, user_ids), event_loop).result()
+
+
+digest_scheduler = DigestScheduler(run_daily_digest, max_workers=DIGEST_WORKERS)
+
+
+def start_notification_scheduler():
+    """Заполняет расписание проверок ячеек с подписчиками и запускает планировщик"""
+    oldest_checks = {}
+    for user_id_str, user_info in users.subscribers_snapshot():
+        cell = subscriber_cell(user_info)
+        last_check_ts = user_info.get("last_check")
+        if cell not in oldest_checks:
+            oldest_checks[cell] = last_check_ts
+        elif last_check_ts is None or (oldest_checks[cell] is not None and last_check_ts < oldest_checks[cell]):
+            oldest_checks[cell] = last_check_ts
+    notification_scheduler.load(oldest_checks.items())
+    notification_scheduler.start()
+    digest_scheduler.load(users.snapshot())
+    digest_scheduler.start()
+
+
+# Спаны обработчиков для трассировки (включается TRACE_FILE, см. tracing.py)
+trace_handlers(bot)
+
+
+# ==================== ЗАПУСК БОТА ====================
+
+async def main():
+    """Главная функция запуска асинхронного бота"""
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+
+    print("🤖 Загрузка данных пользователей...")
+    users.load()
+
+    print("🔔 Запуск системы уведомлений...")
+    start_notification_scheduler()
+
+    if HEALTH_PORT:
+        HealthServer(collect_stats, host=HEALTH_HOST, port=int(HEALTH_PORT)).start()
+        print(f"🩺 Проверка состояния: {HEALTH_HOST}:{HEALTH_PORT}/healthz")
+
+    print("✅ WeatherBot (asyncio) запущен!")
+    print("Нажмите Ctrl+C для остановки")
+
+    try:
+        await bot.infinity_polling(timeout=60, request_timeout=90)
+    finally:
+        notification_scheduler.stop()
+        digest_scheduler.stop()
+        await async_weather.close_session()
+        await bot.close_session()
+        user_store.close()
+        conversations.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\n👋 Бот остановлен")
@@ -0,0 +1,258 @@
+import asyncio
+import os
+import weakref
+from urllib.parse import quote
+
+import aiohttp
+
+# Импорт weather_app загружает .env (API_KEY) так же, как в синхронной версии
+import weather_app
+from metrics import metrics
+from tracing import span
+
+# Общая HTTP-сессия с пулом соединений; создается в работающем цикле событий
+_session = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую aiohttp-сессию (создает при первом обращении).
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    return _session
+
+
+async def close_session() -> None:
+    """
+    Закрывает общую aiohttp-сессию.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def request_json(url: str, deadline=None, headers: dict = None) -> tuple:
+    """
+    Выполняет GET-запрос и возвращает (код ответа, JSON или None); код None -
+    ответа нет (сетевая ошибка или истек срок).
+    Таймаут - остаток общего срока deadline (секунды или weather_app.Deadline);
+    если срок уже истек, запрос не отправляется.
+    """
+    timeout = weather_app.Deadline.of(deadline).remaining()
+    if timeout <= 0:
+        return None, None
+    try:
+        with metrics.upstream(), weather_app.upstream_span(url) as current_span:
+            async with get_session().get(url, headers=headers,
+                                         timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                current_span.set_attribute("http.response.status_code", response.status)
+                if response.status == 200:
+                    return response.status, await response.json(content_type=None)
+                print(f"Ошибка: {response.status} - {await response.text()}")
+                return response.status, None
+    except (aiohttp.ClientError, TimeoutError) as e:
+        print(f"Ошибка: Не удалось получить данные о погоде. {type(e).__name__}")
+        return None, None
+
+
+async def fetch_json(url: str, deadline=None, headers: dict = None):
+    """
+    Выполняет GET-запрос и возвращает JSON или None при ошибке (см. request_json).
+    """
+    _, data = await request_json(url, deadline, headers)
+    return data
+
+
+def _api_key():
+    api_key = os.getenv("API_KEY")
+    if not api_key:
+        print("Ошибка: API_KEY не установлен в переменных окружения!")
+    return api_key
+
+
+async def get_weather(city: str, deadline=None) -> dict:
+    """
+    Получает текущую погоду для указанного города (без блокировки цикла событий).
+    Если API недоступен (нет ответа в срок deadline, сетевая ошибка, 429 или 5xx),
+    возвращает последнюю известную погоду города - как weather_app.get_weather.
+    """
+    api_key = _api_key()
+    if not api_key or not city:
+        return None
+    url = f"https://api.openweathermap.org/data/2.5/weather?q={quote(city)}&appid={api_key}&units=metric&lang=ru"
+    status, data = await request_json(url, deadline)
+    if data is None and weather_app.upstream_unavailable(status):
+        return weather_app.cached_city_weather(city)
+    return data
+
+
+async def get_weather_by_coordinates(latitude: float, longitude: float, deadline=None) -> dict:
+    """
+    Получает текущую погоду по координатам.
+    """
+    api_key = _api_key()
+    if not api_key:
+        return None
+    url = f"https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={api_key}&units=metric&lang=ru"
+    return await fetch_json(url, deadline)
+
+
+async def get_weather_by_hour(latitude: float, longitude: float, deadline=None) -> dict:
+    """
+    Получает прогноз на 5 дней с шагом 3 часа.
+    """
+    api_key = _api_key()
+    if not api_key:
+        return None
+    url = f"https://api.openweathermap.org/data/2.5/forecast?lat={latitude}&lon={longitude}&appid={api_key}&units=metric&lang=ru"
+    return await fetch_json(url, deadline)
+
+
+async def get_weather_pollution(latitude: float, longitude: float, deadline=None) -> dict:
+    """
+    Получает данные о загрязнении воздуха по координатам.
+    """
+    api_key = _api_key()
+    if not api_key:
+        return None
+    url = f"https://api.openweathermap.org/data/2.5/air_pollution?lat={latitude}&lon={longitude}&appid={api_key}"
+    return await fetch_json(url, deadline)
+
+
+_PART_FETCHERS = {
+    "current": get_weather_by_coordinates,
+    "forecast": get_weather_by_hour,
+    "pollution": get_weather_pollution
+}
+
+
+async def cached_part(snapshot, part: str):
+    """
+    snapshot.cached(part) без блокировки цикла событий: данные в памяти процесса
+    берутся сразу, общий кэш процессов (SQLite) читается в потоке.
+    """
+    data = snapshot.cached(part, shared=False)
+    if data is None:
+        data = await asyncio.to_thread(snapshot.cached, part)
+    return data
+
+
+async def put_part(snapshot, part: str, data: dict) -> None:
+    """snapshot.put(part, data) в потоке: запись в общий кэш и историю наблюдений (SQLite)."""
+    if data:
+        await asyncio.to_thread(snapshot.put, part, data)
+
+
+async def remember_weather(data: dict) -> None:
+    """weather_app.remember_weather в потоке (запись снимка места в SQLite)."""
+    if data:
+        await asyncio.to_thread(weather_app.remember_weather, data)
+
+
+# Запрос части места к API идет один на процесс: остальные ждут его результата
+_part_locks = weakref.WeakValueDictionary()
+
+
+async def get_snapshot_part(latitude: float, longitude: float, part: str, deadline=None) -> dict:
+    """
+    Возвращает часть LocationSnapshot ("current", "forecast", "pollution") для места:
+    свежие данные берутся из общего снимка weather_app, иначе запрашиваются и сохраняются.
+    Одновременные запросы одной части места ждут один запрос к API (как LocationSnapshot.get).
+    Если запрос не удался в срок deadline, возвращаются последние известные данные места.
+    """
+    deadline = weather_app.Deadline.of(deadline)
+    snapshot = weather_app.get_location_snapshot(latitude, longitude)
+    with span("cache.snapshot", part=part, cell=snapshot.cell) as current_span:
+        data = await cached_part(snapshot, part)
+        current_span.set_attribute("cache.hit", data is not None)
+        metrics.incr("snapshot_hits" if data is not None else "snapshot_misses")
+        if data is None:
+            lock = _part_locks.get((snapshot.cell, part))
+            if lock is None:
+                lock = _part_locks[(snapshot.cell, part)] = asyncio.Lock()
+            try:
+                await asyncio.wait_for(lock.acquire(), deadline.remaining())
+            except TimeoutError:
+                # Запрос той же части другой задачей не успел завершиться
+                lock = None
+            if lock is not None:
+                try:
+                    # Пока ждали блокировку, данные могла получить другая задача
+                    data = await cached_part(snapshot, part)
+                    if data is None:
+                        data = await _PART_FETCHERS[part](snapshot.latitude, snapshot.longitude, deadline)
+                        await put_part(snapshot, part, data)
+                finally:
+                    lock.release()
+        if data is None:
+            data = snapshot.latest(part)
+            current_span.set_attribute("cache.stale", data is not None)
+            if data is not None:
+                metrics.incr("snapshot_stale")
+        return data
+
+
+async def reverse_geocode(latitude: float, longitude: float, default_name: str = None,
+                          deadline=None) -> str:
+    """
+    Получает название места на русском: Nominatim (OpenStreetMap), затем OpenWeatherMap Geocoding.
+    Оба запроса укладываются в общий срок deadline.
+    """
+    deadline = weather_app.Deadline.of(deadline)
+    nominatim_url = f"https://nominatim.openstreetmap.org/reverse?lat={latitude}&lon={longitude}&format=json&accept-language=ru&addressdetails=1"
+    nominatim_data = await fetch_json(nominatim_url, deadline, headers={"User-Agent": "WeatherApp/1.0"})
+    if nominatim_data:
+        address = nominatim_data.get("address", {})
+        city_name = (address.get("city") or address.get("town") or address.get("village") or
+                     address.get("municipality") or address.get("county"))
+        if not city_name and nominatim_data.get("display_name"):
+            city_name = nominatim_data["display_name"].split(",")[0]
+        if city_name:
+            return city_name
+
+    api_key = _api_key()
+    if not api_key:
+        return default_name
+    geocode_url = f"http://api.openweathermap.org/geo/1.0/reverse?lat={latitude}&lon={longitude}&limit=1&appid={api_key}&lang=ru"
+    geocode_data = await fetch_json(geocode_url, deadline)
+    if geocode_data:
+        return geocode_data[0].get("name", default_name)
+    return default_name
+
+
+async def fetch_location_snapshot(latitude: float, longitude: float, deadline=None,
+                                  resolve_city_name: bool = True) -> dict:
+    """
+    Одновременно запрашивает текущую погоду, загрязнение воздуха и название места
+    с общим сроком deadline (секунды или weather_app.Deadline). Вместо не успевших
+    частей - последние известные данные места или None.
+    """
+    deadline = weather_app.Deadline.of(deadline)
+    snapshot = weather_app.get_location_snapshot(latitude, longitude)
+    parts = {"weather": "current", "pollution": "pollution"}
+    jobs = {
+        key: asyncio.ensure_future(get_snapshot_part(latitude, longitude, part, deadline))
+        for key, part in parts.items()
+    }
+    if resolve_city_name and snapshot.city_name is None:
+        jobs["city_name"] = asyncio.ensure_future(
+            reverse_geocode(snapshot.latitude, snapshot.longitude, deadline=deadline)
+        )
+    await asyncio.wait(jobs.values(), timeout=deadline.remaining())
+
+    result = {"weather": None, "pollution": None, "city_name": snapshot.city_name if resolve_city_name else None}
+    for key, task in jobs.items():
+        if task.done() and task.exception() is None:
+            result[key] = task.result()
+            continue
+        if not task.done():
+            task.cancel()
+            print(f"Ошибка: {key} для ({latitude}, {longitude}) не получен в срок")
+        if key in parts:
+            result[key] = snapshot.latest(parts[key])
+    if result["city_name"]:
+        snapshot.city_name = result["city_name"]
+    return result
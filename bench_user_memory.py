@@ -0,0 +1,105 @@
+"""
+Сравнение памяти и времени подготовки расписания уведомлений для двух
+представлений пользователей: прежнего (словарь словарей по строковому ID,
+last_check строкой ISO) и компактного (UserRecord по int ID, см. user_state.py).
+
+Запуск: python bench_user_memory.py --users 200000
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+from datetime import datetime
+
+from user_state import UserRecord
+
+CITIES = ["Москва", "Санкт-Петербург", "Казань", "Новосибирск", "Екатеринбург", "Омск", "Самара", "Тула"]
+ALERT_STATES = [None, "rain", "snow", "thunderstorm"]
+
+
+def generate_records(count: int) -> str:
+    """JSON пользователей в формате хранилища (как его отдает UserStore.load_all)."""
+    rng = random.Random(42)
+    now = time.time()
+    records = {}
+    for i in range(count):
+        user_id = str(100000000 + i * 7)
+        has_location = rng.random() < 0.8
+        records[user_id] = {
+            "notifications": has_location and rng.random() < 0.5,
+            "location": {
+                "lat": round(rng.uniform(41, 70), 4),
+                "lon": round(rng.uniform(20, 135), 4),
+                "city": rng.choice(CITIES)
+            } if has_location else None,
+            "last_check": datetime.fromtimestamp(now - rng.uniform(0, 7200)).isoformat(),
+            "alert_state": rng.choice(ALERT_STATES)
+        }
+    return json.dumps(records, ensure_ascii=False)
+
+
+def build_legacy(raw: str) -> dict:
+    return json.loads(raw)
+
+
+def build_compact(raw: str) -> dict:
+    return {int(user_id): UserRecord.from_dict(record) for user_id, record in json.loads(raw).items()}
+
+
+def measure(build, raw: str):
+    """Возвращает (структура, байт в памяти после построения)."""
+    gc.collect()
+    tracemalloc.start()
+    users = build(raw)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return users, size
+
+
+def legacy_schedule(users: dict) -> list:
+    return [
+        datetime.fromisoformat(record["last_check"]).timestamp() if record.get("last_check") else None
+        for record in users.values()
+        if record.get("notifications") and record.get("location")
+    ]
+
+
+def compact_schedule(users: dict) -> list:
+    return [record.last_check for record in users.values() if record.is_subscriber]
+
+
+def timed(func, users, repeat: int = 5) -> float:
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(users)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Память на пользователя: словари против UserRecord")
+    parser.add_argument("--users", type=int, default=200000, help="Количество пользователей")
+    args = parser.parse_args()
+
+    raw = generate_records(args.users)
+    legacy, legacy_size = measure(build_legacy, raw)
+    compact, compact_size = measure(build_compact, raw)
+
+    print(f"Пользователей: {args.users}")
+    print(f"{'Представление':<24}{'МБ':>10}{'байт/польз.':>14}{'расписание, мс':>17}")
+    for name, size, users, schedule in (
+        ("словарь словарей", legacy_size, legacy, legacy_schedule),
+        ("UserRecord (__slots__)", compact_size, compact, compact_schedule),
+    ):
+        print(f"{name:<24}{size / 1024 / 1024:>10.1f}{size / args.users:>14.0f}"
+              f"{timed(schedule, users) * 1000:>17.1f}")
+    print(f"Экономия памяти: {legacy_size / compact_size:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
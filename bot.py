@@ -1,19 +1,78 @@
 import telebot
-from telebot import types
+from telebot import apihelper
+from telebot.handler_backends import BaseMiddleware
 import os
-from dotenv import load_dotenv
-import json
-from datetime import datetime, timedelta
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dotenv import load_dotenv
 from pathlib import Path
 
 # Импортируем функции из weather_app
 from weather_app import (
+    Deadline,
+    FETCH_DEADLINE,
     get_weather,
-    get_weather_by_coordinates,
-    get_weather_by_hour,
-    get_weather_pollution
+    get_location_snapshot,
+    remember_weather,
+    fetch_location_snapshot,
+    parse_location_cell,
+    get_location_cell,
+    snapshot_cache_size,
+    close_shared_cache,
+    get_observation_store
+)
+from user_store import create_user_store
+from user_state import UserStateRegistry
+from conversation_state import create_conversation_store, cache_for_shard
+from weather_alerts import ALERT_MESSAGES, classify_weather_alert, alert_state_changed, subscriber_cell
+from notification_scheduler import NotificationScheduler
+from daily_digest import (
+    DigestScheduler,
+    DIGEST_PRESET_TIMES,
+    digest_bucket,
+    digest_local_date,
+    parse_digest_time,
+    format_digest_time
+)
+from message_dispatcher import MessageDispatcher, PRIORITY_BROADCAST
+from webhook_server import WebhookServer, HealthServer, stub_request_sender
+from forecast_views import ForecastViewCache
+from sharding import ConsistentHashRing
+from user_throttle import UserThrottle
+from city_index import city_index
+from metrics import metrics
+from profiling import profile_handlers
+from tracing import (
+    KIND_SERVER,
+    tracing_enabled,
+    start_span,
+    span,
+    bind,
+    trace_handlers,
+    trace_telegram_api,
+    update_attributes
+)
+from render import (
+    WELCOME_TEXT,
+    MAIN_MENU_TEXT,
+    get_main_menu,
+    get_back_menu,
+    get_location_menu,
+    build_notifications_status,
+    build_digest_status,
+    format_digest_message,
+    format_weather_message,
+    format_extended_weather_message,
+    build_compare_prompt,
+    build_compare_reply,
+    build_throttled_text,
+    build_inline_results,
+    format_history_message,
+    split_city_list,
+    build_forecast_views,
+    format_stats_message,
+    render_cache
 )
 
 # Загружаем переменные окружения
@@ -24,90 +83,94 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не установлен в файле .env!")
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Количество рабочих потоков telebot для обработки обновлений
+BOT_NUM_THREADS = int(os.getenv("BOT_NUM_THREADS", "8"))
 
-# Путь к файлу для хранения данных пользователей
-BASE_DIR = Path(__file__).resolve().parent
-USER_DATA_FILE = BASE_DIR / "user_data.json"
-
-# Глобальное хранилище данных пользователей
-user_data = {}
-
-# Смайлики для погоды
-WEATHER_EMOJI = {
-    "ясно": "☀️",
-    "облачно": "☁️",
-    "пасмурно": "☁️",
-    "дождь": "🌧️",
-    "небольшой дождь": "🌦️",
-    "гроза": "⛈️",
-    "снег": "❄️",
-    "туман": "🌫️",
-    "ветер": "💨"
-}
+bot = telebot.TeleBot(BOT_TOKEN, num_threads=BOT_NUM_THREADS, use_class_middlewares=True)
 
 
-def get_main_menu():
-    """Создает главное меню с кнопками"""
-    markup = types.ReplyKeyboardMarkup(
-        resize_keyboard=True,
-        one_time_keyboard=False,
-        is_persistent=True
-    )
+class HandlerLatencyMiddleware(BaseMiddleware):
+    """Замеряет время обработки сообщений и нажатий кнопок (p95 в /stats)"""
     
-    # Первый ряд
-    btn1 = types.KeyboardButton("🏙️ Погода в городе")
-    btn2 = types.KeyboardButton("📅 Прогноз на 5 дней")
-    markup.row(btn1, btn2)
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query", "inline_query"]
     
-    # Второй ряд
-    btn3 = types.KeyboardButton("📍 Моё местоположение")
-    btn4 = types.KeyboardButton("🔔 Уведомления")
-    markup.row(btn3, btn4)
+    def pre_process(self, message, data):
+        data["started_at"] = time.perf_counter()
     
-    # Третий ряд
-    btn5 = types.KeyboardButton("⚖️ Сравнить города")
-    btn6 = types.KeyboardButton("📊 Расширенные данные")
-    markup.row(btn5, btn6)
+    def post_process(self, message, data, exception):
+        metrics.handler_latency.observe(time.perf_counter() - data["started_at"])
+        if exception:
+            metrics.incr("handler_errors")
+
+
+bot.setup_middleware(HandlerLatencyMiddleware())
+
+
+class UpdateTracingMiddleware(BaseMiddleware):
+    """Корневой спан трассировки на каждое обновление (TRACE_FILE, см. tracing.py)"""
+    
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query", "inline_query"]
     
-    # Четвертый ряд
-    btn7 = types.KeyboardButton("❓ Помощь")
-    markup.row(btn7)
+    def pre_process(self, message, data):
+        data["trace_span"] = start_span("telegram.update", KIND_SERVER, **update_attributes(message))
     
-    return markup
+    def post_process(self, message, data, exception):
+        data["trace_span"].end(exception)
 
 
-def get_back_menu():
-    """Создает меню с кнопкой возврата"""
-    markup = types.ReplyKeyboardMarkup(
-        resize_keyboard=True,
-        is_persistent=True
-    )
-    markup.row(types.KeyboardButton("◀️ Главное меню"))
-    return markup
+if tracing_enabled():
+    bot.setup_middleware(UpdateTracingMiddleware())
+    trace_telegram_api()
 
+# Заглушка Telegram API для локальной проверки (запросы только печатаются)
+if os.getenv("TELEGRAM_STUB") == "1":
+    apihelper.CUSTOM_REQUEST_SENDER = stub_request_sender
 
-def load_user_data():
-    """Загружает данные пользователей из файла"""
-    global user_data
-    if USER_DATA_FILE.exists():
-        try:
-            with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-                user_data = json.load(f)
-        except Exception as e:
-            print(f"Ошибка при загрузке данных пользователей: {e}")
-            user_data = {}
-    else:
-        user_data = {}
+BASE_DIR = Path(__file__).resolve().parent
+
+# Очередь исходящих сообщений с ограничением скорости (лимиты Telegram)
+dispatcher = MessageDispatcher(
+    bot,
+    workers=int(os.getenv("SEND_WORKERS", "4")),
+    global_rate=float(os.getenv("SEND_GLOBAL_RATE", "30")),
+    chat_interval=float(os.getenv("SEND_CHAT_INTERVAL", "1.0"))
+)
+
+# Хранилище данных пользователей (SQLite по умолчанию, см. user_store.py)
+user_store = create_user_store()
+
+# Потокобезопасное состояние пользователей с индексом подписчиков по ячейкам
+users = UserStateRegistry(user_store, index_key=subscriber_cell)
+
+# Отрисованные виды прогноза по сообщениям для навигации без повторных запросов
+forecast_views = ForecastViewCache(int(os.getenv("FORECAST_VIEW_CACHE_SIZE", "1000")))
+
+# Номер процесса-шарда и число шардов (задает supervisor.py; по умолчанию один процесс на всех)
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+shard_ring = ConsistentHashRing(range(SHARD_COUNT))
+
+
+def owns_user(user_id):
+    """Проверяет, что пользователь принадлежит этому шарду"""
+    return SHARD_COUNT == 1 or shard_ring.node_for(user_id) == SHARD_INDEX
 
 
-def save_user_data():
-    """Сохраняет данные пользователей в файл"""
+def load_user_data():
+    """Загружает данные пользователей этого шарда из хранилища"""
     try:
-        with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        users.load(owns_user)
     except Exception as e:
-        print(f"Ошибка при сохранении данных пользователей: {e}")
+        print(f"Ошибка при загрузке данных пользователей: {e}")
+
+
+def send_message(chat_id, text, **kwargs):
+    """Отправляет ответ пользователю через очередь (с приоритетом) и возвращает сообщение"""
+    return dispatcher.send_message(chat_id, text, **kwargs)
 
 
 def get_user_id_str(user_id):
@@ -115,108 +178,81 @@ def get_user_id_str(user_id):
     return str(user_id)
 
 
-def get_weather_emoji(description):
-    """Возвращает смайлик для описания погоды"""
-    description_lower = description.lower()
-    for key, emoji in WEATHER_EMOJI.items():
-        if key in description_lower:
-            return emoji
-    return "🌍"
+# ==================== СЛЕДУЮЩИЙ ШАГ ДИАЛОГА ====================
 
+# Ожидаемые шаги диалогов хранятся вне процесса (SQLite по умолчанию, см. conversation_state.py):
+# ответ пользователя может обработать любой процесс бота, перезапуск шаг не теряет
+conversations = create_conversation_store()
 
-def format_weather_message(data, city_name=None):
-    """Форматирует данные о погоде в красивое сообщение"""
-    if not data:
-        return "❌ Не удалось получить данные о погоде"
-    
-    # Основные данные
-    temp = data.get("main", {}).get("temp", "N/A")
-    feels_like = data.get("main", {}).get("feels_like", "N/A")
-    humidity = data.get("main", {}).get("humidity", "N/A")
-    pressure = data.get("main", {}).get("pressure", "N/A")
-    wind_speed = data.get("wind", {}).get("speed", "N/A")
-    description = data.get("weather", [{}])[0].get("description", "N/A")
-    city = city_name or data.get("name", "Неизвестно")
-    
-    emoji = get_weather_emoji(description)
-    
-    message = f"{emoji} <b>Погода в городе {city}</b>\n\n"
-    message += f"🌡️ Температура: <b>{temp}°C</b>\n"
-    message += f"🤔 Ощущается как: <b>{feels_like}°C</b>\n"
-    message += f"💧 Влажность: <b>{humidity}%</b>\n"
-    message += f"🌪️ Ветер: <b>{wind_speed} м/с</b>\n"
-    message += f"📊 Давление: <b>{pressure} мм рт. ст.</b>\n"
-    message += f"📝 Описание: <b>{description.capitalize()}</b>"
-    
-    return message
 
+def set_next_step(chat_id, step, data=None):
+    """Назначает обработчик следующего сообщения в чате (имя из CONVERSATION_STEPS)"""
+    conversations.set(chat_id, step, data)
 
-def format_extended_weather_message(weather_data, pollution_data=None):
-    """Форматирует расширенные данные о погоде"""
-    if not weather_data:
-        return "❌ Не удалось получить данные о погоде"
-    
-    # Основные данные
-    temp = weather_data.get("main", {}).get("temp", "N/A")
-    feels_like = weather_data.get("main", {}).get("feels_like", "N/A")
-    humidity = weather_data.get("main", {}).get("humidity", "N/A")
-    pressure = weather_data.get("main", {}).get("pressure", "N/A")
-    wind_speed = weather_data.get("wind", {}).get("speed", "N/A")
-    description = weather_data.get("weather", [{}])[0].get("description", "N/A")
-    city = weather_data.get("name", "Неизвестно")
-    clouds = weather_data.get("clouds", {}).get("all", "N/A")
-    
-    # Время восхода и заката
-    sys_data = weather_data.get("sys", {})
-    sunrise = sys_data.get("sunrise")
-    sunset = sys_data.get("sunset")
-    
-    sunrise_str = datetime.fromtimestamp(sunrise).strftime("%H:%M") if sunrise else "N/A"
-    sunset_str = datetime.fromtimestamp(sunset).strftime("%H:%M") if sunset else "N/A"
-    
-    emoji = get_weather_emoji(description)
-    
-    message = f"{emoji} <b>Расширенная информация о погоде</b>\n"
-    message += f"📍 <b>Город:</b> {city}\n\n"
-    
-    message += f"<b>🌡️ ТЕМПЕРАТУРА</b>\n"
-    message += f"  • Текущая: <b>{temp}°C</b>\n"
-    message += f"  • Ощущается: <b>{feels_like}°C</b>\n\n"
-    
-    message += f"<b>💨 ВЕТЕР И АТМОСФЕРА</b>\n"
-    message += f"  • Скорость ветра: <b>{wind_speed} м/с</b>\n"
-    message += f"  • Давление: <b>{pressure} мм рт. ст.</b>\n"
-    message += f"  • Влажность: <b>{humidity}%</b>\n"
-    message += f"  • Облачность: <b>{clouds}%</b>\n\n"
-    
-    message += f"<b>🌅 СОЛНЦЕ</b>\n"
-    message += f"  • Восход: <b>{sunrise_str}</b>\n"
-    message += f"  • Закат: <b>{sunset_str}</b>\n\n"
-    
-    # Добавляем данные о загрязнении, если они есть
-    if pollution_data and "list" in pollution_data and pollution_data["list"]:
-        components = pollution_data["list"][0].get("components", {})
-        aqi = pollution_data["list"][0].get("main", {}).get("aqi", "N/A")
-        
-        aqi_text = {
-            1: "Отличное 🟢",
-            2: "Хорошее 🟡",
-            3: "Умеренное 🟠",
-            4: "Плохое 🔴",
-            5: "Очень плохое 🟣"
-        }
-        
-        message += f"<b>🏭 КАЧЕСТВО ВОЗДУХА</b>\n"
-        message += f"  • Общий индекс: <b>{aqi_text.get(aqi, 'N/A')}</b>\n"
-        
-        if components:
-            message += f"  • PM2.5: <b>{components.get('pm2_5', 'N/A')} µg/m³</b>\n"
-            message += f"  • PM10: <b>{components.get('pm10', 'N/A')} µg/m³</b>\n"
-            message += f"  • CO: <b>{components.get('co', 'N/A')} µg/m³</b>\n"
-    
-    message += f"\n📝 <b>Описание:</b> {description.capitalize()}"
-    
-    return message
+
+# Регистрируется первым: сообщение с ожидаемым шагом не попадает в другие обработчики
+@bot.message_handler(func=lambda message: conversations.get(message.chat.id) is not None,
+                     content_types=["text", "location"])
+def process_next_step(message):
+    """Передает сообщение обработчику ожидаемого шага"""
+    state = conversations.pop(message.chat.id)
+    if state is None:
+        # Шаг уже забрал другой процесс или истек срок ожидания
+        return
+    handler = CONVERSATION_STEPS.get(state["step"])
+    if handler:
+        with span(f"step.{state['step']}"):
+            handler(message)
+
+
+# ==================== ОГРАНИЧЕНИЕ ЗАПРОСОВ ПОЛЬЗОВАТЕЛЯ ====================
+
+# Запросы к погодным API на пользователя: THROTTLE_BURST подряд, затем THROTTLE_RATE в секунду.
+# Ответы из кэша лимит не расходуют
+user_throttle = UserThrottle(
+    rate=float(os.getenv("THROTTLE_RATE", "0.2")),
+    burst=float(os.getenv("THROTTLE_BURST", "5")),
+    max_users=int(os.getenv("THROTTLE_MAX_USERS", "10000"))
+)
+
+
+def send_throttled(chat_id, retry_after):
+    """Просит пользователя подождать вместо нового запроса к API"""
+    metrics.incr("throttled")
+    send_message(chat_id, build_throttled_text(retry_after), reply_markup=get_main_menu())
+
+
+def get_snapshot_part(user_id, lat, lon, part):
+    """
+    Часть снимка места для пользователя: свежие данные из кэша - сразу,
+    запрос к API - за токен пользователя.
+    Возвращает (data, retry_after); при превышении лимита data равно None, retry_after > 0
+    """
+    snapshot = get_location_snapshot(lat, lon)
+    if snapshot.cached(part) is None:
+        retry_after = user_throttle.try_acquire(user_id)
+        if retry_after:
+            return None, retry_after
+    return snapshot.get(part), 0
+
+
+def get_city_weather(user_id, city):
+    """
+    Текущая погода по названию города: для сохраненного города пользователя - из кэша
+    снимка места, иначе запрос к API за токен пользователя. Возвращает (data, retry_after)
+    """
+    location = (users.get(user_id) or {}).get("location")
+    if location and location.get("city", "").lower() == city.lower():
+        weather_data = get_location_snapshot(location["lat"], location["lon"]).cached("current")
+        if weather_data:
+            return weather_data, 0
+    retry_after = user_throttle.try_acquire(user_id)
+    if retry_after:
+        return None, retry_after
+    # При недоступном API - последняя известная погода города (без вопроса в консоли)
+    weather_data = get_weather(city, deadline=FETCH_DEADLINE)
+    remember_weather(weather_data)
+    return weather_data, 0
 
 
 # ==================== КОМАНДЫ БОТА ====================
@@ -225,29 +261,15 @@ def format_extended_weather_message(weather_data, pollution_data=None):
 def send_welcome(message):
     """Приветственное сообщение и меню"""
     user_id = get_user_id_str(message.from_user.id)
-    if user_id not in user_data:
-        user_data[user_id] = {
-            "notifications": False,
-            "location": None,
-            "last_check": None
-        }
-        save_user_data()
-    
-    welcome_text = """🌤️ <b>Добро пожаловать в WeatherBot!</b>
-
-Я помогу вам узнать погоду в любой точке мира! 🌍
-
-<b>📋 Выберите действие из меню ниже:</b>
-
-Нажмите на кнопки внизу экрана 👇"""
+    users.ensure(user_id)
     
     # Создаем клавиатуру
     keyboard = get_main_menu()
     print("✅ Отправка сообщения с клавиатурой...")  # Отладка
     
-    bot.send_message(
+    send_message(
         message.chat.id, 
-        welcome_text, 
+        WELCOME_TEXT, 
         parse_mode="HTML", 
         reply_markup=keyboard
     )
@@ -258,21 +280,18 @@ def send_welcome(message):
 @bot.message_handler(func=lambda message: message.text == "◀️ Главное меню")
 def back_to_main_menu(message):
     """Возврат в главное меню"""
-    welcome_text = """🌤️ <b>Главное меню WeatherBot</b>
-
-Выберите нужное действие из меню ниже 👇"""
-    bot.send_message(message.chat.id, welcome_text, parse_mode="HTML", reply_markup=get_main_menu())
+    send_message(message.chat.id, MAIN_MENU_TEXT, parse_mode="HTML", reply_markup=get_main_menu())
 
 
 @bot.message_handler(func=lambda message: message.text == "🏙️ Погода в городе")
 def menu_weather(message):
     """Обработчик кнопки 'Погода в городе'"""
-    msg = bot.send_message(
+    set_next_step(message.chat.id, "weather_city")
+    send_message(
         message.chat.id,
         "🏙️ Введите название города на русском или английском языке:",
         reply_markup=get_back_menu()
     )
-    bot.register_next_step_handler(msg, process_weather_city)
 
 
 @bot.message_handler(func=lambda message: message.text == "📅 Прогноз на 5 дней")
@@ -296,25 +315,31 @@ def menu_notifications(message):
 @bot.message_handler(func=lambda message: message.text == "⚖️ Сравнить города")
 def menu_compare(message):
     """Обработчик кнопки 'Сравнить города'"""
-    msg = bot.send_message(
+    set_next_step(message.chat.id, "compare_cities")
+    send_message(
         message.chat.id,
-        "⚖️ Введите два города через запятую для сравнения.\n\nНапример: <code>Москва, Санкт-Петербург</code>",
+        build_compare_prompt(COMPARE_MAX_CITIES),
         parse_mode="HTML",
         reply_markup=get_back_menu()
     )
-    bot.register_next_step_handler(msg, process_compare_cities)
 
 
 @bot.message_handler(func=lambda message: message.text == "📊 Расширенные данные")
 def menu_extended(message):
     """Обработчик кнопки 'Расширенные данные'"""
-    msg = bot.send_message(
+    set_next_step(message.chat.id, "extended_data")
+    send_message(
         message.chat.id,
         "📊 <b>Расширенные данные о погоде</b>\n\nВведите название города или покажите местоположение:",
         parse_mode="HTML",
         reply_markup=get_back_menu()
     )
-    bot.register_next_step_handler(msg, process_extended_data)
+
+
+@bot.message_handler(func=lambda message: message.text == "📈 История погоды")
+def menu_history(message):
+    """Обработчик кнопки 'История погоды'"""
+    history_command(message)
 
 
 @bot.message_handler(func=lambda message: message.text == "❓ Помощь")
@@ -329,7 +354,7 @@ def menu_help(message):
 def show_menu_command(message):
     """Команда для принудительного показа меню"""
     keyboard = get_main_menu()
-    bot.send_message(
+    send_message(
         message.chat.id,
         "📱 Меню отображено! Кнопки должны появиться внизу экрана.",
         reply_markup=keyboard
@@ -339,11 +364,11 @@ def show_menu_command(message):
 @bot.message_handler(commands=["weather"])
 def weather_command(message):
     """Команда для получения погоды по городу"""
-    msg = bot.send_message(
+    set_next_step(message.chat.id, "weather_city")
+    send_message(
         message.chat.id,
         "🏙️ Введите название города на русском или английском языке:"
     )
-    bot.register_next_step_handler(msg, process_weather_city)
 
 
 def process_weather_city(message):
@@ -356,31 +381,35 @@ def process_weather_city(message):
     city = message.text.strip()
     
     if not city:
-        bot.send_message(message.chat.id, "❌ Вы не ввели название города!", reply_markup=get_main_menu())
+        send_message(message.chat.id, "❌ Вы не ввели название города!", reply_markup=get_main_menu())
         return
     
     # Показываем индикатор загрузки
     bot.send_chat_action(message.chat.id, "typing")
     
     # Получаем данные о погоде
-    weather_data = get_weather(city)
+    user_id = get_user_id_str(message.from_user.id)
+    weather_data, retry_after = get_city_weather(user_id, city)
+    if retry_after:
+        send_throttled(message.chat.id, retry_after)
+        return
     
     if weather_data:
         # Сохраняем местоположение пользователя
-        user_id = get_user_id_str(message.from_user.id)
         coord = weather_data.get("coord", {})
         if coord:
-            user_data[user_id]["location"] = {
+            user_info = users.update(user_id, location={
                 "lat": coord.get("lat"),
                 "lon": coord.get("lon"),
                 "city": weather_data.get("name", city)
-            }
-            save_user_data()
+            }, alert_state=None, tz_offset=weather_data.get("timezone", 0))
+            schedule_subscriber_check(user_info)
+            digest_scheduler.set(user_id, digest_bucket(user_info))
         
         weather_msg = format_weather_message(weather_data)
-        bot.send_message(message.chat.id, weather_msg, parse_mode="HTML", reply_markup=get_main_menu())
+        send_message(message.chat.id, weather_msg, parse_mode="HTML", reply_markup=get_main_menu())
     else:
-        bot.send_message(
+        send_message(
             message.chat.id,
             f"❌ Не удалось найти город '{city}'. Проверьте правильность написания.",
             reply_markup=get_main_menu()
@@ -391,160 +420,120 @@ def process_weather_city(message):
 def forecast_command(message):
     """Команда для получения прогноза на 5 дней"""
     user_id = get_user_id_str(message.from_user.id)
+    user_info = users.get(user_id)
     
-    if user_id not in user_data or not user_data[user_id].get("location"):
-        bot.send_message(
+    if not user_info or not user_info.get("location"):
+        send_message(
             message.chat.id,
             "❌ Сначала покажите своё местоположение через /location или узнайте погоду в городе через /weather"
         )
         return
     
-    location = user_data[user_id]["location"]
+    location = user_info["location"]
     lat = location["lat"]
     lon = location["lon"]
     
     bot.send_chat_action(message.chat.id, "typing")
     
-    # Получаем прогноз
-    forecast_data = get_weather_by_hour(lat, lon)
+    # Получаем прогноз (общий для всех пользователей в этом месте)
+    forecast_data, retry_after = get_snapshot_part(user_id, lat, lon, "forecast")
+    if retry_after:
+        send_throttled(message.chat.id, retry_after)
+        return
     
     if forecast_data and "list" in forecast_data:
         show_forecast_menu(message.chat.id, forecast_data, location.get("city", "Ваше местоположение"))
     else:
-        bot.send_message(message.chat.id, "❌ Не удалось получить прогноз погоды")
+        send_message(message.chat.id, "❌ Не удалось получить прогноз погоды")
 
 
 def show_forecast_menu(chat_id, forecast_data, city_name):
-    """Показывает меню выбора дня прогноза"""
-    # Группируем прогноз по дням
-    days_data = {}
-    
-    for item in forecast_data.get("list", []):
-        dt = datetime.fromtimestamp(item["dt"])
-        date_key = dt.strftime("%Y-%m-%d")
-        day_name = dt.strftime("%d.%m (%a)")
-        
-        if date_key not in days_data:
-            days_data[date_key] = {
-                "date": dt,
-                "day_name": day_name,
-                "forecasts": []
-            }
-        days_data[date_key]["forecasts"].append(item)
-    
-    # Создаем inline-клавиатуру
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    
-    for date_key, day_info in list(days_data.items())[:5]:  # Берем только 5 дней
-        # Получаем среднюю температуру за день
-        temps = [f["main"]["temp"] for f in day_info["forecasts"]]
-        avg_temp = sum(temps) / len(temps)
-        
-        # Получаем наиболее частое описание погоды
-        descriptions = [f["weather"][0]["description"] for f in day_info["forecasts"]]
-        most_common_desc = max(set(descriptions), key=descriptions.count)
-        emoji = get_weather_emoji(most_common_desc)
-        
-        button_text = f"{emoji} {day_info['day_name']} ({avg_temp:.1f}°C)"
-        callback_data = f"forecast_{date_key}"
-        
-        markup.add(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
-    
-    markup.add(types.InlineKeyboardButton(text="❌ Закрыть", callback_data="close_forecast"))
-    
-    message_text = f"📅 <b>Прогноз погоды на 5 дней</b>\n📍 {city_name}\n\nВыберите день для подробной информации:"
+    """Показывает меню выбора дня прогноза и запоминает отрисованные дни"""
+    views = build_forecast_views(forecast_data, city_name)
+    message_text, markup = views["menu"]
+    sent = send_message(chat_id, message_text, reply_markup=markup, parse_mode="HTML")
+    forecast_views.put(chat_id, sent.message_id, views)
+
+
+def get_forecast_view(call, view_key):
+    """
+    Возвращает (text, markup) вида прогноза для сообщения или None (пользователю уже ответили).
+    Если сообщения нет в кэше (например, после перезапуска), прогноз запрашивается заново.
+    """
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    view = forecast_views.get(chat_id, message_id, view_key)
+    if view:
+        return view
+    
+    user_info = users.get(get_user_id_str(call.from_user.id))
+    if not user_info or not user_info.get("location"):
+        bot.answer_callback_query(call.id, "❌ Сначала покажите своё местоположение")
+        return None
+    
+    location = user_info["location"]
+    forecast_data, retry_after = get_snapshot_part(get_user_id_str(call.from_user.id),
+                                                   location["lat"], location["lon"], "forecast")
+    if retry_after:
+        bot.answer_callback_query(call.id, build_throttled_text(retry_after).split("\n")[0])
+        return None
+    if not forecast_data or "list" not in forecast_data:
+        bot.answer_callback_query(call.id, "❌ Ошибка получения данных")
+        return None
     
-    bot.send_message(chat_id, message_text, reply_markup=markup, parse_mode="HTML")
+    views = build_forecast_views(forecast_data, location.get("city", "Ваше местоположение"))
+    forecast_views.put(chat_id, message_id, views)
+    view = views.get(view_key)
+    if not view or not view[0]:
+        bot.answer_callback_query(call.id, "❌ Данные не найдены")
+        return None
+    return view
+
+
+def edit_forecast_message(call, view):
+    """Заменяет текст и клавиатуру сообщения прогноза на месте"""
+    message_text, markup = view
+    try:
+        bot.edit_message_text(
+            message_text,
+            call.message.chat.id,
+            call.message.message_id,
+            parse_mode="HTML",
+            reply_markup=markup
+        )
+    except apihelper.ApiTelegramException as e:
+        # Повторное нажатие на ту же кнопку - сообщение уже такое
+        if "message is not modified" not in str(e.description):
+            raise
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("forecast_"))
 def forecast_day_callback(call):
     """Обработчик нажатия на день в прогнозе"""
     date_key = call.data.replace("forecast_", "")
-    user_id = get_user_id_str(call.from_user.id)
-    
-    location = user_data[user_id]["location"]
-    lat = location["lat"]
-    lon = location["lon"]
-    
-    # Получаем прогноз заново
-    forecast_data = get_weather_by_hour(lat, lon)
-    
-    if not forecast_data or "list" not in forecast_data:
-        bot.answer_callback_query(call.id, "❌ Ошибка получения данных")
+    view = get_forecast_view(call, date_key)
+    if not view:
         return
     
-    # Находим прогнозы для выбранного дня
-    day_forecasts = []
-    for item in forecast_data["list"]:
-        dt = datetime.fromtimestamp(item["dt"])
-        if dt.strftime("%Y-%m-%d") == date_key:
-            day_forecasts.append(item)
-    
-    if not day_forecasts:
-        bot.answer_callback_query(call.id, "❌ Данные не найдены")
-        return
-    
-    # Форматируем детальное сообщение
-    first_dt = datetime.fromtimestamp(day_forecasts[0]["dt"])
-    day_str = first_dt.strftime("%d.%m.%Y (%A)")
-    
-    message = f"📅 <b>Детальный прогноз на {day_str}</b>\n"
-    message += f"📍 {location.get('city', 'Ваше местоположение')}\n\n"
-    
-    for forecast in day_forecasts:
-        dt = datetime.fromtimestamp(forecast["dt"])
-        time_str = dt.strftime("%H:%M")
-        temp = forecast["main"]["temp"]
-        feels_like = forecast["main"]["feels_like"]
-        description = forecast["weather"][0]["description"]
-        wind = forecast["wind"]["speed"]
-        humidity = forecast["main"]["humidity"]
-        emoji = get_weather_emoji(description)
-        
-        message += f"🕐 <b>{time_str}</b>\n"
-        message += f"{emoji} {temp:.1f}°C (ощущ. {feels_like:.1f}°C)\n"
-        message += f"💨 {wind} м/с | 💧 {humidity}%\n"
-        message += f"📝 {description.capitalize()}\n\n"
-    
-    # Создаем кнопку "Назад"
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton(text="◀️ Назад к выбору дня", callback_data="back_to_forecast"))
-    markup.add(types.InlineKeyboardButton(text="❌ Закрыть", callback_data="close_forecast"))
-    
-    # Удаляем предыдущее сообщение и отправляем новое
-    try:
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-    except:
-        pass
-    
-    bot.send_message(call.message.chat.id, message, reply_markup=markup, parse_mode="HTML")
+    edit_forecast_message(call, view)
     bot.answer_callback_query(call.id)
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "back_to_forecast")
 def back_to_forecast_callback(call):
     """Возврат к меню выбора дня"""
-    user_id = get_user_id_str(call.from_user.id)
-    location = user_data[user_id]["location"]
-    lat = location["lat"]
-    lon = location["lon"]
-    
-    forecast_data = get_weather_by_hour(lat, lon)
-    
-    # Удаляем текущее сообщение
-    try:
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-    except:
-        pass
+    view = get_forecast_view(call, "menu")
+    if not view:
+        return
     
-    show_forecast_menu(call.message.chat.id, forecast_data, location.get("city", "Ваше местоположение"))
+    edit_forecast_message(call, view)
     bot.answer_callback_query(call.id)
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "close_forecast")
 def close_forecast_callback(call):
     """Закрытие меню прогноза"""
+    forecast_views.discard(call.message.chat.id, call.message.message_id)
     try:
         bot.delete_message(call.message.chat.id, call.message.message_id)
     except:
@@ -552,28 +541,50 @@ def close_forecast_callback(call):
     bot.answer_callback_query(call.id, "✅ Закрыто")
 
 
+# Сколько последних дней показывать в /history
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "5"))
+
+
+@bot.message_handler(commands=["history"])
+def history_command(message):
+    """История погоды в месте пользователя из локального временного ряда (без запросов к API)"""
+    user_info = users.get(get_user_id_str(message.from_user.id))
+    
+    if not user_info or not user_info.get("location"):
+        send_message(
+            message.chat.id,
+            "❌ Сначала покажите своё местоположение через /location или узнайте погоду в городе через /weather"
+        )
+        return
+    store = get_observation_store()
+    if store is None:
+        send_message(message.chat.id, "❌ История погоды отключена", reply_markup=get_main_menu())
+        return
+    
+    location = user_info["location"]
+    days = store.history(get_location_cell(location["lat"], location["lon"]), days=HISTORY_DAYS)
+    send_message(
+        message.chat.id,
+        format_history_message(days, location.get("city", "Ваше местоположение")),
+        parse_mode="HTML",
+        reply_markup=get_main_menu()
+    )
+
+
 @bot.message_handler(commands=["location"])
 def location_command(message):
     """Команда для запроса местоположения"""
-    markup = types.ReplyKeyboardMarkup(
-        one_time_keyboard=True,
-        resize_keyboard=True
-    )
-    button = types.KeyboardButton(text="📍 Показать местоположение", request_location=True)
-    markup.add(button)
-    markup.add(types.KeyboardButton(text="❌ Отмена"))
-    
-    bot.send_message(
+    send_message(
         message.chat.id,
         "📍 Нажмите на кнопку ниже, чтобы показать своё местоположение:",
-        reply_markup=markup
+        reply_markup=get_location_menu()
     )
 
 
 @bot.message_handler(func=lambda message: message.text and message.text == "❌ Отмена")
 def cancel_location(message):
     """Обработчик отмены отправки местоположения"""
-    bot.send_message(
+    send_message(
         message.chat.id,
         "❌ Отменено.",
         reply_markup=get_main_menu()
@@ -590,44 +601,39 @@ def handle_location(message):
         bot.send_chat_action(message.chat.id, "typing")
         
         # Получаем погоду по координатам
-        weather_data = get_weather_by_coordinates(lat, lon)
+        user_id = get_user_id_str(message.from_user.id)
+        weather_data, retry_after = get_snapshot_part(user_id, lat, lon, "current")
+        if retry_after:
+            send_throttled(message.chat.id, retry_after)
+            return
         
         if weather_data:
             # Сохраняем местоположение пользователя
-            user_id = get_user_id_str(message.from_user.id)
-            
-            # Инициализируем user_data для пользователя, если его нет
-            if user_id not in user_data:
-                user_data[user_id] = {
-                    "notifications": False,
-                    "location": None,
-                    "last_check": None
-                }
-            
-            user_data[user_id]["location"] = {
+            user_info = users.update(user_id, location={
                 "lat": lat,
                 "lon": lon,
                 "city": weather_data.get("name", "Ваше местоположение")
-            }
-            save_user_data()
+            }, alert_state=None, tz_offset=weather_data.get("timezone", 0))
+            schedule_subscriber_check(user_info)
+            digest_scheduler.set(user_id, digest_bucket(user_info))
             
             weather_msg = format_weather_message(weather_data)
             
-            bot.send_message(message.chat.id, weather_msg, parse_mode="HTML")
-            bot.send_message(
+            send_message(message.chat.id, weather_msg, parse_mode="HTML")
+            send_message(
                 message.chat.id,
                 "✅ Ваше местоположение сохранено! Теперь вы можете использовать прогноз на 5 дней.",
                 reply_markup=get_main_menu()
             )
         else:
-            bot.send_message(
+            send_message(
                 message.chat.id,
                 "❌ Не удалось получить погоду для данного местоположения.\n\n🔑 Проверьте, что API_KEY установлен в файле .env",
                 reply_markup=get_main_menu()
             )
     except Exception as e:
         print(f"Ошибка при обработке местоположения: {e}")
-        bot.send_message(
+        send_message(
             message.chat.id,
             "❌ Произошла ошибка при обработке вашего местоположения. Попробуйте позже.",
             reply_markup=get_main_menu()
@@ -638,34 +644,20 @@ def handle_location(message):
 def notifications_command(message):
     """Управление уведомлениями"""
     user_id = get_user_id_str(message.from_user.id)
+    user_info = users.ensure(user_id)
     
-    if user_id not in user_data:
-        user_data[user_id] = {
-            "notifications": False,
-            "location": None,
-            "last_check": None
-        }
-    
-    current_status = user_data[user_id].get("notifications", False)
-    location = user_data[user_id].get("location")
-    
-    markup = types.InlineKeyboardMarkup()
+    current_status = user_info.get("notifications", False)
+    location = user_info.get("location")
     
     if not location:
-        bot.send_message(
+        send_message(
             message.chat.id,
             "❌ Сначала покажите местоположение через /location или /weather"
         )
         return
     
-    if current_status:
-        status_text = "🔔 <b>Уведомления включены</b>\n\nВы будете получать уведомления о погоде каждые 2 часа."
-        markup.add(types.InlineKeyboardButton(text="🔕 Отключить уведомления", callback_data="notif_off"))
-    else:
-        status_text = "🔕 <b>Уведомления отключены</b>\n\nВключите уведомления, чтобы получать информацию о погоде каждые 2 часа."
-        markup.add(types.InlineKeyboardButton(text="🔔 Включить уведомления", callback_data="notif_on"))
-    
-    bot.send_message(message.chat.id, status_text, reply_markup=markup, parse_mode="HTML")
+    status_text, markup = build_notifications_status(current_status)
+    send_message(message.chat.id, status_text, reply_markup=markup, parse_mode="HTML")
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("notif_"))
@@ -675,157 +667,195 @@ def notification_toggle_callback(call):
     action = call.data.replace("notif_", "")
     
     if action == "on":
-        user_data[user_id]["notifications"] = True
-        user_data[user_id]["last_check"] = datetime.now().isoformat()
-        save_user_data()
+        user_info = users.update(user_id, notifications=True, last_check=int(time.time()), alert_state=None)
+        # Первая проверка - вскоре после подписки, без ожидания общего цикла
+        schedule_subscriber_check(user_info)
         bot.answer_callback_query(call.id, "✅ Уведомления включены!")
-        bot.edit_message_text(
-            "🔔 <b>Уведомления включены</b>\n\nВы будете получать уведомления о погоде каждые 2 часа.",
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode="HTML",
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton(text="🔕 Отключить уведомления", callback_data="notif_off")
-            )
-        )
+        status_text, markup = build_notifications_status(True)
     else:
-        user_data[user_id]["notifications"] = False
-        save_user_data()
+        users.update(user_id, notifications=False)
         bot.answer_callback_query(call.id, "✅ Уведомления отключены!")
-        bot.edit_message_text(
-            "🔕 <b>Уведомления отключены</b>\n\nВключите уведомления, чтобы получать информацию о погоде каждые 2 часа.",
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode="HTML",
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton(text="🔔 Включить уведомления", callback_data="notif_on")
-            )
+        status_text, markup = build_notifications_status(False)
+    
+    bot.edit_message_text(
+        status_text,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode="HTML",
+        reply_markup=markup
+    )
+
+
+@bot.message_handler(commands=["digest"])
+def digest_command(message):
+    """Ежедневная сводка погоды: /digest - состояние и выбор времени, /digest 07:30 - задать время"""
+    user_id = get_user_id_str(message.from_user.id)
+    user_info = users.ensure(user_id)
+    
+    if not user_info.get("location"):
+        send_message(
+            message.chat.id,
+            "❌ Сначала покажите местоположение через /location или /weather"
         )
+        return
+    
+    argument = message.text.partition(" ")[2].strip()
+    if argument:
+        digest_time = parse_digest_time(argument)
+        if digest_time is None:
+            send_message(message.chat.id, "❌ Укажите время в формате ЧЧ:ММ, например: /digest 07:30")
+            return
+        user_info = set_digest_time(user_id, digest_time)
+        if user_info is None:
+            send_message(message.chat.id, "❌ Не удалось определить часовой пояс вашего места. Попробуйте позже.")
+            return
+    
+    status_text, markup = build_digest_status(user_info.get("digest_time"), DIGEST_PRESET_TIMES)
+    send_message(message.chat.id, status_text, reply_markup=markup, parse_mode="HTML")
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("digest_"))
+def digest_callback(call):
+    """Выбор времени ежедневной сводки или ее отключение"""
+    user_id = get_user_id_str(call.from_user.id)
+    action = call.data.replace("digest_", "")
+    
+    if action == "off":
+        user_info = users.update(user_id, create=False, digest_time=None)
+        digest_scheduler.set(user_id, None)
+        bot.answer_callback_query(call.id, "✅ Сводка отключена")
+    else:
+        user_info = set_digest_time(user_id, int(action))
+        if user_info is None:
+            bot.answer_callback_query(call.id, "❌ Не удалось определить часовой пояс места")
+            return
+        bot.answer_callback_query(call.id, f"✅ Сводка в {format_digest_time(user_info['digest_time'])}")
+    
+    status_text, markup = build_digest_status((user_info or {}).get("digest_time"), DIGEST_PRESET_TIMES)
+    bot.edit_message_text(
+        status_text,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode="HTML",
+        reply_markup=markup
+    )
+
+
+def set_digest_time(user_id, digest_time):
+    """
+    Включает сводку в digest_time (минуты от полуночи по местному времени места).
+    Смещение часового пояса берется из ответа OWM; у записей, сохраненных до
+    появления сводки, его нет - тогда берется текущая погода места (обычно из кэша).
+    Возвращает запись пользователя или None, если часовой пояс узнать не удалось.
+    """
+    user_info = users.get(user_id)
+    if not user_info or not user_info.get("location"):
+        return None
+    tz_offset = user_info.get("tz_offset")
+    if tz_offset is None:
+        location = user_info["location"]
+        weather_data = get_location_snapshot(location["lat"], location["lon"]).get("current")
+        if not weather_data:
+            return None
+        tz_offset = weather_data.get("timezone", 0)
+    user_info = users.update(user_id, create=False, digest_time=digest_time, tz_offset=tz_offset)
+    digest_scheduler.set(user_id, digest_bucket(user_info))
+    return user_info
+
+
+# Сравнение городов: не больше COMPARE_MAX_CITIES городов, запросы идут параллельно
+# в общем пуле из COMPARE_WORKERS потоков, ответ ждем не дольше COMPARE_TIMEOUT секунд
+COMPARE_MAX_CITIES = int(os.getenv("COMPARE_MAX_CITIES", "5"))
+COMPARE_WORKERS = int(os.getenv("COMPARE_WORKERS", "8"))
+COMPARE_TIMEOUT = float(os.getenv("COMPARE_TIMEOUT", "10"))
+
+compare_executor = ThreadPoolExecutor(max_workers=COMPARE_WORKERS, thread_name_prefix="compare")
 
 
 @bot.message_handler(commands=["compare"])
 def compare_command(message):
-    """Команда для сравнения погоды в двух городах"""
-    msg = bot.send_message(
+    """Команда для сравнения погоды в нескольких городах"""
+    set_next_step(message.chat.id, "compare_cities")
+    send_message(
         message.chat.id,
-        "⚖️ Введите два города через запятую для сравнения.\n\nНапример: <code>Москва, Санкт-Петербург</code>",
+        build_compare_prompt(COMPARE_MAX_CITIES),
         parse_mode="HTML"
     )
-    bot.register_next_step_handler(msg, process_compare_cities)
+
+
+def fetch_cities_weather(cities):
+    """
+    Запрашивает погоду для городов параллельно и ждет не дольше COMPARE_TIMEOUT.
+    Срок общий: ожидание свободного потока пула тоже расходует его.
+    Возвращает (список (город, данные), города без данных, города без ответа вовремя).
+    """
+    deadline = Deadline(COMPARE_TIMEOUT)
+    futures = {
+        city: compare_executor.submit(bind(get_weather), city, deadline=deadline)
+        for city in cities
+    }
+    wait(futures.values(), timeout=deadline.remaining())
+    
+    results, failed, timed_out = [], [], []
+    for city, future in futures.items():
+        if not future.done():
+            future.cancel()
+            timed_out.append(city)
+        elif future.exception() is None and future.result():
+            remember_weather(future.result())
+            results.append((city, future.result()))
+        else:
+            failed.append(city)
+    return results, failed, timed_out
 
 
 def process_compare_cities(message):
-    """Обрабатывает сравнение двух городов"""
+    """Обрабатывает сравнение нескольких городов"""
     # Проверка на возврат в меню
     if message.text == "◀️ Главное меню":
         back_to_main_menu(message)
         return
     
-    cities_text = message.text.strip()
+    cities = split_city_list(message.text)
     
-    if "," not in cities_text:
-        bot.send_message(
+    if not 2 <= len(cities) <= COMPARE_MAX_CITIES:
+        send_message(
             message.chat.id,
-            "❌ Пожалуйста, введите два города через запятую.\nНапример: <code>Москва, Санкт-Петербург</code>",
+            f"❌ Нужно ввести от 2 до {COMPARE_MAX_CITIES} городов через запятую.\n"
+            "Например: <code>Москва, Санкт-Петербург</code>",
             parse_mode="HTML",
             reply_markup=get_main_menu()
         )
         return
     
-    cities = [city.strip() for city in cities_text.split(",")]
-    
-    if len(cities) != 2:
-        bot.send_message(
-            message.chat.id,
-            "❌ Нужно ввести ровно два города через запятую.",
-            reply_markup=get_main_menu()
-        )
+    # Каждый город - отдельный запрос к API и отдельный токен пользователя
+    retry_after = user_throttle.try_acquire(get_user_id_str(message.from_user.id), cost=len(cities))
+    if retry_after:
+        send_throttled(message.chat.id, retry_after)
         return
     
-    city1, city2 = cities
-    
     bot.send_chat_action(message.chat.id, "typing")
     
-    # Получаем погоду для обоих городов
-    weather1 = get_weather(city1)
-    weather2 = get_weather(city2)
-    
-    if not weather1:
-        bot.send_message(message.chat.id, f"❌ Не удалось найти город '{city1}'", reply_markup=get_main_menu())
-        return
-    
-    if not weather2:
-        bot.send_message(message.chat.id, f"❌ Не удалось найти город '{city2}'", reply_markup=get_main_menu())
-        return
-    
-    # Форматируем сравнение
-    name1 = weather1.get("name", city1)
-    name2 = weather2.get("name", city2)
-    
-    temp1 = weather1.get("main", {}).get("temp", 0)
-    temp2 = weather2.get("main", {}).get("temp", 0)
-    
-    humidity1 = weather1.get("main", {}).get("humidity", 0)
-    humidity2 = weather2.get("main", {}).get("humidity", 0)
+    # Все города запрашиваются одновременно: ответ занимает время самого медленного запроса
+    results, failed, timed_out = fetch_cities_weather(cities)
     
-    wind1 = weather1.get("wind", {}).get("speed", 0)
-    wind2 = weather2.get("wind", {}).get("speed", 0)
-    
-    pressure1 = weather1.get("main", {}).get("pressure", 0)
-    pressure2 = weather2.get("main", {}).get("pressure", 0)
-    
-    desc1 = weather1.get("weather", [{}])[0].get("description", "N/A")
-    desc2 = weather2.get("weather", [{}])[0].get("description", "N/A")
-    
-    emoji1 = get_weather_emoji(desc1)
-    emoji2 = get_weather_emoji(desc2)
-    
-    # Определяем, где теплее
-    if temp1 > temp2:
-        temp_compare = f"В {name1} теплее на {abs(temp1 - temp2):.1f}°C"
-    elif temp2 > temp1:
-        temp_compare = f"В {name2} теплее на {abs(temp1 - temp2):.1f}°C"
-    else:
-        temp_compare = "Температура одинаковая"
-    
-    message_text = f"⚖️ <b>Сравнение погоды</b>\n\n"
-    message_text += f"<b>{'─' * 30}</b>\n"
-    message_text += f"<b>{emoji1} {name1}</b> vs <b>{emoji2} {name2}</b>\n"
-    message_text += f"<b>{'─' * 30}</b>\n\n"
-    
-    message_text += f"🌡️ <b>Температура:</b>\n"
-    message_text += f"  • {name1}: <b>{temp1}°C</b>\n"
-    message_text += f"  • {name2}: <b>{temp2}°C</b>\n"
-    message_text += f"  ℹ️ {temp_compare}\n\n"
-    
-    message_text += f"💧 <b>Влажность:</b>\n"
-    message_text += f"  • {name1}: <b>{humidity1}%</b>\n"
-    message_text += f"  • {name2}: <b>{humidity2}%</b>\n\n"
-    
-    message_text += f"💨 <b>Ветер:</b>\n"
-    message_text += f"  • {name1}: <b>{wind1} м/с</b>\n"
-    message_text += f"  • {name2}: <b>{wind2} м/с</b>\n\n"
-    
-    message_text += f"📊 <b>Давление:</b>\n"
-    message_text += f"  • {name1}: <b>{pressure1} мм</b>\n"
-    message_text += f"  • {name2}: <b>{pressure2} мм</b>\n\n"
-    
-    message_text += f"📝 <b>Описание:</b>\n"
-    message_text += f"  • {name1}: {desc1.capitalize()}\n"
-    message_text += f"  • {name2}: {desc2.capitalize()}"
-    
-    bot.send_message(message.chat.id, message_text, parse_mode="HTML", reply_markup=get_main_menu())
+    message_text = build_compare_reply(results, failed, timed_out)
+    send_message(message.chat.id, message_text, parse_mode="HTML", reply_markup=get_main_menu())
 
 
 @bot.message_handler(commands=["extended"])
 def extended_command(message):
     """Команда для получения расширенных данных"""
-    msg = bot.send_message(
+    set_next_step(message.chat.id, "extended_data")
+    send_message(
         message.chat.id,
         "📊 <b>Расширенные данные о погоде</b>\n\nВведите название города или покажите местоположение:",
         parse_mode="HTML"
     )
-    bot.register_next_step_handler(msg, process_extended_data)
+
+
+# Общий срок ответа погодных API для /extended по местоположению (секунды)
+EXTENDED_TIMEOUT = float(os.getenv("EXTENDED_TIMEOUT", "10"))
 
 
 def process_extended_data(message):
@@ -834,16 +864,24 @@ def process_extended_data(message):
         lat = message.location.latitude
         lon = message.location.longitude
         
+        location_snapshot = get_location_snapshot(lat, lon)
+        if location_snapshot.cached("current") is None or location_snapshot.cached("pollution") is None:
+            retry_after = user_throttle.try_acquire(get_user_id_str(message.from_user.id))
+            if retry_after:
+                send_throttled(message.chat.id, retry_after)
+                return
+        
         bot.send_chat_action(message.chat.id, "typing")
         
-        weather_data = get_weather_by_coordinates(lat, lon)
-        pollution_data = get_weather_pollution(lat, lon)
+        # Координаты известны сразу - погода, загрязнение и название места запрашиваются одновременно
+        snapshot = fetch_location_snapshot(lat, lon, deadline=EXTENDED_TIMEOUT)
+        weather_data = snapshot["weather"]
         
         if weather_data:
-            extended_msg = format_extended_weather_message(weather_data, pollution_data)
-            bot.send_message(message.chat.id, extended_msg, parse_mode="HTML", reply_markup=get_main_menu())
+            extended_msg = format_extended_weather_message(weather_data, snapshot["pollution"], snapshot["city_name"])
+            send_message(message.chat.id, extended_msg, parse_mode="HTML", reply_markup=get_main_menu())
         else:
-            bot.send_message(message.chat.id, "❌ Не удалось получить данные о погоде", reply_markup=get_main_menu())
+            send_message(message.chat.id, "❌ Не удалось получить данные о погоде", reply_markup=get_main_menu())
     
     elif message.content_type == "text":
         # Проверка на возврат в меню
@@ -854,12 +892,15 @@ def process_extended_data(message):
         city = message.text.strip()
         
         if not city:
-            bot.send_message(message.chat.id, "❌ Вы не ввели название города!", reply_markup=get_main_menu())
+            send_message(message.chat.id, "❌ Вы не ввели название города!", reply_markup=get_main_menu())
             return
         
         bot.send_chat_action(message.chat.id, "typing")
         
-        weather_data = get_weather(city)
+        weather_data, retry_after = get_city_weather(get_user_id_str(message.from_user.id), city)
+        if retry_after:
+            send_throttled(message.chat.id, retry_after)
+            return
         
         if weather_data:
             coord = weather_data.get("coord", {})
@@ -868,103 +909,395 @@ def process_extended_data(message):
             
             pollution_data = None
             if lat and lon:
-                pollution_data = get_weather_pollution(lat, lon)
+                pollution_data = get_location_snapshot(lat, lon).get("pollution")
             
             extended_msg = format_extended_weather_message(weather_data, pollution_data)
-            bot.send_message(message.chat.id, extended_msg, parse_mode="HTML", reply_markup=get_main_menu())
+            send_message(message.chat.id, extended_msg, parse_mode="HTML", reply_markup=get_main_menu())
         else:
-            bot.send_message(
+            send_message(
                 message.chat.id,
                 f"❌ Не удалось найти город '{city}'. Проверьте правильность написания.",
                 reply_markup=get_main_menu()
             )
 
 
-# ==================== СИСТЕМА УВЕДОМЛЕНИЙ ====================
+# Обработчики шагов диалога по именам, которые сохраняются в хранилище состояния
+CONVERSATION_STEPS = {
+    "weather_city": process_weather_city,
+    "compare_cities": process_compare_cities,
+    "extended_data": process_extended_data
+}
+
+
+# ==================== INLINE-РЕЖИМ ====================
 
-def check_weather_notifications():
-    """Проверяет и отправляет погодные уведомления"""
-    while True:
+# Сколько городов подсказывать на запрос "@бот Моск..."
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", "5"))
+# Сколько секунд Telegram может отдавать наш ответ из своего кэша
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+# Ответ, где погода еще загружается, кэшируется ненадолго
+INLINE_PENDING_CACHE_TIME = int(os.getenv("INLINE_PENDING_CACHE_TIME", "5"))
+INLINE_FETCH_TIMEOUT = float(os.getenv("INLINE_FETCH_TIMEOUT", "10"))
+
+# Фоновая загрузка погоды для подсказок: не больше двух запросов к API одновременно
+inline_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="inline")
+inline_prefetching = set()
+inline_prefetching_lock = threading.Lock()
+
+
+def prefetch_inline_weather(user_id, lat, lon):
+    """
+    Загружает в фоне погоду города из подсказки: один запрос на место, пока он не завершится,
+    и только если у пользователя есть токен (ввод по буквам не порождает запрос на каждую букву)
+    """
+    cell = get_location_snapshot(lat, lon).cell
+    with inline_prefetching_lock:
+        if cell in inline_prefetching:
+            return
+        if user_throttle.try_acquire(user_id):
+            return
+        inline_prefetching.add(cell)
+    
+    def fetch():
         try:
-            time.sleep(7200)  # 2 часа = 7200 секунд
-            
-            current_time = datetime.now()
-            
-            for user_id_str, user_info in user_data.items():
-                if not user_info.get("notifications", False):
-                    continue
-                
-                location = user_info.get("location")
-                if not location:
-                    continue
-                
-                last_check = user_info.get("last_check")
-                if last_check:
-                    last_check_dt = datetime.fromisoformat(last_check)
-                    if (current_time - last_check_dt).total_seconds() < 7200:
-                        continue
-                
-                # Получаем погоду
-                lat = location["lat"]
-                lon = location["lon"]
-                city = location.get("city", "Ваше местоположение")
-                
-                weather_data = get_weather_by_coordinates(lat, lon)
-                
-                if weather_data:
-                    # Проверяем, есть ли дождь или снег
-                    weather_id = weather_data.get("weather", [{}])[0].get("id", 0)
-                    description = weather_data.get("weather", [{}])[0].get("description", "")
-                    
-                    # Коды погоды: 2xx - гроза, 3xx - морось, 5xx - дождь, 6xx - снег
-                    should_notify = False
-                    alert_message = ""
-                    
-                    if 200 <= weather_id < 300:
-                        should_notify = True
-                        alert_message = "⛈️ Внимание! Ожидается гроза!"
-                    elif 300 <= weather_id < 600:
-                        should_notify = True
-                        alert_message = "🌧️ Внимание! Ожидается дождь!"
-                    elif 600 <= weather_id < 700:
-                        should_notify = True
-                        alert_message = "❄️ Внимание! Ожидается снег!"
-                    
-                    if should_notify:
-                        notification_text = f"{alert_message}\n\n"
-                        notification_text += format_weather_message(weather_data, city)
-                        
-                        try:
-                            user_id_int = int(user_id_str)
-                            bot.send_message(user_id_int, notification_text, parse_mode="HTML")
-                        except Exception as e:
-                            print(f"Ошибка отправки уведомления пользователю {user_id_str}: {e}")
-                
-                # Обновляем время последней проверки
-                user_data[user_id_str]["last_check"] = current_time.isoformat()
-            
-            save_user_data()
+            get_location_snapshot(lat, lon).get("current", deadline=INLINE_FETCH_TIMEOUT)
+        finally:
+            with inline_prefetching_lock:
+                inline_prefetching.discard(cell)
+    
+    inline_executor.submit(bind(fetch))
+
+
+@bot.inline_handler(func=lambda query: True)
+def inline_weather_query(query):
+    """Подсказывает города по началу названия с погодой из кэша"""
+    rows = []
+    missing = []
+    for name, lat, lon in city_index.search(query.query, INLINE_RESULTS):
+        weather_data = get_location_snapshot(lat, lon).cached("current")
+        rows.append((name, lat, lon, weather_data))
+        if weather_data is None:
+            missing.append((lat, lon))
+    
+    # Погода догружается только для первой подсказки без данных
+    if missing:
+        prefetch_inline_weather(get_user_id_str(query.from_user.id), *missing[0])
+    
+    bot.answer_inline_query(
+        query.id,
+        build_inline_results(rows),
+        cache_time=INLINE_PENDING_CACHE_TIME if missing else INLINE_CACHE_TIME
+    )
+
+
+# ==================== СОСТОЯНИЕ БОТА (/stats, /healthz) ====================
+
+# ID администраторов через запятую: только им доступна команда /stats
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+# Порт HTTP-проверки /healthz в режиме polling (в режиме webhook она на порту webhook)
+HEALTH_PORT = os.getenv("HEALTH_PORT")
+
+
+def collect_stats():
+    """Собирает показатели бота из счетчиков, которые ведутся по ходу работы"""
+    p95 = metrics.handler_latency.percentile(95)
+    return {
+        "uptime_seconds": round(metrics.uptime()),
+        "users": len(users),
+        "subscribers": users.indexed_count(),
+        "notification_cells": len(notification_scheduler),
+        "snapshot_cache_size": snapshot_cache_size(),
+        "snapshot_hit_ratio": metrics.ratio("snapshot_hits", "snapshot_misses"),
+        "render_cache_size": len(render_cache),
+        "render_hit_ratio": metrics.ratio("render_hits", "render_misses"),
+        "upstream_in_flight": metrics.upstream_in_flight,
+        "upstream_requests": metrics.get("upstream_requests"),
+        "send_queue": dispatcher.qsize(),
+        "scheduler_lag_seconds": round(notification_scheduler.last_lag, 3),
+        "digest_users": len(digest_scheduler),
+        "handler_p95_ms": None if p95 is None else round(p95 * 1000, 1),
+        "handler_samples": len(metrics.handler_latency),
+        "handler_errors": metrics.get("handler_errors"),
+        "throttled_requests": metrics.get("throttled"),
+        "throttled_users_tracked": len(user_throttle)
+    }
+
+
+@bot.message_handler(commands=["stats"])
+def stats_command(message):
+    """Показатели бота для администраторов (остальным команда не отвечает)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    send_message(message.chat.id, format_stats_message(collect_stats()), parse_mode="HTML")
+
+
+# ==================== СИСТЕМА УВЕДОМЛЕНИЙ ====================
+
+# Интервал между проверками одного пользователя (2 часа = 7200 секунд)
+NOTIFY_INTERVAL = int(os.getenv("NOTIFY_INTERVAL", "7200"))
+# Количество потоков, выполняющих проверки
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "4"))
+
+
+def check_weather_notifications(cell):
+    """
+    Проверяет погоду в ячейке местоположения и рассылает предупреждение
+    всем ее подписчикам: один запрос погоды на ячейку, а не на пользователя
+    """
+    subscriber_ids = users.members(cell)
+    if not subscriber_ids:
+        notification_scheduler.unschedule(cell)
+        return
+    
+    now = int(time.time())
+    
+    # Получаем погоду один раз для всей ячейки (свежие данные берутся из снимка места)
+    lat, lon = parse_location_cell(cell)
+    weather_data = get_location_snapshot(lat, lon).get("current")
+    if not weather_data:
+        return
+    alert_state = classify_weather_alert(weather_data)
+    
+    notification_texts = {}
+    for user_id_str in subscriber_ids:
+        user_info = users.get(user_id_str)
+        if not user_info or subscriber_cell(user_info) != cell:
+            continue
+        
+        # Обновляем время последней проверки и состояние предупреждения до отправки:
+        # если отправка не удастся, обратный вызов вернет прежнее состояние
+        previous_state = user_info.get("alert_state")
+        users.update(user_id_str, create=False, last_check=now, alert_state=alert_state)
+        
+        # Уведомляем только при смене состояния относительно прошлой проверки
+        if alert_state_changed(previous_state, alert_state):
+            city = user_info["location"].get("city", "Ваше местоположение")
+            if city not in notification_texts:
+                notification_texts[city] = f"{ALERT_MESSAGES[alert_state]}\n\n" + format_weather_message(weather_data, city)
             
-        except Exception as e:
-            print(f"Ошибка в системе уведомлений: {e}")
-            time.sleep(60)  # Ждем минуту перед повтором при ошибке
+            # Рассылка идет с низким приоритетом и не ждет отправки
+            future = dispatcher.send_message(
+                int(user_id_str),
+                notification_texts[city],
+                priority=PRIORITY_BROADCAST,
+                wait=False,
+                parse_mode="HTML"
+            )
+            future.add_done_callback(
+                lambda f, uid=user_id_str, previous=previous_state:
+                    restore_alert_state_on_error(f, uid, previous, alert_state)
+            )
+
+
+notification_scheduler = NotificationScheduler(
+    check_weather_notifications,
+    interval=NOTIFY_INTERVAL,
+    max_workers=NOTIFY_WORKERS
+)
+
+
+def report_notification_error(future, user_id_str):
+    """Сообщает об ошибке отправки уведомления; возвращает True, если она была"""
+    error = future.exception()
+    if error:
+        print(f"Ошибка отправки уведомления пользователю {user_id_str}: {error}")
+    return error is not None
+
+
+def restore_alert_state_on_error(future, user_id_str, previous_state, alert_state):
+    """
+    Если предупреждение не отправлено, возвращает прежнее состояние предупреждения,
+    чтобы следующая проверка отправила его снова
+    """
+    if not report_notification_error(future, user_id_str):
+        return
+    with users.edit(user_id_str) as record:
+        # Состояние могла уже сменить следующая проверка - тогда его не трогаем
+        if record is not None and record.get("alert_state") == alert_state:
+            record["alert_state"] = previous_state
+
+
+def schedule_subscriber_check(user_info):
+    """Назначает скорую проверку ячейки подписчика (если уведомления включены)"""
+    cell = subscriber_cell(user_info) if user_info else None
+    if cell:
+        notification_scheduler.schedule(cell)
+
+
+# ==================== ЕЖЕДНЕВНАЯ СВОДКА ====================
+
+# Количество потоков, рассылающих корзины сводки (запрос прогноза на корзину)
+DIGEST_WORKERS = int(os.getenv("DIGEST_WORKERS", "4"))
+
+
+def deliver_daily_digest(cell, user_ids):
+    """
+    Рассылает сводку корзины (минута, ячейка): один прогноз и один текст на всех
+    получателей, сообщения уходят в очередь отправки с общим лимитом
+    """
+    lat, lon = parse_location_cell(cell)
+    forecast_data = get_location_snapshot(lat, lon).get("forecast")
+    if not forecast_data:
+        print(f"Не удалось получить прогноз для сводки ({cell})")
+        return
+    tz_offset = forecast_data.get("city", {}).get("timezone", 0)
+    today = digest_local_date(tz_offset)
+    
+    digest_texts = {}
+    for user_id_str in user_ids:
+        user_info = users.get(user_id_str)
+        bucket = digest_bucket(user_info)
+        if bucket is None or bucket[1] != cell:
+            continue
+        # Сводка за сегодня уже отправлена: корзина переехала на более позднюю
+        # минуту того же дня после перехода на зимнее время
+        if user_info.get("last_digest_date") == today:
+            continue
+        
+        city = user_info["location"].get("city", "Ваше местоположение")
+        if city not in digest_texts:
+            digest_texts[city] = format_digest_message(forecast_data, city)
+        future = dispatcher.send_message(
+            int(user_id_str),
+            digest_texts[city],
+            priority=PRIORITY_BROADCAST,
+            wait=False,
+            parse_mode="HTML"
+        )
+        future.add_done_callback(lambda f, uid=user_id_str: report_notification_error(f, uid))
+        
+        # Часовой пояс места сменился (переход на летнее/зимнее время) - со следующей
+        # сводки время в UTC другое; дата отправки не даст повторить сегодняшнюю
+        previous_offset = user_info.get("tz_offset")
+        user_info = users.update(user_id_str, create=False, last_digest_date=today, tz_offset=tz_offset)
+        if previous_offset != tz_offset:
+            digest_scheduler.set(user_id_str, digest_bucket(user_info))
+
+
+digest_scheduler = DigestScheduler(deliver_daily_digest, max_workers=DIGEST_WORKERS)
+
+
+def start_notification_scheduler():
+    """Заполняет расписание проверок ячеек с подписчиками и запускает планировщик"""
+    oldest_checks = {}
+    for user_id_str, user_info in users.subscribers_snapshot():
+        cell = subscriber_cell(user_info)
+        last_check_ts = user_info.get("last_check")
+        if cell not in oldest_checks:
+            oldest_checks[cell] = last_check_ts
+        elif last_check_ts is None or (oldest_checks[cell] is not None and last_check_ts < oldest_checks[cell]):
+            oldest_checks[cell] = last_check_ts
+    notification_scheduler.load(oldest_checks.items())
+    notification_scheduler.start()
+    digest_scheduler.load(users.snapshot())
+    digest_scheduler.start()
+
+
+# Выборочное профилирование всех обработчиков выше (включается PROFILE_RATE, см. profiling.py)
+profile_handlers(bot)
+# Спаны обработчиков для трассировки (включается TRACE_FILE, см. tracing.py)
+trace_handlers(bot)
 
 
 # ==================== ЗАПУСК БОТА ====================
 
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+
+def run_webhook():
+    """Запускает прием обновлений через встроенный HTTP-сервер (webhook)"""
+    # Обновления обрабатывают потоки сервера: заполненная очередь
+    # возвращает Telegram 503, и он повторяет доставку позже
+    bot.threaded = False
+    server = WebhookServer(
+        bot,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+        workers=BOT_NUM_THREADS,
+        health=collect_stats
+    )
+    
+    # Без WEBHOOK_URL webhook не регистрируется (например, за балансировщиком его ставит одна реплика)
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    
+    print(f"🌐 Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+
+def run_shard_worker(update_queue):
+    """
+    Запускает процесс-шард: обновления своих пользователей (словари JSON)
+    приходят от supervisor.py через очередь, None - сигнал остановки
+    """
+    global conversations
+    # Обновления обрабатывают BOT_NUM_THREADS потоков шарда, каждый по одному
+    # (без собственной очереди telebot): пока все потоки заняты, очередь
+    # шарда заполняется и supervisor.py притормаживает прием обновлений
+    bot.threaded = False
+    # Все обновления чата приходят в этот шард: "шага нет" можно кэшировать
+    conversations = cache_for_shard(conversations)
+    load_user_data()
+    start_notification_scheduler()
+    print(f"✅ Шард {SHARD_INDEX + 1}/{SHARD_COUNT} запущен ({len(users)} пользователей)")
+    
+    def process_updates():
+        while True:
+            update = update_queue.get()
+            if update is None:
+                # Сигнал остановки передаем остальным потокам шарда
+                update_queue.put(None)
+                return
+            try:
+                bot.process_new_updates([telebot.types.Update.de_json(update)])
+            except Exception as e:
+                print(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+    
+    workers = [
+        threading.Thread(target=process_updates, daemon=True, name=f"shard-{i}")
+        for i in range(BOT_NUM_THREADS)
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        notification_scheduler.stop()
+        digest_scheduler.stop()
+        user_store.close()
+        conversations.close()
+        close_shared_cache()
+
+
 def main():
     """Главная функция запуска бота"""
     print("🤖 Загрузка данных пользователей...")
     load_user_data()
     
     print("🔔 Запуск системы уведомлений...")
-    notification_thread = threading.Thread(target=check_weather_notifications, daemon=True)
-    notification_thread.start()
+    start_notification_scheduler()
     
     print("✅ WeatherBot запущен!")
     print("Нажмите Ctrl+C для остановки")
     
-    bot.infinity_polling(timeout=60, long_polling_timeout=60)
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        if HEALTH_PORT:
+            HealthServer(collect_stats, host=WEBHOOK_HOST, port=int(HEALTH_PORT)).start()
+            print(f"🩺 Проверка состояния: {WEBHOOK_HOST}:{HEALTH_PORT}/healthz")
+        bot.infinity_polling(timeout=60, long_polling_timeout=60)
 
 
 if __name__ == "__main__":
@@ -972,7 +1305,10 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         print("\n👋 Бот остановлен")
-        save_user_data()
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
-        save_user_data()
+    finally:
+        notification_scheduler.stop()
+        digest_scheduler.stop()
+        user_store.close()
+        conversations.close()
@@ -0,0 +1,122 @@
+import bisect
+import threading
+
+# Начальный список городов для подсказок (название, широта, долгота).
+# Остальные города добавляются в индекс после успешного запроса погоды по названию
+SEED_CITIES = (
+    ("Москва", 55.75, 37.62),
+    ("Санкт-Петербург", 59.94, 30.31),
+    ("Новосибирск", 55.03, 82.92),
+    ("Екатеринбург", 56.84, 60.61),
+    ("Казань", 55.79, 49.12),
+    ("Нижний Новгород", 56.33, 44.00),
+    ("Челябинск", 55.16, 61.40),
+    ("Самара", 53.20, 50.15),
+    ("Омск", 54.99, 73.37),
+    ("Ростов-на-Дону", 47.23, 39.72),
+    ("Уфа", 54.74, 55.97),
+    ("Красноярск", 56.01, 92.85),
+    ("Воронеж", 51.67, 39.18),
+    ("Пермь", 58.01, 56.25),
+    ("Волгоград", 48.71, 44.51),
+    ("Краснодар", 45.04, 38.98),
+    ("Саратов", 51.53, 46.03),
+    ("Тюмень", 57.15, 65.53),
+    ("Тольятти", 53.51, 49.42),
+    ("Ижевск", 56.85, 53.20),
+    ("Барнаул", 53.35, 83.78),
+    ("Ульяновск", 54.32, 48.40),
+    ("Иркутск", 52.29, 104.28),
+    ("Хабаровск", 48.48, 135.07),
+    ("Ярославль", 57.63, 39.87),
+    ("Владивосток", 43.12, 131.89),
+    ("Махачкала", 42.98, 47.50),
+    ("Томск", 56.49, 84.95),
+    ("Оренбург", 51.77, 55.10),
+    ("Кемерово", 55.35, 86.09),
+    ("Рязань", 54.63, 39.74),
+    ("Астрахань", 46.35, 48.04),
+    ("Пенза", 53.20, 45.00),
+    ("Липецк", 52.61, 39.59),
+    ("Калининград", 54.71, 20.51),
+    ("Тула", 54.19, 37.62),
+    ("Сочи", 43.60, 39.73),
+    ("Мурманск", 68.97, 33.07),
+    ("Архангельск", 64.54, 40.54),
+    ("Якутск", 62.03, 129.73),
+    ("Минск", 53.90, 27.56),
+    ("Астана", 51.17, 71.45),
+    ("Алматы", 43.24, 76.89),
+    ("Ташкент", 41.30, 69.24),
+    ("Тбилиси", 41.72, 44.79),
+    ("Ереван", 40.18, 44.51),
+    ("Баку", 40.41, 49.87),
+    ("Moscow", 55.75, 37.62),
+    ("Saint Petersburg", 59.94, 30.31),
+    ("London", 51.51, -0.13),
+    ("Paris", 48.86, 2.35),
+    ("Berlin", 52.52, 13.40),
+    ("Rome", 41.90, 12.50),
+    ("Madrid", 40.42, -3.70),
+    ("New York", 40.71, -74.01),
+    ("Tokyo", 35.68, 139.69),
+    ("Beijing", 39.90, 116.40),
+    ("Istanbul", 41.01, 28.98),
+    ("Dubai", 25.20, 55.27),
+)
+
+
+def normalize_city_name(name: str) -> str:
+    """Ключ поиска: нижний регистр, "ё" как "е", без лишних пробелов."""
+    return " ".join((name or "").lower().replace("ё", "е").split())
+
+
+class CityIndex:
+    """
+    Индекс названий городов для автодополнения по префиксу: отсортированный
+    список ключей, поиск - двоичный (bisect) до первого несовпадения.
+    Подсказки строятся локально, без запросов к API.
+    """
+
+    def __init__(self, cities=SEED_CITIES, max_size: int = 50000):
+        self.max_size = max_size
+        self._keys = []
+        self._cities = {}
+        self._lock = threading.Lock()
+        for name, lat, lon in cities:
+            self.add(name, lat, lon)
+
+    def add(self, name: str, lat: float, lon: float) -> None:
+        """Добавляет город (или обновляет его координаты)."""
+        key = normalize_city_name(name)
+        if not key:
+            return
+        with self._lock:
+            if key not in self._cities:
+                if len(self._keys) >= self.max_size:
+                    return
+                bisect.insort(self._keys, key)
+            self._cities[key] = (name, lat, lon)
+
+    def search(self, prefix: str, limit: int = 5) -> list:
+        """Возвращает до limit городов (название, широта, долгота), начинающихся с prefix."""
+        prefix = normalize_city_name(prefix)
+        if not prefix:
+            return []
+        result = []
+        with self._lock:
+            index = bisect.bisect_left(self._keys, prefix)
+            while index < len(self._keys) and len(result) < limit:
+                key = self._keys[index]
+                if not key.startswith(prefix):
+                    break
+                result.append(self._cities[key])
+                index += 1
+        return result
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+# Общий индекс городов процесса
+city_index = CityIndex()
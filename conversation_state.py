@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+
+# Файл состояния диалогов (общий для всех процессов бота на одной машине)
+BASE_DIR = Path(__file__).resolve().parent
+CONVERSATION_DB_FILE = BASE_DIR / "conversation_state.db"
+
+
+class ConversationStore(ABC):
+    """
+    Интерфейс хранилища состояния диалогов: какой шаг ожидается от чата
+    (например, "weather_city" после /weather). Состояние живет вне процесса,
+    поэтому следующий шаг может обработать любой процесс бота, а перезапуск
+    его не теряет. Общее хранилище (например, Redis) реализует те же методы.
+    Состояние - словарь {"step": str, "data": dict}.
+    """
+
+    def __init__(self, ttl: float = 3600):
+        # Через ttl секунд неотвеченный шаг забывается
+        self.ttl = ttl
+
+    @abstractmethod
+    def set(self, chat_id: int, step: str, data: dict = None) -> None:
+        """Назначает чату ожидаемый шаг (заменяет предыдущий)."""
+
+    @abstractmethod
+    def get(self, chat_id: int) -> dict:
+        """Возвращает состояние чата или None."""
+
+    @abstractmethod
+    def pop(self, chat_id: int) -> dict:
+        """Атомарно забирает состояние чата: шаг получит только один обработчик."""
+
+    def clear(self, chat_id: int) -> None:
+        """Сбрасывает состояние чата."""
+        self.pop(chat_id)
+
+    def close(self) -> None:
+        """Освобождает ресурсы хранилища."""
+
+
+class MemoryConversationStore(ConversationStore):
+    """Состояние в памяти процесса (для одного процесса и локальной отладки)."""
+
+    def __init__(self, ttl: float = 3600):
+        super().__init__(ttl)
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def set(self, chat_id: int, step: str, data: dict = None) -> None:
+        with self._lock:
+            self._states[chat_id] = ({"step": step, "data": data or {}}, time.time() + self.ttl)
+
+    def get(self, chat_id: int) -> dict:
+        with self._lock:
+            entry = self._states.get(chat_id)
+            if entry and entry[1] < time.time():
+                del self._states[chat_id]
+                entry = None
+        return entry[0] if entry else None
+
+    def pop(self, chat_id: int) -> dict:
+        with self._lock:
+            entry = self._states.pop(chat_id, None)
+        if entry and entry[1] >= time.time():
+            return entry[0]
+        return None
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Состояние в SQLite (режим WAL): общее для процессов бота на одной машине
+    и сохраняется при перезапуске.
+    """
+
+    def __init__(self, path: Path = CONVERSATION_DB_FILE, ttl: float = 3600):
+        super().__init__(ttl)
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        # Транзакции управляются вручную (BEGIN IMMEDIATE в pop)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                chat_id INTEGER PRIMARY KEY,
+                step TEXT NOT NULL,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+
+    def set(self, chat_id: int, step: str, data: dict = None) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM conversation_state WHERE expires_at < ?", (now,))
+            self._conn.execute(
+                """
+                INSERT INTO conversation_state (chat_id, step, data, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    step = excluded.step,
+                    data = excluded.data,
+                    expires_at = excluded.expires_at
+                """,
+                (chat_id, step, json.dumps(data or {}, ensure_ascii=False), now + self.ttl)
+            )
+
+    def get(self, chat_id: int) -> dict:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT step, data FROM conversation_state WHERE chat_id = ? AND expires_at >= ?",
+                (chat_id, time.time())
+            ).fetchone()
+        return {"step": row[0], "data": json.loads(row[1])} if row else None
+
+    def pop(self, chat_id: int) -> dict:
+        with self._lock:
+            # Блокировка записи до чтения: другой процесс не заберет тот же шаг
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT step, data, expires_at FROM conversation_state WHERE chat_id = ?",
+                    (chat_id,)
+                ).fetchone()
+                if row:
+                    self._conn.execute("DELETE FROM conversation_state WHERE chat_id = ?", (chat_id,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row and row[2] >= time.time():
+            return {"step": row[0], "data": json.loads(row[1])}
+        return None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedConversationStore(ConversationStore):
+    """
+    Кэш "шага нет" в памяти перед общим хранилищем - только для процесса-шарда,
+    которому supervisor.py отдает все обновления его чатов. Фильтр шага диалога
+    вызывает get() для каждого входящего сообщения; для чата без шага хранилище
+    читается не чаще раза в refresh секунд. Назначенный шаг в кэше не хранится:
+    get() проверяет его в хранилище, а set() и pop() всегда идут в хранилище.
+    """
+
+    def __init__(self, inner: ConversationStore, refresh: float = 30, max_size: int = 10000):
+        super().__init__(inner.ttl)
+        self.inner = inner
+        self.refresh = refresh
+        self.max_size = max_size
+        self._absent = OrderedDict()  # чат -> когда в хранилище не было шага
+        self._lock = threading.Lock()
+
+    def _remember_absent(self, chat_id: int) -> None:
+        with self._lock:
+            self._absent[chat_id] = time.time()
+            self._absent.move_to_end(chat_id)
+            while len(self._absent) > self.max_size:
+                self._absent.popitem(last=False)
+
+    def _forget(self, chat_id: int) -> None:
+        with self._lock:
+            self._absent.pop(chat_id, None)
+
+    def set(self, chat_id: int, step: str, data: dict = None) -> None:
+        self._forget(chat_id)
+        self.inner.set(chat_id, step, data)
+
+    def get(self, chat_id: int) -> dict:
+        with self._lock:
+            checked_at = self._absent.get(chat_id)
+        if checked_at is not None and time.time() - checked_at < self.refresh:
+            return None
+        state = self.inner.get(chat_id)
+        if state is None:
+            self._remember_absent(chat_id)
+        else:
+            self._forget(chat_id)
+        return state
+
+    def pop(self, chat_id: int) -> dict:
+        state = self.inner.pop(chat_id)
+        self._remember_absent(chat_id)
+        return state
+
+    def close(self) -> None:
+        self.inner.close()
+
+
+def create_conversation_store() -> ConversationStore:
+    """
+    Создает хранилище по переменной окружения CONVERSATION_STORE:
+    "sqlite" (по умолчанию) или "memory".
+    CONVERSATION_TTL - сколько секунд ждать ответа на шаг (по умолчанию 3600).
+    SQLite читается напрямую: ответ может прийти в любой процесс бота
+    (реплики за балансировщиком); кэш включает только шард (cache_for_shard).
+    """
+    backend = os.getenv("CONVERSATION_STORE", "sqlite").lower()
+    ttl = float(os.getenv("CONVERSATION_TTL", "3600"))
+
+    if backend == "memory":
+        return MemoryConversationStore(ttl=ttl)
+    return SQLiteConversationStore(Path(os.getenv("CONVERSATION_DB_FILE", CONVERSATION_DB_FILE)), ttl=ttl)
+
+
+def cache_for_shard(store: ConversationStore) -> ConversationStore:
+    """
+    Ставит кэш "шага нет" перед SQLite в процессе-шарде (все обновления чата
+    приходят в один шард). CONVERSATION_CACHE_REFRESH - как часто (секунды,
+    по умолчанию 30) перечитывать чат без шага из SQLite, 0 - без кэша.
+    """
+    refresh = float(os.getenv("CONVERSATION_CACHE_REFRESH", "30"))
+    if refresh > 0 and isinstance(store, SQLiteConversationStore):
+        return CachedConversationStore(store, refresh=refresh)
+    return store
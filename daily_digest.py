@@ -0,0 +1,161 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from weather_app import get_location_cell
+
+MINUTES_PER_DAY = 24 * 60
+
+# Время сводки, которое предлагается кнопками (минуты от полуночи по местному времени)
+DIGEST_PRESET_TIMES = (6 * 60, 7 * 60, 8 * 60, 9 * 60)
+
+_TIME_PATTERN = re.compile(r"^(\d{1,2})(?:[:.](\d{2}))?$")
+
+
+def parse_digest_time(text: str):
+    """Разбирает время "7", "07:30" или "7.30" в минуты от полуночи (None, если формат неверный)."""
+    match = _TIME_PATTERN.match((text or "").strip())
+    if not match:
+        return None
+    hours, minutes = int(match.group(1)), int(match.group(2) or 0)
+    if hours > 23 or minutes > 59:
+        return None
+    return hours * 60 + minutes
+
+
+def format_digest_time(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def digest_local_date(tz_offset: int, now: float = None) -> str:
+    """
+    Местная дата (ISO) для смещения часового пояса в секундах. Сохраняется
+    у пользователя при отправке сводки (last_digest_date): после перехода на
+    зимнее время корзина переезжает на более позднюю минуту UTC того же дня,
+    и по дате видно, что сегодняшняя сводка уже отправлена.
+    """
+    timestamp = (now if now is not None else time.time()) + (tz_offset or 0)
+    return datetime.fromtimestamp(timestamp, timezone.utc).date().isoformat()
+
+
+def digest_bucket(user_info):
+    """
+    Корзина рассылки пользователя: (минута суток по UTC, ячейка местоположения)
+    или None, если сводка выключена. Местное время переводится в UTC по смещению
+    часового пояса из ответа OWM (поле timezone, секунды).
+    """
+    if not user_info:
+        return None
+    location = user_info.get("location")
+    digest_time = user_info.get("digest_time")
+    if digest_time is None or not location:
+        return None
+    utc_minute = (digest_time - (user_info.get("tz_offset") or 0) // 60) % MINUTES_PER_DAY
+    return utc_minute, get_location_cell(location["lat"], location["lon"])
+
+
+class DigestScheduler:
+    """
+    Расписание ежедневной сводки. Пользователи сгруппированы по корзинам
+    (минута суток UTC, ячейка местоположения): в наступившую минуту каждая
+    корзина передается в deliver(cell, user_ids) одной задачей, поэтому на
+    корзину приходится один запрос прогноза и один текст сообщения.
+    Корзины выполняются в ограниченном пуле потоков; отправка сообщений идет
+    через очередь с общим лимитом, так что 08:00 не превращается в залп запросов.
+    """
+
+    def __init__(self, deliver, max_workers: int = 4):
+        """
+        deliver(cell, user_ids) - рассылает сводку корзины (вызывается в пуле потоков).
+        """
+        self.deliver = deliver
+        self.max_workers = max_workers
+        self._buckets = {}  # минута UTC -> {ячейка: множество пользователей}
+        self._user_bucket = {}  # пользователь -> (минута UTC, ячейка)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._wakeup = threading.Event()
+        self._executor = None
+        self._thread = None
+        self._stopped = False
+        self.last_lag = 0.0
+
+    # ---------- управление расписанием ----------
+
+    def set(self, user_id: str, bucket) -> None:
+        """Переносит пользователя в корзину bucket (None - убирает из расписания)."""
+        with self._lock:
+            old = self._user_bucket.pop(user_id, None)
+            if old is not None:
+                minute, cell = old
+                cells = self._buckets[minute]
+                cells[cell].discard(user_id)
+                if not cells[cell]:
+                    del cells[cell]
+                if not cells:
+                    del self._buckets[minute]
+            if bucket is not None:
+                minute, cell = bucket
+                self._buckets.setdefault(minute, {}).setdefault(cell, set()).add(user_id)
+                self._user_bucket[user_id] = bucket
+
+    def load(self, users) -> None:
+        """Заполняет расписание по списку (пользователь, запись пользователя)."""
+        for user_id, user_info in users:
+            bucket = digest_bucket(user_info)
+            if bucket is not None:
+                self.set(user_id, bucket)
+
+    def due(self, minute: int) -> list:
+        """Корзины минуты UTC: список (ячейка, список пользователей)."""
+        with self._lock:
+            cells = self._buckets.get(minute % MINUTES_PER_DAY, {})
+            return [(cell, list(user_ids)) for cell, user_ids in cells.items()]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._user_bucket)
+
+    # ---------- выполнение ----------
+
+    def start(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix="digest")
+        self._thread = threading.Thread(target=self._run, daemon=True, name="digest-scheduler")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wakeup.set()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+    def _run(self) -> None:
+        # Текущая минута тоже выполняется: перезапуск в 08:00:30 не пропускает сводку 08:00
+        last_minute = int(time.time() // 60) - 1
+        while not self._stopped:
+            now = time.time()
+            current = int(now // 60)
+            # После долгой паузы (сон машины) догоняем не больше 5 минут
+            for minute in range(max(last_minute + 1, current - 4), current + 1):
+                for cell, user_ids in self.due(minute):
+                    self.last_lag = time.time() - minute * 60
+                    # Ждем свободный поток: очередь задач пула не растет без границ
+                    self._slots.acquire()
+                    try:
+                        self._executor.submit(self._deliver, cell, user_ids)
+                    except RuntimeError:
+                        self._slots.release()
+                        return
+            last_minute = current
+            self._wakeup.wait(60 - time.time() % 60)
+
+    def _deliver(self, cell: str, user_ids: list) -> None:
+        try:
+            self.deliver(cell, user_ids)
+        except Exception as e:
+            print(f"Ошибка рассылки ежедневной сводки: {e}")
+        finally:
+            self._slots.release()
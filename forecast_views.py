@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+
+
+class ForecastViewCache:
+    """
+    LRU-кэш отрисованных видов прогноза по сообщениям: (chat_id, message_id) ->
+    {"menu": (text, markup), "<дата>": (text, markup), ...}.
+    Навигация по кнопкам прогноза берет готовый вид отсюда и редактирует
+    сообщение на месте, без повторного запроса прогноза.
+    """
+
+    def __init__(self, max_messages: int = 1000):
+        self.max_messages = max_messages
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, chat_id, message_id, views: dict) -> None:
+        """Сохраняет виды прогноза для сообщения."""
+        key = (chat_id, message_id)
+        with self._lock:
+            self._views[key] = views
+            self._views.move_to_end(key)
+            while len(self._views) > self.max_messages:
+                self._views.popitem(last=False)
+
+    def get(self, chat_id, message_id, view_key: str):
+        """Возвращает (text, markup) вида или None, если сообщения или вида нет в кэше."""
+        key = (chat_id, message_id)
+        with self._lock:
+            views = self._views.get(key)
+            if views is None:
+                return None
+            self._views.move_to_end(key)
+            return views.get(view_key)
+
+    def discard(self, chat_id, message_id) -> None:
+        """Удаляет виды сообщения (после закрытия прогноза)."""
+        with self._lock:
+            self._views.pop((chat_id, message_id), None)
+
+    def __len__(self) -> int:
+        return len(self._views)
@@ -0,0 +1,195 @@
+import asyncio
+import contextvars
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from telebot.apihelper import ApiTelegramException
+
+# Приоритеты отправки: меньшее значение отправляется раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 10
+
+
+class TokenBucket:
+    """
+    Потокобезопасное "ведро токенов": не более rate операций в секунду
+    с допустимым всплеском до capacity.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Берет tokens токенов, если они есть. Возвращает 0 или время ожидания нужного количества."""
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    @property
+    def updated(self) -> float:
+        """Время последнего обращения (time.monotonic)."""
+        return self._updated
+
+    def acquire(self) -> None:
+        """Ждет и берет токен."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class AsyncSendLimiter:
+    """
+    Темп рассылок асинхронной версии (у нее нет очереди отправки): не более rate
+    сообщений в секунду всего и не чаще одного сообщения в чат за chat_interval
+    секунд. Работает в одном цикле событий; ожидание не занимает поток.
+    """
+
+    def __init__(self, rate: float, chat_interval: float = 1.0):
+        self.chat_interval = chat_interval
+        self._bucket = TokenBucket(rate)
+        self._chat_next = {}
+        self._waiting = 0
+
+    def pending(self) -> int:
+        """Количество сообщений, ожидающих своей очереди на отправку."""
+        return self._waiting
+
+    def pause(self, chat_id, seconds: float) -> None:
+        """Откладывает отправку в чат (после ответа 429 с retry_after)."""
+        self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0), time.monotonic() + seconds)
+
+    async def wait(self, chat_id) -> None:
+        """Ждет окна отправки в чат и токена общего лимита."""
+        self._waiting += 1
+        try:
+            now = time.monotonic()
+            slot = max(now, self._chat_next.get(chat_id, 0))
+            self._chat_next[chat_id] = slot + self.chat_interval
+            if len(self._chat_next) > 10000:
+                self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            wait = self._bucket.try_acquire()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._bucket.try_acquire()
+        finally:
+            self._waiting -= 1
+
+
+class MessageDispatcher:
+    """
+    Очередь исходящих запросов к Telegram с пулом отправителей.
+    - общий лимит (global_rate сообщений в секунду, по умолчанию 30);
+    - не чаще одного сообщения в чат за chat_interval секунд;
+    - при ответе 429 запрос повторяется через retry_after секунд;
+    - интерактивные ответы имеют приоритет над рассылками уведомлений.
+    """
+
+    def __init__(self, bot, workers: int = 4, global_rate: float = 30,
+                 chat_interval: float = 1.0, max_retries: int = 3):
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(global_rate)
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._chat_next = {}
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._worker, daemon=True, name=f"sender-{i}")
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def qsize(self) -> int:
+        """Количество запросов, ожидающих отправки."""
+        return self._queue.qsize()
+
+    def submit(self, method: str, chat_id, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Future:
+        """Ставит вызов bot.<method>(chat_id, *args, **kwargs) в очередь и возвращает Future."""
+        future = Future()
+        # Контекст вызывающего (например, текущий спан трассировки) переносится в поток отправителя
+        job = (method, chat_id, args, kwargs, future, 0, contextvars.copy_context())
+        self._queue.put((priority, next(self._counter), job))
+        return future
+
+    def send_message(self, chat_id, text, priority: int = PRIORITY_INTERACTIVE, wait: bool = True, **kwargs):
+        """
+        Отправляет сообщение через очередь.
+        wait=True - дождаться отправки и вернуть Message (ошибки пробрасываются);
+        wait=False - вернуть Future сразу.
+        """
+        future = self.submit("send_message", chat_id, text, priority=priority, **kwargs)
+        return future.result() if wait else future
+
+    def _reserve_chat_slot(self, chat_id) -> float:
+        """
+        Резервирует ближайшее окно отправки в чат и возвращает задержку до него.
+        Если чат на паузе дольше chat_interval (после 429), окно не резервируется.
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._chat_next.get(chat_id, 0))
+            if slot - now > self.chat_interval:
+                return slot - now
+            self._chat_next[chat_id] = slot + self.chat_interval
+            if len(self._chat_next) > 10000:
+                self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+            return slot - now
+
+    def _requeue_later(self, delay: float, item: tuple) -> None:
+        timer = threading.Timer(delay, self._queue.put, args=(item,))
+        timer.daemon = True
+        timer.start()
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            priority, _, job = item
+            method, chat_id, args, kwargs, future, attempt, context = job
+            if future.cancelled():
+                continue
+
+            delay = self._reserve_chat_slot(chat_id)
+            if delay > self.chat_interval:
+                # Чат на паузе после 429 - не занимаем поток ожиданием
+                self._requeue_later(delay, item)
+                continue
+            if delay > 0:
+                time.sleep(delay)
+            self._bucket.acquire()
+
+            try:
+                result = context.run(getattr(self.bot, method), chat_id, *args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429 and attempt < self.max_retries:
+                    retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                    with self._lock:
+                        self._chat_next[chat_id] = time.monotonic() + retry_after
+                    retry_job = (method, chat_id, args, kwargs, future, attempt + 1, context)
+                    self._requeue_later(retry_after, (priority, next(self._counter), retry_job))
+                else:
+                    future.set_exception(e)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
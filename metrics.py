@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class LatencyWindow:
+    """
+    Скользящее окно последних size длительностей (в секундах) для расчета
+    перцентилей. Запись - O(1), расчет выполняется только по запросу.
+    """
+
+    def __init__(self, size: int = 1000):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        """Возвращает p-й перцентиль (0-100) или None, если замеров нет."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class Metrics:
+    """
+    Счетчики процесса бота: обновляются по ходу работы и дешево читаются
+    командой /stats и HTTP-проверкой /healthz.
+    """
+
+    def __init__(self, latency_window: int = 1000):
+        self.started_at = time.time()
+        self.handler_latency = LatencyWindow(latency_window)
+        self._counters = {}
+        self._upstream_in_flight = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """Увеличивает счетчик name."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def get(self, name: str) -> int:
+        return self._counters.get(name, 0)
+
+    def ratio(self, hits: str, misses: str) -> float:
+        """Доля hits среди hits + misses или None, если обращений не было."""
+        total = self.get(hits) + self.get(misses)
+        return self.get(hits) / total if total else None
+
+    @property
+    def upstream_in_flight(self) -> int:
+        """Количество выполняющихся запросов к внешним API."""
+        return self._upstream_in_flight
+
+    @contextmanager
+    def upstream(self):
+        """Учитывает запрос к внешнему API, выполняющийся внутри блока with."""
+        with self._lock:
+            self._upstream_in_flight += 1
+            self._counters["upstream_requests"] = self._counters.get("upstream_requests", 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._upstream_in_flight -= 1
+
+    def uptime(self) -> float:
+        return time.time() - self.started_at
+
+
+# Метрики процесса (общие для модулей бота)
+metrics = Metrics()
@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class NotificationScheduler:
+    """
+    Планировщик проверок погоды для подписчиков.
+    Для каждого ключа (например, ячейки местоположения с подписчиками)
+    хранится свое время следующей проверки в куче (heapq). Времена разбросаны
+    случайным образом по интервалу, поэтому нагрузка на API и Telegram
+    распределяется равномерно, а не приходит пачкой раз в 2 часа.
+    Наступившие проверки выполняются в ограниченном пуле потоков.
+    """
+
+    def __init__(self, check, interval: float = 7200, max_workers: int = 4,
+                 jitter: float = 0.1, first_check_delay: float = 60):
+        """
+        check(key) - выполняет проверку для ключа (вызывается в пуле потоков).
+        """
+        self.check = check
+        self.interval = interval
+        self.max_workers = max_workers
+        self.jitter = jitter
+        self.first_check_delay = first_check_delay
+
+        self._heap = []
+        self._entries = {}  # ключ -> время проверки (None - проверка выполняется)
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = None
+        self._thread = None
+        self._stopped = False
+        self.last_lag = 0.0
+
+    # ---------- управление расписанием ----------
+
+    def _push(self, key: str, due: float) -> None:
+        self._entries[key] = due
+        heapq.heappush(self._heap, (due, next(self._counter), key))
+        self._cond.notify()
+
+    def _next_due(self) -> float:
+        spread = self.interval * self.jitter
+        return time.time() + self.interval + random.uniform(-spread, spread)
+
+    def load(self, subscribers) -> None:
+        """
+        Заполняет расписание по списку (ключ, время последней проверки в epoch
+        или None). Просроченные проверки равномерно распределяются по интервалу.
+        """
+        now = time.time()
+        with self._cond:
+            for key, last_check_ts in subscribers:
+                due = last_check_ts + self.interval if last_check_ts else 0
+                if due <= now:
+                    due = now + random.uniform(0, self.interval)
+                self._push(key, due)
+
+    def schedule(self, key: str, delay: float = None) -> None:
+        """
+        Назначает проверку ключа через delay секунд (по умолчанию - скоро).
+        Если проверка уже назначена на более раннее время, она не переносится.
+        """
+        if delay is None:
+            delay = random.uniform(0, self.first_check_delay)
+        due = time.time() + delay
+        with self._cond:
+            current = self._entries.get(key)
+            if current is not None and current <= due:
+                return
+            self._push(key, due)
+
+    def unschedule(self, key: str) -> None:
+        """Убирает ключ из расписания (запись в куче удаляется лениво)."""
+        with self._cond:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._entries)
+
+    # ---------- выполнение ----------
+
+    def start(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix="notify")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+    def _pop_due(self) -> list:
+        """Ждет наступления ближайшей проверки и забирает все наступившие."""
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                while self._heap:
+                    due, _, key = self._heap[0]
+                    if self._entries.get(key) != due:
+                        heapq.heappop(self._heap)  # устаревшая запись
+                        continue
+                    break
+                if self._heap and self._heap[0][0] <= now:
+                    break
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(timeout)
+            else:
+                return []
+
+            due_keys = []
+            while self._heap and self._heap[0][0] <= now:
+                due, _, key = heapq.heappop(self._heap)
+                if self._entries.get(key) != due:
+                    continue
+                self._entries[key] = None
+                self.last_lag = now - due
+                due_keys.append(key)
+            return due_keys
+
+    def _run(self) -> None:
+        while not self._stopped:
+            for key in self._pop_due():
+                # Ждем свободный поток: очередь задач пула не растет без границ
+                self._slots.acquire()
+                try:
+                    self._executor.submit(self._check, key)
+                except RuntimeError:
+                    self._slots.release()
+                    return
+
+    def _check(self, key: str) -> None:
+        try:
+            self.check(key)
+        except Exception as e:
+            print(f"Ошибка в системе уведомлений: {e}")
+        finally:
+            self._slots.release()
+            with self._cond:
+                # Перепланируем, только если ключ не убрали из расписания
+                # и не назначили ему новую проверку во время выполнения
+                if key in self._entries and self._entries[key] is None:
+                    self._push(key, self._next_due())
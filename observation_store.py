@@ -0,0 +1,202 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+OBSERVATION_DB_FILE = BASE_DIR / "observations.db"
+
+KIND_CURRENT = "current"
+KIND_FORECAST = "forecast"
+
+
+def observation_rows(cell: str, kind: str, data: dict, fetched_at: int) -> list:
+    """
+    Переводит ответ OWM (текущая погода или прогноз) в строки временного ряда:
+    (cell, kind, ts, fetched_at, tz_offset, temp, humidity, pressure, wind, condition_id).
+    """
+    if not data:
+        return []
+    if kind == KIND_FORECAST:
+        items = data.get("list", [])
+        tz_offset = data.get("city", {}).get("timezone", 0)
+    else:
+        items = [data]
+        tz_offset = data.get("timezone", 0)
+    rows = []
+    for item in items:
+        if item.get("dt") is None:
+            continue
+        main = item.get("main", {})
+        rows.append((
+            cell,
+            kind,
+            int(item["dt"]),
+            fetched_at,
+            tz_offset or 0,
+            main.get("temp"),
+            main.get("humidity"),
+            main.get("pressure"),
+            item.get("wind", {}).get("speed"),
+            (item.get("weather") or [{}])[0].get("id")
+        ))
+    return rows
+
+
+class ObservationStore:
+    """
+    Локальный временной ряд полученных наблюдений (SQLite, режим WAL):
+    каждая текущая погода и каждый 3-часовой слот прогноза по ячейке места.
+    Ключ (ячейка, вид, время наблюдения) - повторный ответ для того же слота
+    заменяет прежний. Запись отложенная: add() только кладет строки в буфер,
+    фоновый поток сбрасывает их пакетом раз в flush_interval секунд.
+    Данные старше retention_days удаляются.
+    """
+
+    def __init__(self, path: Path = OBSERVATION_DB_FILE, flush_interval: float = 5.0,
+                 retention_days: int = 30):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self._pending = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS observations (
+                cell TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                fetched_at INTEGER NOT NULL,
+                tz_offset INTEGER NOT NULL DEFAULT 0,
+                temp REAL,
+                humidity INTEGER,
+                pressure INTEGER,
+                wind REAL,
+                condition_id INTEGER,
+                PRIMARY KEY (cell, ts, kind)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.commit()
+        self._last_prune = 0.0
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True, name="observations")
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, cell: str, kind: str, data: dict) -> None:
+        """Добавляет ответ API в буфер записи (без обращения к диску)."""
+        rows = observation_rows(cell, kind, data, int(time.time()))
+        if rows:
+            with self._lock:
+                self._pending.extend(rows)
+
+    def _flush_loop(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self) -> None:
+        """Записывает накопленные наблюдения одной транзакцией."""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        now = time.time()
+        try:
+            with self._db_lock, self._conn:
+                if batch:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch
+                    )
+                if now - self._last_prune > 3600:
+                    self._conn.execute("DELETE FROM observations WHERE ts < ?",
+                                       (int(now - self.retention_days * 86400),))
+                    self._last_prune = now
+        except sqlite3.Error as e:
+            print(f"Ошибка записи наблюдений: {e}")
+
+    def history(self, cell: str, days: int = 5, until: float = None) -> list:
+        """
+        Возвращает сводку по дням за последние days дней (по местному времени места):
+        список словарей {"date", "temp_min", "temp_max", "humidity", "pressure",
+        "wind_max", "condition_id", "samples"} от старых к новым.
+        Текущая погода важнее прогноза: слоты прогноза учитываются только
+        для часов, за которые нет наблюдения.
+        """
+        self.flush()
+        until = until or time.time()
+        with self._db_lock:
+            rows = self._conn.execute(
+                """
+                SELECT ts, kind, tz_offset, temp, humidity, pressure, wind, condition_id
+                FROM observations
+                WHERE cell = ? AND ts BETWEEN ? AND ?
+                ORDER BY ts
+                """,
+                (cell, int(until - days * 86400), int(until))
+            ).fetchall()
+
+        observed_hours = {ts // 3600 for ts, kind, *_ in rows if kind == KIND_CURRENT}
+        summary = {}
+        for ts, kind, tz_offset, temp, humidity, pressure, wind, condition_id in rows:
+            if kind == KIND_FORECAST and ts // 3600 in observed_hours:
+                continue
+            date = datetime.fromtimestamp(ts + tz_offset, timezone.utc).date()
+            day = summary.setdefault(date, {"temps": [], "humidity": [], "pressure": [], "wind": [], "conditions": {}})
+            if temp is not None:
+                day["temps"].append(temp)
+            if humidity is not None:
+                day["humidity"].append(humidity)
+            if pressure is not None:
+                day["pressure"].append(pressure)
+            if wind is not None:
+                day["wind"].append(wind)
+            if condition_id is not None:
+                day["conditions"][condition_id] = day["conditions"].get(condition_id, 0) + 1
+
+        result = []
+        for date in sorted(summary):
+            day = summary[date]
+            if not day["temps"]:
+                continue
+            result.append({
+                "date": date,
+                "temp_min": min(day["temps"]),
+                "temp_max": max(day["temps"]),
+                "humidity": round(sum(day["humidity"]) / len(day["humidity"])) if day["humidity"] else None,
+                "pressure": round(sum(day["pressure"]) / len(day["pressure"])) if day["pressure"] else None,
+                "wind_max": max(day["wind"]) if day["wind"] else None,
+                "condition_id": max(day["conditions"], key=day["conditions"].get) if day["conditions"] else None,
+                "samples": len(day["temps"])
+            })
+        return result
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+
+def create_observation_store():
+    """
+    Создает хранилище наблюдений: OBSERVATION_DB_FILE (по умолчанию observations.db),
+    OBSERVATION_RETENTION_DAYS (30). OBSERVATION_STORE=off отключает запись.
+    """
+    if os.getenv("OBSERVATION_STORE", "sqlite").lower() == "off":
+        return None
+    return ObservationStore(
+        Path(os.getenv("OBSERVATION_DB_FILE", OBSERVATION_DB_FILE)),
+        retention_days=int(os.getenv("OBSERVATION_RETENTION_DAYS", "30"))
+    )
@@ -0,0 +1,153 @@
+import atexit
+import cProfile
+import functools
+import inspect
+import os
+import random
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Выделения памяти самим профилировщиком в отчет не попадают
+_TRACEMALLOC_FILTERS = (
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, tracemalloc.__file__)
+)
+
+# Доля вызовов, которые профилируются (0 - профилирование выключено, 1 - каждый вызов)
+PROFILE_RATE = float(os.getenv("PROFILE_RATE", "0"))
+# Куда писать профили (.prof для pstats/snakeviz) и места выделения памяти (.alloc.txt)
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", BASE_DIR / "profiles"))
+# Глубина стека tracemalloc (0 - без снимков памяти)
+PROFILE_TRACEMALLOC = int(os.getenv("PROFILE_TRACEMALLOC", "0"))
+# Сколько мест выделения памяти записывать на вызов
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", "15"))
+# Раз в сколько профилированных вызовов обработчика перезаписывать его .prof
+PROFILE_DUMP_EVERY = int(os.getenv("PROFILE_DUMP_EVERY", "20"))
+
+
+class Profiler:
+    """
+    Выборочное профилирование обработчиков и запросов к API.
+    Вызов попадает в выборку с вероятностью rate; его время накапливается
+    в cProfile.Profile этого имени, который периодически и при выходе
+    сохраняется в PROFILE_DIR/<имя>.<pid>.prof. Одновременно работает только
+    один профилировщик (cProfile не вкладывается), поэтому вызов, пришедший,
+    пока идет замер другого, выполняется без профилирования - вложенные
+    вызовы (запрос к API внутри обработчика) видны в профиле внешнего.
+    С tracemalloc для вызова из выборки записываются места, где выделено
+    больше всего памяти, в PROFILE_DIR/<имя>.<pid>.alloc.txt.
+    """
+
+    def __init__(self, rate: float, directory: Path, tracemalloc_frames: int = 0,
+                 top_allocations: int = 15, dump_every: int = 20):
+        self.rate = rate
+        self.directory = Path(directory)
+        self.tracemalloc_frames = tracemalloc_frames
+        self.top_allocations = top_allocations
+        self.dump_every = dump_every
+        self._profiles = {}  # имя -> (cProfile.Profile, число замеров)
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if tracemalloc_frames and not tracemalloc.is_tracing():
+            tracemalloc.start(tracemalloc_frames)
+        atexit.register(self.dump_all)
+
+    def wrap(self, func, name: str):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if random.random() >= self.rate or not self._active.acquire(blocking=False):
+                return func(*args, **kwargs)
+            try:
+                return self._run(name, func, args, kwargs)
+            finally:
+                self._active.release()
+        return wrapper
+
+    def _run(self, name: str, func, args, kwargs):
+        with self._lock:
+            profile, samples = self._profiles.get(name) or (cProfile.Profile(), 0)
+            self._profiles[name] = (profile, samples + 1)
+        before = self._snapshot() if self.tracemalloc_frames else None
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - started
+            if before is not None:
+                self._write_allocations(name, elapsed, self._snapshot().compare_to(before, "lineno"))
+            if (samples + 1) % self.dump_every == 0:
+                self.dump(name)
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces(_TRACEMALLOC_FILTERS)
+
+    def _write_allocations(self, name: str, elapsed: float, stats) -> None:
+        lines = [f"# {time.strftime('%Y-%m-%d %H:%M:%S')} {name}: {elapsed * 1000:.1f} мс"]
+        lines += [str(stat) for stat in stats[:self.top_allocations]]
+        try:
+            with open(self.directory / f"{name}.{os.getpid()}.alloc.txt", "a", encoding="utf-8") as file:
+                file.write("\n".join(lines) + "\n\n")
+        except OSError as e:
+            print(f"Ошибка записи профиля памяти {name}: {e}")
+
+    def dump(self, name: str) -> None:
+        """Сохраняет накопленный профиль (pstats) для имени."""
+        with self._lock:
+            entry = self._profiles.get(name)
+        if entry is None:
+            return
+        try:
+            entry[0].dump_stats(str(self.directory / f"{name}.{os.getpid()}.prof"))
+        except OSError as e:
+            print(f"Ошибка записи профиля {name}: {e}")
+
+    def dump_all(self) -> None:
+        # Сохранение выключает профиль: ждем окончания текущего замера
+        acquired = self._active.acquire(timeout=5)
+        try:
+            with self._lock:
+                names = list(self._profiles)
+            for name in names:
+                self.dump(name)
+        finally:
+            if acquired:
+                self._active.release()
+
+
+profiler = Profiler(
+    PROFILE_RATE,
+    PROFILE_DIR,
+    tracemalloc_frames=PROFILE_TRACEMALLOC,
+    top_allocations=PROFILE_TOP_ALLOCATIONS,
+    dump_every=PROFILE_DUMP_EVERY
+) if PROFILE_RATE > 0 else None
+
+
+def profiled(name: str = None):
+    """
+    Декоратор выборочного профилирования. При выключенном профилировании
+    (PROFILE_RATE=0) возвращает функцию без обертки - накладных расходов нет.
+    """
+    def decorator(func):
+        if profiler is None or inspect.iscoroutinefunction(func):
+            return func
+        return profiler.wrap(func, name or f"{func.__module__}.{func.__name__}")
+    return decorator
+
+
+def profile_handlers(bot) -> None:
+    """Оборачивает все зарегистрированные обработчики бота (сообщения, кнопки, inline)."""
+    if profiler is None:
+        return
+    for handlers in (bot.message_handlers, bot.callback_query_handlers, bot.inline_handlers):
+        for handler in handlers:
+            func = handler["function"]
+            handler["function"] = profiled(f"handler.{func.__name__}")(func)
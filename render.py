@@ -0,0 +1,722 @@
+import html
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from telebot import types
+
+from metrics import metrics
+
+# Язык текстов (и описаний погоды OWM, lang=ru) - часть ключа кэша сообщений
+RENDER_LANGUAGE = "ru"
+
+# Сколько готовых текстов сообщений хранить в памяти
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "2048"))
+
+WELCOME_TEXT = """🌤️ <b>Добро пожаловать в WeatherBot!</b>
+
+Я помогу вам узнать погоду в любой точке мира! 🌍
+
+<b>📋 Выберите действие из меню ниже:</b>
+
+Нажмите на кнопки внизу экрана 👇"""
+
+MAIN_MENU_TEXT = """🌤️ <b>Главное меню WeatherBot</b>
+
+Выберите нужное действие из меню ниже 👇"""
+
+# Смайлики для погоды
+WEATHER_EMOJI = {
+    "ясно": "☀️",
+    "облачно": "☁️",
+    "пасмурно": "☁️",
+    "дождь": "🌧️",
+    "небольшой дождь": "🌦️",
+    "гроза": "⛈️",
+    "снег": "❄️",
+    "туман": "🌫️",
+    "ветер": "💨"
+}
+
+
+def _build_condition_emoji():
+    """Таблица смайликов по коду погодных условий OWM (openweathermap.org/weather-conditions)"""
+    table = {}
+    for code in range(200, 300):
+        table[code] = "⛈️"   # гроза
+    for code in range(300, 400):
+        table[code] = "🌦️"   # морось
+    for code in range(500, 600):
+        table[code] = "🌧️"   # дождь
+    table[500] = "🌦️"        # небольшой дождь
+    for code in range(600, 700):
+        table[code] = "❄️"   # снег
+    for code in range(700, 800):
+        table[code] = "🌫️"   # туман, дымка, пыль
+    table[771] = "💨"        # шквал
+    table[781] = "💨"        # смерч
+    table[800] = "☀️"        # ясно
+    for code in range(801, 805):
+        table[code] = "☁️"   # облачность
+    return table
+
+
+CONDITION_EMOJI = _build_condition_emoji()
+
+
+class RenderCache:
+    """
+    Потокобезопасный LRU-кэш готовых текстов сообщений.
+    Одно и то же наблюдение (например, при рассылке уведомлений подписчикам
+    одного города) форматируется один раз.
+    """
+
+    def __init__(self, max_size: int = 2048):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        """Возвращает текст по ключу; при промахе вызывает render() и запоминает результат"""
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                metrics.incr("render_hits")
+                return self._items[key]
+        metrics.incr("render_misses")
+        text = render()
+        with self._lock:
+            self._items[key] = text
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return text
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+
+def observation_key(data):
+    """
+    Идентификатор наблюдения OWM: (id города, время измерения dt, координаты).
+    None, если в ответе нет dt - такое сообщение не кэшируется.
+    """
+    if not data or not data.get("dt"):
+        return None
+    coord = data.get("coord", {})
+    return data.get("id"), data["dt"], coord.get("lat"), coord.get("lon")
+
+
+def get_main_menu():
+    """Создает главное меню с кнопками"""
+    markup = types.ReplyKeyboardMarkup(
+        resize_keyboard=True,
+        one_time_keyboard=False,
+        is_persistent=True
+    )
+    
+    # Первый ряд
+    btn1 = types.KeyboardButton("🏙️ Погода в городе")
+    btn2 = types.KeyboardButton("📅 Прогноз на 5 дней")
+    markup.row(btn1, btn2)
+    
+    # Второй ряд
+    btn3 = types.KeyboardButton("📍 Моё местоположение")
+    btn4 = types.KeyboardButton("🔔 Уведомления")
+    markup.row(btn3, btn4)
+    
+    # Третий ряд
+    btn5 = types.KeyboardButton("⚖️ Сравнить города")
+    btn6 = types.KeyboardButton("📊 Расширенные данные")
+    markup.row(btn5, btn6)
+    
+    # Четвертый ряд
+    btn7 = types.KeyboardButton("📈 История погоды")
+    btn8 = types.KeyboardButton("❓ Помощь")
+    markup.row(btn7, btn8)
+    
+    return markup
+
+
+def get_back_menu():
+    """Создает меню с кнопкой возврата"""
+    markup = types.ReplyKeyboardMarkup(
+        resize_keyboard=True,
+        is_persistent=True
+    )
+    markup.row(types.KeyboardButton("◀️ Главное меню"))
+    return markup
+
+
+def get_location_menu():
+    """Создает клавиатуру с кнопкой отправки местоположения"""
+    markup = types.ReplyKeyboardMarkup(
+        one_time_keyboard=True,
+        resize_keyboard=True
+    )
+    button = types.KeyboardButton(text="📍 Показать местоположение", request_location=True)
+    markup.add(button)
+    markup.add(types.KeyboardButton(text="❌ Отмена"))
+    return markup
+
+
+def build_notifications_status(enabled):
+    """Возвращает текст состояния уведомлений и кнопку переключения"""
+    markup = types.InlineKeyboardMarkup()
+    if enabled:
+        status_text = "🔔 <b>Уведомления включены</b>\n\nВы будете получать уведомления о погоде каждые 2 часа."
+        markup.add(types.InlineKeyboardButton(text="🔕 Отключить уведомления", callback_data="notif_off"))
+    else:
+        status_text = "🔕 <b>Уведомления отключены</b>\n\nВключите уведомления, чтобы получать информацию о погоде каждые 2 часа."
+        markup.add(types.InlineKeyboardButton(text="🔔 Включить уведомления", callback_data="notif_on"))
+    return status_text, markup
+
+
+def build_digest_status(digest_time, preset_times):
+    """
+    Возвращает текст состояния ежедневной сводки и кнопки выбора времени.
+    digest_time - минуты от полуночи по местному времени или None (сводка выключена)
+    """
+    markup = types.InlineKeyboardMarkup(row_width=4)
+    markup.add(*[
+        types.InlineKeyboardButton(text=f"{minute // 60:02d}:{minute % 60:02d}", callback_data=f"digest_{minute}")
+        for minute in preset_times
+    ])
+    help_text = "Выберите время кнопкой или отправьте /digest 07:30 (местное время вашего места)."
+    if digest_time is None:
+        status_text = f"🌅 <b>Утренняя сводка отключена</b>\n\nКаждый день в выбранное время бот пришлет прогноз на день.\n{help_text}"
+    else:
+        status_text = (f"🌅 <b>Утренняя сводка: каждый день в {digest_time // 60:02d}:{digest_time % 60:02d}</b>\n\n"
+                       f"{help_text}")
+        markup.add(types.InlineKeyboardButton(text="🔕 Отключить сводку", callback_data="digest_off"))
+    return status_text, markup
+
+
+def get_weather_emoji(description, condition_id=None):
+    """Возвращает смайлик по коду условий OWM, а без кода - по описанию погоды"""
+    emoji = CONDITION_EMOJI.get(condition_id)
+    if emoji:
+        return emoji
+    return _emoji_by_description(description)
+
+
+@lru_cache(maxsize=256)
+def _emoji_by_description(description):
+    description_lower = description.lower()
+    for key, emoji in WEATHER_EMOJI.items():
+        if key in description_lower:
+            return emoji
+    return "🌍"
+
+
+def _condition(data):
+    """Возвращает (описание, код условий) первого элемента weather ответа OWM"""
+    weather = (data.get("weather") or [{}])[0]
+    return weather.get("description", "N/A"), weather.get("id")
+
+
+def format_weather_message(data, city_name=None):
+    """Форматирует данные о погоде в красивое сообщение (с кэшированием по наблюдению)"""
+    key = observation_key(data)
+    if key is None:
+        return _format_weather_message(data, city_name)
+    return render_cache.get_or_render(
+        ("weather", RENDER_LANGUAGE, key, city_name),
+        lambda: _format_weather_message(data, city_name)
+    )
+
+
+def _format_weather_message(data, city_name=None):
+    if not data:
+        return "❌ Не удалось получить данные о погоде"
+    
+    # Основные данные
+    temp = data.get("main", {}).get("temp", "N/A")
+    feels_like = data.get("main", {}).get("feels_like", "N/A")
+    humidity = data.get("main", {}).get("humidity", "N/A")
+    pressure = data.get("main", {}).get("pressure", "N/A")
+    wind_speed = data.get("wind", {}).get("speed", "N/A")
+    description, condition_id = _condition(data)
+    city = city_name or data.get("name", "Неизвестно")
+    
+    emoji = get_weather_emoji(description, condition_id)
+    
+    message = f"{emoji} <b>Погода в городе {city}</b>\n\n"
+    message += f"🌡️ Температура: <b>{temp}°C</b>\n"
+    message += f"🤔 Ощущается как: <b>{feels_like}°C</b>\n"
+    message += f"💧 Влажность: <b>{humidity}%</b>\n"
+    message += f"🌪️ Ветер: <b>{wind_speed} м/с</b>\n"
+    message += f"📊 Давление: <b>{pressure} мм рт. ст.</b>\n"
+    message += f"📝 Описание: <b>{description.capitalize()}</b>"
+    
+    return message
+
+
+def format_extended_weather_message(weather_data, pollution_data=None, city_name=None):
+    """Форматирует расширенные данные о погоде (с кэшированием по наблюдению)"""
+    key = observation_key(weather_data)
+    if key is None:
+        return _format_extended_weather_message(weather_data, pollution_data, city_name)
+    pollution_list = (pollution_data or {}).get("list") or [{}]
+    return render_cache.get_or_render(
+        ("extended", RENDER_LANGUAGE, key, pollution_list[0].get("dt"), city_name),
+        lambda: _format_extended_weather_message(weather_data, pollution_data, city_name)
+    )
+
+
+def _format_extended_weather_message(weather_data, pollution_data=None, city_name=None):
+    if not weather_data:
+        return "❌ Не удалось получить данные о погоде"
+    
+    # Основные данные
+    temp = weather_data.get("main", {}).get("temp", "N/A")
+    feels_like = weather_data.get("main", {}).get("feels_like", "N/A")
+    humidity = weather_data.get("main", {}).get("humidity", "N/A")
+    pressure = weather_data.get("main", {}).get("pressure", "N/A")
+    wind_speed = weather_data.get("wind", {}).get("speed", "N/A")
+    description, condition_id = _condition(weather_data)
+    city = city_name or weather_data.get("name", "Неизвестно")
+    clouds = weather_data.get("clouds", {}).get("all", "N/A")
+    
+    # Время восхода и заката
+    sys_data = weather_data.get("sys", {})
+    sunrise = sys_data.get("sunrise")
+    sunset = sys_data.get("sunset")
+    
+    sunrise_str = datetime.fromtimestamp(sunrise).strftime("%H:%M") if sunrise else "N/A"
+    sunset_str = datetime.fromtimestamp(sunset).strftime("%H:%M") if sunset else "N/A"
+    
+    emoji = get_weather_emoji(description, condition_id)
+    
+    message = f"{emoji} <b>Расширенная информация о погоде</b>\n"
+    message += f"📍 <b>Город:</b> {city}\n\n"
+    
+    message += f"<b>🌡️ ТЕМПЕРАТУРА</b>\n"
+    message += f"  • Текущая: <b>{temp}°C</b>\n"
+    message += f"  • Ощущается: <b>{feels_like}°C</b>\n\n"
+    
+    message += f"<b>💨 ВЕТЕР И АТМОСФЕРА</b>\n"
+    message += f"  • Скорость ветра: <b>{wind_speed} м/с</b>\n"
+    message += f"  • Давление: <b>{pressure} мм рт. ст.</b>\n"
+    message += f"  • Влажность: <b>{humidity}%</b>\n"
+    message += f"  • Облачность: <b>{clouds}%</b>\n\n"
+    
+    message += f"<b>🌅 СОЛНЦЕ</b>\n"
+    message += f"  • Восход: <b>{sunrise_str}</b>\n"
+    message += f"  • Закат: <b>{sunset_str}</b>\n\n"
+    
+    # Добавляем данные о загрязнении, если они есть
+    if pollution_data and "list" in pollution_data and pollution_data["list"]:
+        components = pollution_data["list"][0].get("components", {})
+        aqi = pollution_data["list"][0].get("main", {}).get("aqi", "N/A")
+        
+        aqi_text = {
+            1: "Отличное 🟢",
+            2: "Хорошее 🟡",
+            3: "Умеренное 🟠",
+            4: "Плохое 🔴",
+            5: "Очень плохое 🟣"
+        }
+        
+        message += f"<b>🏭 КАЧЕСТВО ВОЗДУХА</b>\n"
+        message += f"  • Общий индекс: <b>{aqi_text.get(aqi, 'N/A')}</b>\n"
+        
+        if components:
+            message += f"  • PM2.5: <b>{components.get('pm2_5', 'N/A')} µg/m³</b>\n"
+            message += f"  • PM10: <b>{components.get('pm10', 'N/A')} µg/m³</b>\n"
+            message += f"  • CO: <b>{components.get('co', 'N/A')} µg/m³</b>\n"
+    
+    message += f"\n📝 <b>Описание:</b> {description.capitalize()}"
+    
+    return message
+
+
+def group_forecast_by_day(forecast_data):
+    """Группирует почасовой прогноз по дням: {дата: {date, day_name, forecasts}}"""
+    days_data = {}
+    
+    for item in forecast_data.get("list", []):
+        dt = datetime.fromtimestamp(item["dt"])
+        date_key = dt.strftime("%Y-%m-%d")
+        day_name = dt.strftime("%d.%m (%a)")
+        
+        if date_key not in days_data:
+            days_data[date_key] = {
+                "date": dt,
+                "day_name": day_name,
+                "forecasts": []
+            }
+        days_data[date_key]["forecasts"].append(item)
+    
+    return days_data
+
+
+def build_forecast_menu(forecast_data, city_name):
+    """Возвращает текст и inline-клавиатуру меню выбора дня прогноза"""
+    days_data = group_forecast_by_day(forecast_data)
+    
+    # Создаем inline-клавиатуру
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    
+    for date_key, day_info in list(days_data.items())[:5]:  # Берем только 5 дней
+        # Получаем среднюю температуру за день
+        temps = [f["main"]["temp"] for f in day_info["forecasts"]]
+        avg_temp = sum(temps) / len(temps)
+        
+        # Получаем наиболее частые погодные условия
+        conditions = [(f["weather"][0]["description"], f["weather"][0].get("id")) for f in day_info["forecasts"]]
+        most_common_desc, most_common_id = max(set(conditions), key=conditions.count)
+        emoji = get_weather_emoji(most_common_desc, most_common_id)
+        
+        button_text = f"{emoji} {day_info['day_name']} ({avg_temp:.1f}°C)"
+        callback_data = f"forecast_{date_key}"
+        
+        markup.add(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
+    
+    markup.add(types.InlineKeyboardButton(text="❌ Закрыть", callback_data="close_forecast"))
+    
+    message_text = f"📅 <b>Прогноз погоды на 5 дней</b>\n📍 {city_name}\n\nВыберите день для подробной информации:"
+    
+    return message_text, markup
+
+
+def build_forecast_day(forecast_data, date_key, city_name):
+    """
+    Возвращает текст и клавиатуру детального прогноза на день
+    или (None, None), если данных за этот день нет
+    """
+    # Находим прогнозы для выбранного дня
+    day_forecasts = []
+    for item in forecast_data["list"]:
+        dt = datetime.fromtimestamp(item["dt"])
+        if dt.strftime("%Y-%m-%d") == date_key:
+            day_forecasts.append(item)
+    
+    if not day_forecasts:
+        return None, None
+    
+    # Форматируем детальное сообщение
+    first_dt = datetime.fromtimestamp(day_forecasts[0]["dt"])
+    day_str = first_dt.strftime("%d.%m.%Y (%A)")
+    
+    message = f"📅 <b>Детальный прогноз на {day_str}</b>\n"
+    message += f"📍 {city_name}\n\n"
+    
+    for forecast in day_forecasts:
+        dt = datetime.fromtimestamp(forecast["dt"])
+        time_str = dt.strftime("%H:%M")
+        temp = forecast["main"]["temp"]
+        feels_like = forecast["main"]["feels_like"]
+        description, condition_id = _condition(forecast)
+        wind = forecast["wind"]["speed"]
+        humidity = forecast["main"]["humidity"]
+        emoji = get_weather_emoji(description, condition_id)
+        
+        message += f"🕐 <b>{time_str}</b>\n"
+        message += f"{emoji} {temp:.1f}°C (ощущ. {feels_like:.1f}°C)\n"
+        message += f"💨 {wind} м/с | 💧 {humidity}%\n"
+        message += f"📝 {description.capitalize()}\n\n"
+    
+    # Создаем кнопку "Назад"
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(text="◀️ Назад к выбору дня", callback_data="back_to_forecast"))
+    markup.add(types.InlineKeyboardButton(text="❌ Закрыть", callback_data="close_forecast"))
+    
+    return message, markup
+
+
+def build_forecast_views(forecast_data, city_name):
+    """
+    Отрисовывает меню и все дни прогноза сразу:
+    {"menu": (text, markup), "<дата>": (text, markup), ...}
+    """
+    views = {"menu": build_forecast_menu(forecast_data, city_name)}
+    for date_key in list(group_forecast_by_day(forecast_data))[:5]:
+        views[date_key] = build_forecast_day(forecast_data, date_key, city_name)
+    return views
+
+
+def format_compare_message(weather1, weather2, city1, city2):
+    """Форматирует сравнение погоды в двух городах (с кэшированием по паре наблюдений)"""
+    key1 = observation_key(weather1)
+    key2 = observation_key(weather2)
+    if key1 is None or key2 is None:
+        return _format_compare_message(weather1, weather2, city1, city2)
+    return render_cache.get_or_render(
+        ("compare", RENDER_LANGUAGE, key1, key2, city1, city2),
+        lambda: _format_compare_message(weather1, weather2, city1, city2)
+    )
+
+
+def _format_compare_message(weather1, weather2, city1, city2):
+    # Форматируем сравнение
+    name1 = weather1.get("name", city1)
+    name2 = weather2.get("name", city2)
+    
+    temp1 = weather1.get("main", {}).get("temp", 0)
+    temp2 = weather2.get("main", {}).get("temp", 0)
+    
+    humidity1 = weather1.get("main", {}).get("humidity", 0)
+    humidity2 = weather2.get("main", {}).get("humidity", 0)
+    
+    wind1 = weather1.get("wind", {}).get("speed", 0)
+    wind2 = weather2.get("wind", {}).get("speed", 0)
+    
+    pressure1 = weather1.get("main", {}).get("pressure", 0)
+    pressure2 = weather2.get("main", {}).get("pressure", 0)
+    
+    desc1, condition_id1 = _condition(weather1)
+    desc2, condition_id2 = _condition(weather2)
+    
+    emoji1 = get_weather_emoji(desc1, condition_id1)
+    emoji2 = get_weather_emoji(desc2, condition_id2)
+    
+    # Определяем, где теплее
+    if temp1 > temp2:
+        temp_compare = f"В {name1} теплее на {abs(temp1 - temp2):.1f}°C"
+    elif temp2 > temp1:
+        temp_compare = f"В {name2} теплее на {abs(temp1 - temp2):.1f}°C"
+    else:
+        temp_compare = "Температура одинаковая"
+    
+    message_text = f"⚖️ <b>Сравнение погоды</b>\n\n"
+    message_text += f"<b>{'─' * 30}</b>\n"
+    message_text += f"<b>{emoji1} {name1}</b> vs <b>{emoji2} {name2}</b>\n"
+    message_text += f"<b>{'─' * 30}</b>\n\n"
+    
+    message_text += f"🌡️ <b>Температура:</b>\n"
+    message_text += f"  • {name1}: <b>{temp1}°C</b>\n"
+    message_text += f"  • {name2}: <b>{temp2}°C</b>\n"
+    message_text += f"  ℹ️ {temp_compare}\n\n"
+    
+    message_text += f"💧 <b>Влажность:</b>\n"
+    message_text += f"  • {name1}: <b>{humidity1}%</b>\n"
+    message_text += f"  • {name2}: <b>{humidity2}%</b>\n\n"
+    
+    message_text += f"💨 <b>Ветер:</b>\n"
+    message_text += f"  • {name1}: <b>{wind1} м/с</b>\n"
+    message_text += f"  • {name2}: <b>{wind2} м/с</b>\n\n"
+    
+    message_text += f"📊 <b>Давление:</b>\n"
+    message_text += f"  • {name1}: <b>{pressure1} мм</b>\n"
+    message_text += f"  • {name2}: <b>{pressure2} мм</b>\n\n"
+    
+    message_text += f"📝 <b>Описание:</b>\n"
+    message_text += f"  • {name1}: {desc1.capitalize()}\n"
+    message_text += f"  • {name2}: {desc2.capitalize()}"
+    
+    return message_text
+
+
+# Показатели таблицы сравнения: (заголовок, путь в ответе OWM, единицы)
+COMPARE_METRICS = [
+    ("🌡️ Температура", ("main", "temp"), "°C"),
+    ("💨 Ветер", ("wind", "speed"), " м/с"),
+    ("💧 Влажность", ("main", "humidity"), "%"),
+    ("📊 Давление", ("main", "pressure"), " мм"),
+]
+
+
+def format_history_message(days, city_name):
+    """
+    Форматирует сводку погоды по дням из локального временного ряда (ObservationStore.history)
+    и тренд температуры между первым и последним днем
+    """
+    if not days:
+        return (f"📈 <b>История погоды</b>\n📍 {html.escape(city_name)}\n\n"
+                "Данных пока нет: история копится по мере запросов погоды для этого места.")
+    
+    message_text = f"📈 <b>История погоды за {len(days)} дн.</b>\n📍 {html.escape(city_name)}\n\n"
+    for day in days:
+        emoji = get_weather_emoji("", day["condition_id"])
+        message_text += f"{emoji} <b>{day['date'].strftime('%d.%m')}</b>: {day['temp_min']:.0f}…{day['temp_max']:.0f}°C"
+        if day["humidity"] is not None:
+            message_text += f", 💧 {day['humidity']}%"
+        if day["wind_max"] is not None:
+            message_text += f", 🌪️ до {day['wind_max']:.0f} м/с"
+        message_text += "\n"
+    
+    if len(days) > 1:
+        first = (days[0]["temp_min"] + days[0]["temp_max"]) / 2
+        last = (days[-1]["temp_min"] + days[-1]["temp_max"]) / 2
+        change = last - first
+        if change >= 1:
+            message_text += f"\n↗️ Теплеет: +{change:.1f}°C"
+        elif change <= -1:
+            message_text += f"\n↘️ Холодает: {change:.1f}°C"
+        else:
+            message_text += "\n➡️ Температура без заметных изменений"
+        pressures = [day["pressure"] for day in days if day["pressure"] is not None]
+        if len(pressures) > 1:
+            message_text += f"\n📊 Давление: {pressures[0]} → {pressures[-1]}"
+    
+    return message_text.rstrip()
+
+
+def format_digest_message(forecast_data, city_name, hours=24):
+    """
+    Форматирует ежедневную сводку: прогноз на ближайшие hours часов из ответа
+    OWM /forecast (время слотов - местное, по смещению city.timezone)
+    """
+    tz_offset = forecast_data.get("city", {}).get("timezone", 0)
+    slots = forecast_data.get("list", [])[:max(1, hours // 3)]
+    if not slots:
+        return "❌ Не удалось получить прогноз погоды"
+    
+    temps = [item["main"]["temp"] for item in slots if item.get("main", {}).get("temp") is not None]
+    conditions = {}
+    for item in slots:
+        description, condition_id = _condition(item)
+        conditions.setdefault(condition_id, [description, 0])[1] += 1
+    condition_id, (description, _) = max(conditions.items(), key=lambda entry: entry[1][1])
+    pop = max(item.get("pop", 0) for item in slots)
+    wind = max(item.get("wind", {}).get("speed", 0) for item in slots)
+    
+    message_text = f"🌅 <b>Сводка погоды на сутки</b>\n📍 {html.escape(city_name)}\n\n"
+    if temps:
+        message_text += f"🌡️ Температура: <b>{min(temps):.0f}…{max(temps):.0f}°C</b>\n"
+    message_text += f"{get_weather_emoji(description, condition_id)} {description.capitalize()}\n"
+    message_text += f"☔ Вероятность осадков: до <b>{pop * 100:.0f}%</b>\n"
+    message_text += f"🌪️ Ветер: до <b>{wind:.0f} м/с</b>\n\n"
+    for item in slots[::2]:
+        local_time = datetime.fromtimestamp(item["dt"] + tz_offset, timezone.utc).strftime("%H:%M")
+        item_description, item_condition_id = _condition(item)
+        message_text += (f"{local_time} {get_weather_emoji(item_description, item_condition_id)} "
+                         f"{item.get('main', {}).get('temp', 0):.0f}°C\n")
+    
+    return message_text.rstrip()
+
+
+def build_inline_results(cities):
+    """
+    Результаты inline-запроса: cities - список (название, широта, долгота, погода или None).
+    Для города без погоды в кэше результат отправляет только название.
+    """
+    results = []
+    for name, lat, lon, weather in cities:
+        if weather:
+            description, condition_id = _condition(weather)
+            temp = weather.get("main", {}).get("temp", "N/A")
+            title = f"{get_weather_emoji(description, condition_id)} {name}: {temp}°C"
+            text = format_weather_message(weather, name)
+        else:
+            description = "Погода загружается - продолжите ввод или повторите запрос"
+            title = f"📍 {name}"
+            text = f"📍 <b>{html.escape(name)}</b>"
+        results.append(types.InlineQueryResultArticle(
+            id=f"{lat}:{lon}",
+            title=title,
+            description=description.capitalize(),
+            input_message_content=types.InputTextMessageContent(text, parse_mode="HTML")
+        ))
+    return results
+
+
+def build_throttled_text(retry_after):
+    """Ответ пользователю, превысившему лимит запросов к погодным API"""
+    return (f"⏳ Слишком много запросов подряд. Попробуйте снова через {max(1, round(retry_after))} с.\n\n"
+            "Уже полученные данные (погода в вашем месте, прогноз) по-прежнему доступны.")
+
+
+def build_compare_prompt(max_cities):
+    """Текст приглашения ввести города для сравнения"""
+    return (f"⚖️ Введите от 2 до {max_cities} городов через запятую для сравнения.\n\n"
+            "Например: <code>Москва, Санкт-Петербург, Казань</code>")
+
+
+def split_city_list(text):
+    """Разбивает ввод по запятым, убирает пустые значения и повторы (без учета регистра)"""
+    cities = []
+    seen = set()
+    for city in (text or "").split(","):
+        city = city.strip()
+        if city and city.lower() not in seen:
+            seen.add(city.lower())
+            cities.append(city)
+    return cities
+
+
+def build_compare_reply(results, failed=(), timed_out=()):
+    """
+    Текст ответа на сравнение: для двух городов - подробное сравнение,
+    для большего числа или при ошибках - рейтинг по показателям.
+    """
+    if not results:
+        return "❌ Не удалось получить погоду ни для одного города: " + ", ".join(
+            html.escape(city) for city in list(failed) + list(timed_out))
+    if len(results) == 2 and not failed and not timed_out:
+        (city1, weather1), (city2, weather2) = results
+        return format_compare_message(weather1, weather2, city1, city2)
+    return format_compare_table(results, failed, timed_out)
+
+
+def format_compare_table(results, failed=(), timed_out=()):
+    """
+    Форматирует рейтинг городов по каждому показателю (по убыванию).
+    results - список (введенное название, ответ OWM); failed и timed_out -
+    города, для которых погоду получить не удалось или не удалось вовремя.
+    """
+    keys = tuple(observation_key(weather) for _, weather in results)
+    if None in keys:
+        return _format_compare_table(results, failed, timed_out)
+    cities = tuple(city for city, _ in results)
+    return render_cache.get_or_render(
+        ("compare_table", RENDER_LANGUAGE, keys, cities, tuple(failed), tuple(timed_out)),
+        lambda: _format_compare_table(results, failed, timed_out)
+    )
+
+
+def _format_compare_table(results, failed=(), timed_out=()):
+    message_text = f"⚖️ <b>Сравнение погоды ({len(results)} гор.)</b>\n\n"
+    
+    rows = []
+    for city, weather in results:
+        description, condition_id = _condition(weather)
+        rows.append((get_weather_emoji(description, condition_id), weather.get("name", city), weather))
+    
+    for title, (section, field), unit in COMPARE_METRICS:
+        ranked = sorted(rows, key=lambda row: row[2].get(section, {}).get(field, float("-inf")), reverse=True)
+        message_text += f"<b>{title}:</b>\n"
+        for place, (emoji, name, weather) in enumerate(ranked, start=1):
+            value = weather.get(section, {}).get(field, "N/A")
+            message_text += f"  {place}. {emoji} {name}: <b>{value}{unit}</b>\n"
+        message_text += "\n"
+    
+    if failed:
+        message_text += "❌ Не удалось получить: " + ", ".join(html.escape(city) for city in failed) + "\n"
+    if timed_out:
+        message_text += "⏱️ Не ответили вовремя: " + ", ".join(html.escape(city) for city in timed_out) + "\n"
+    
+    return message_text.rstrip()
+
+
+def _format_ratio(value):
+    return "—" if value is None else f"{value:.0%}"
+
+
+def format_stats_message(stats):
+    """Форматирует показатели бота (словарь collect_stats) для команды /stats"""
+    hours, rest = divmod(int(stats["uptime_seconds"]), 3600)
+    p95 = stats["handler_p95_ms"]
+    send_queue = stats["send_queue"]
+    return (
+        "📈 <b>Состояние бота</b>\n\n"
+        f"⏱️ Работает: <b>{hours} ч {rest // 60} мин</b>\n"
+        f"👥 Пользователей: <b>{stats['users']}</b>, подписчиков: <b>{stats['subscribers']}</b>\n"
+        f"🗺️ Ячеек в расписании уведомлений: <b>{stats['notification_cells']}</b>\n"
+        f"🌅 Получателей утренней сводки: <b>{stats['digest_users']}</b>\n\n"
+        f"🗄️ Кэш мест: <b>{stats['snapshot_cache_size']}</b>, попаданий: <b>{_format_ratio(stats['snapshot_hit_ratio'])}</b>\n"
+        f"📝 Кэш сообщений: <b>{stats['render_cache_size']}</b>, попаданий: <b>{_format_ratio(stats['render_hit_ratio'])}</b>\n"
+        f"🌐 Запросов к API в работе: <b>{stats['upstream_in_flight']}</b> (всего {stats['upstream_requests']})\n"
+        f"📤 Очередь отправки: <b>{'—' if send_queue is None else send_queue}</b>\n"
+        f"🔔 Задержка уведомлений: <b>{stats['scheduler_lag_seconds']:.1f} с</b>\n"
+        f"⚡ Обработка p95: <b>{'—' if p95 is None else f'{p95:.0f} мс'}</b> "
+        f"(замеров {stats['handler_samples']}, ошибок {stats['handler_errors']})\n"
+        f"🚦 Отклонено по лимиту: <b>{stats['throttled_requests']}</b> "
+        f"(пользователей в учете {stats['throttled_users_tracked']})"
+    )
@@ -0,0 +1,59 @@
+import bisect
+import hashlib
+
+# Поля обновления Telegram, в которых есть отправитель (from)
+UPDATE_SENDER_FIELDS = (
+    "message",
+    "edited_message",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "shipping_query",
+    "pre_checkout_query",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class ConsistentHashRing:
+    """
+    Консистентное хеширование ключей (ID пользователей) по узлам (процессам).
+    У каждого узла replicas виртуальных точек на кольце, поэтому ключи
+    распределяются равномерно, а при изменении числа узлов переезжает
+    только часть ключей.
+    """
+
+    def __init__(self, nodes, replicas: int = 100):
+        self.replicas = replicas
+        self._points = []
+        for node in nodes:
+            for i in range(replicas):
+                self._points.append((_hash(f"{node}:{i}"), node))
+        self._points.sort()
+        self._hashes = [point for point, _ in self._points]
+        self._nodes = [node for _, node in self._points]
+
+    def node_for(self, key) -> object:
+        """Возвращает узел, которому принадлежит ключ."""
+        if not self._points:
+            raise ValueError("Кольцо не содержит узлов")
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def update_user_id(update: dict):
+    """
+    Возвращает ID пользователя из обновления Telegram (словарь JSON) или None.
+    """
+    for field in UPDATE_SENDER_FIELDS:
+        payload = update.get(field)
+        if payload:
+            sender = payload.get("from") or payload.get("chat") or {}
+            if sender.get("id") is not None:
+                return sender["id"]
+    return None
@@ -0,0 +1,148 @@
+import multiprocessing
+import os
+import queue
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from telebot import apihelper
+
+from sharding import ConsistentHashRing, update_user_id
+from user_store import create_user_store
+
+# Загружаем переменные окружения
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+if not BOT_TOKEN:
+    raise ValueError("BOT_TOKEN не установлен в файле .env!")
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Число процессов-шардов (по умолчанию по числу ядер)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", str(os.cpu_count() or 1)))
+# Размер очереди обновлений каждого шарда: заполненная очередь притормаживает прием
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))
+# Общий для шардов кэш погоды по местам
+SHARED_CACHE_FILE = os.getenv("SHARED_CACHE_FILE", str(BASE_DIR / "weather_shared_cache.db"))
+# Лимит Telegram на все процессы бота делится между шардами
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+
+POLLING_TIMEOUT = 30
+
+
+def run_worker(index, count, update_queue):
+    """Точка входа процесса-шарда: настраивает окружение и запускает bot.run_shard_worker"""
+    os.environ["SHARD_INDEX"] = str(index)
+    os.environ["SHARD_COUNT"] = str(count)
+    os.environ["SHARED_CACHE_FILE"] = SHARED_CACHE_FILE
+    os.environ["SEND_GLOBAL_RATE"] = str(SEND_GLOBAL_RATE / count)
+    # Импорт после настройки окружения: bot читает его при загрузке
+    import bot
+    try:
+        bot.run_shard_worker(update_queue)
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """
+    Принимает обновления Telegram (long polling) и распределяет их по
+    процессам-шардам по ID пользователя (консистентное хеширование):
+    все обновления одного пользователя обрабатывает один процесс, который
+    хранит только свою долю пользователей и рассылает им уведомления.
+    """
+
+    def __init__(self, token: str, workers: int, queue_size: int = 1000):
+        self.token = token
+        self.workers = workers
+        self.ring = ConsistentHashRing(range(workers))
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues = [self._ctx.Queue(queue_size) for _ in range(workers)]
+        self._processes = [None] * workers
+        self._offset = None
+
+    def _start_worker(self, index: int) -> None:
+        process = self._ctx.Process(
+            target=run_worker,
+            args=(index, self.workers, self._queues[index]),
+            name=f"weather-shard-{index}",
+            daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self) -> None:
+        """Запускает процессы-шарды"""
+        for index in range(self.workers):
+            self._start_worker(index)
+
+    def check_workers(self) -> None:
+        """Перезапускает упавшие процессы-шарды (очередь и пользователи сохраняются)"""
+        for index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                print(f"⚠️ Шард {index + 1} завершился (код {process.exitcode}), перезапуск...")
+                self._start_worker(index)
+
+    def route(self, update: dict) -> None:
+        """Передает обновление шарду его пользователя (ждет, если очередь заполнена)"""
+        user_id = update_user_id(update)
+        key = user_id if user_id is not None else update.get("update_id")
+        self._queues[self.ring.node_for(key)].put(update)
+
+    def poll_forever(self) -> None:
+        """Получает обновления через getUpdates и распределяет их по шардам"""
+        apihelper.delete_webhook(self.token)
+        while True:
+            try:
+                updates = apihelper.get_updates(
+                    self.token,
+                    offset=self._offset,
+                    timeout=POLLING_TIMEOUT + 10,
+                    long_polling_timeout=POLLING_TIMEOUT
+                )
+            except Exception as e:
+                print(f"Ошибка получения обновлений: {e}")
+                time.sleep(3)
+                continue
+            self.check_workers()
+            for update in updates:
+                self.route(update)
+                self._offset = update["update_id"] + 1
+
+    def stop(self, timeout: float = 10) -> None:
+        """Останавливает шарды: дообрабатывают очередь и сохраняют данные"""
+        for update_queue in self._queues:
+            try:
+                update_queue.put(None, timeout=1)
+            except queue.Full:
+                pass
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
+
+
+def main():
+    """Запуск бота в режиме нескольких процессов-шардов"""
+    # Перенос user_data.json выполняется здесь один раз, а не одновременно в каждом шарде
+    create_user_store().close()
+    supervisor = Supervisor(BOT_TOKEN, BOT_WORKERS, SHARD_QUEUE_SIZE)
+    print(f"🧩 Запуск {BOT_WORKERS} процессов-шардов...")
+    supervisor.start()
+    print("✅ WeatherBot запущен!")
+    print("Нажмите Ctrl+C для остановки")
+    try:
+        supervisor.poll_forever()
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n👋 Бот остановлен")
+    except Exception as e:
+        print(f"❌ Критическая ошибка: {e}")
@@ -0,0 +1,317 @@
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Файл JSONL для спанов (пусто - трассировка выключена), например traces.jsonl
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+# Доля обновлений (корневых спанов), которые попадают в трассировку
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+# Сколько законченных спанов может ждать записи; лишние отбрасываются
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "weatherbot")
+
+# Виды спанов OTLP (SpanKind)
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+# Коды статуса OTLP
+STATUS_ERROR = 2
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """
+    Спан трассировки: имя, время начала и конца (нс), атрибуты и статус.
+    Пока спан не закончен, он текущий (contextvars) - спаны, начатые внутри,
+    становятся его дочерними и получают тот же trace_id.
+    """
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns",
+                 "attributes", "error", "sampled", "_token")
+
+    def __init__(self, name: str, kind: int, attributes: dict, parent=None):
+        if parent is None:
+            self.trace_id = os.urandom(16).hex()
+            self.parent_id = None
+            self.sampled = random.random() < TRACE_SAMPLE_RATE
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.sampled = parent.sampled
+        self.span_id = os.urandom(8).hex()
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._token = _current_span.set(self)
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def end(self, exception: BaseException = None) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if exception is not None:
+            # Только тип: текст исключений requests содержит адрес запроса вместе с ключом API
+            self.error = type(exception).__name__
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Спан закончен в другом контексте (другом потоке) - текущий спан там не менялся
+            pass
+        if self.sampled and exporter is not None:
+            exporter.export(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """Спан-заглушка при выключенной трассировке."""
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def end(self, exception: BaseException = None) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class JsonlSpanExporter:
+    """
+    Асинхронная запись спанов в JSONL: законченный спан кладется в очередь
+    (без ожидания - при переполнении спан отбрасывается), фоновый поток
+    пишет пачки. Каждая строка - запрос OTLP/JSON ExportTraceServiceRequest
+    (resourceSpans), который читает, например, ресивер otlpjsonfile
+    OpenTelemetry Collector.
+    """
+
+    def __init__(self, path: Path, queue_size: int = 10000, batch_size: int = 512,
+                 flush_interval: float = 1.0):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._resource = {"attributes": _otlp_attributes({
+            "service.name": TRACE_SERVICE_NAME,
+            "process.pid": os.getpid()
+        })}
+        self._thread = threading.Thread(target=self._run, daemon=True, name="trace-exporter")
+        self._thread.start()
+        atexit.register(self.close)
+
+    def export(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            try:
+                span = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            while span is not None:
+                batch.append(span)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    span = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            if span is None:
+                return
+
+    def _write(self, batch: list) -> None:
+        request = {"resourceSpans": [{
+            "resource": self._resource,
+            "scopeSpans": [{"scope": {"name": "weatherbot.tracing"}, "spans": [span.to_otlp() for span in batch]}]
+        }]}
+        try:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(request, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Ошибка записи трассировки: {e}")
+
+    def close(self) -> None:
+        """Дописывает спаны из очереди и останавливает поток записи."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+
+exporter = JsonlSpanExporter(
+    Path(TRACE_FILE) if os.path.isabs(TRACE_FILE) else BASE_DIR / TRACE_FILE,
+    queue_size=TRACE_QUEUE_SIZE
+) if TRACE_FILE else None
+
+
+def tracing_enabled() -> bool:
+    return exporter is not None
+
+
+def start_span(name: str, kind: int = KIND_INTERNAL, **attributes):
+    """Начинает спан (дочерний для текущего) и делает его текущим; закончить - span.end()."""
+    if exporter is None:
+        return NOOP_SPAN
+    return Span(name, kind, attributes, _current_span.get())
+
+
+@contextmanager
+def _span(name: str, kind: int, attributes: dict):
+    current = Span(name, kind, attributes, _current_span.get())
+    try:
+        yield current
+    except BaseException as e:
+        current.end(e)
+        raise
+    current.end()
+
+
+def span(name: str, kind: int = KIND_INTERNAL, **attributes):
+    """Контекстный менеджер спана; при выключенной трассировке - общая заглушка."""
+    if exporter is None:
+        return NOOP_SPAN
+    return _span(name, kind, attributes)
+
+
+def bind(func):
+    """
+    Привязывает func к текущему контексту трассировки - для передачи в пул потоков,
+    чтобы спаны внутри стали дочерними для текущего.
+    """
+    if exporter is None:
+        return func
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def trace_handlers(bot) -> None:
+    """Оборачивает зарегистрированные обработчики бота (TeleBot или AsyncTeleBot) в спаны handler.<имя>."""
+    if exporter is None:
+        return
+    for handlers in (bot.message_handlers, bot.callback_query_handlers, bot.inline_handlers):
+        for handler in handlers:
+            handler["function"] = _traced_handler(handler["function"])
+
+
+def _traced_handler(func):
+    name = f"handler.{func.__name__}"
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _telegram_attributes(method_name: str, params) -> dict:
+    return {
+        "rpc.system": "telegram",
+        "rpc.method": method_name,
+        "telegram.chat_id": (params or {}).get("chat_id")
+    }
+
+
+def trace_telegram_api() -> None:
+    """Спан на каждый вызов Telegram Bot API через telebot (все запросы идут через apihelper._make_request)."""
+    if exporter is None:
+        return
+    from telebot import apihelper
+    make_request = apihelper._make_request
+
+    def traced_make_request(token, method_name, method="get", params=None, files=None):
+        with span(f"telegram.{method_name}", KIND_CLIENT, **_telegram_attributes(method_name, params)):
+            return make_request(token, method_name, method=method, params=params, files=files)
+    apihelper._make_request = traced_make_request
+
+
+def trace_async_telegram_api() -> None:
+    """То же для AsyncTeleBot (asyncio_helper._process_request)."""
+    if exporter is None:
+        return
+    from telebot import asyncio_helper
+    process_request = asyncio_helper._process_request
+
+    async def traced_process_request(token, url, method="get", params=None, files=None, **kwargs):
+        with span(f"telegram.{url}", KIND_CLIENT, **_telegram_attributes(url, params)):
+            return await process_request(token, url, method=method, params=params, files=files, **kwargs)
+    asyncio_helper._process_request = traced_process_request
+
+
+def update_attributes(update) -> dict:
+    """Атрибуты корневого спана обновления Telegram (без текста сообщений, кроме команд)."""
+    update_type = {"Message": "message", "CallbackQuery": "callback_query",
+                   "InlineQuery": "inline_query"}.get(type(update).__name__, type(update).__name__)
+    attributes = {
+        "telegram.update_type": update_type,
+        "telegram.user_id": getattr(getattr(update, "from_user", None), "id", None)
+    }
+    if update_type == "message":
+        attributes["telegram.chat_id"] = update.chat.id
+        attributes["telegram.content_type"] = update.content_type
+        if (update.text or "").startswith("/"):
+            attributes["telegram.command"] = update.text.split()[0]
+    elif update_type == "callback_query":
+        attributes["telegram.callback_data"] = update.data
+    return attributes
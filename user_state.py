@@ -0,0 +1,250 @@
+import sys
+import threading
+from contextlib import contextmanager
+
+from user_store import UserStore, to_timestamp
+
+# Биты поля flags компактной записи
+FLAG_NOTIFICATIONS = 1
+FLAG_LOCATION = 2
+
+
+def new_user_record() -> dict:
+    """Возвращает запись нового пользователя со значениями по умолчанию."""
+    return {
+        "notifications": False,
+        "location": None,
+        "last_check": None,
+        "alert_state": None,
+        "digest_time": None,
+        "tz_offset": None,
+        "last_digest_date": None
+    }
+
+
+def _intern(value):
+    # Названия городов и состояния предупреждений повторяются у многих пользователей
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class UserRecord:
+    """
+    Компактная запись пользователя в памяти: поля в __slots__ вместо словаря
+    словарей, настройки - битами flags, время проверки - int epoch, строки
+    (город, состояние предупреждения) интернированы; время ежедневной сводки
+    (минуты от полуночи) и смещение часового пояса места (секунды) - числа,
+    местная дата последней отправленной сводки - строка ISO.
+    Наружу запись отдается словарем (to_dict), поэтому обработчики и UserStore
+    работают со словарями, как раньше.
+    Редкие поля, которых нет в слотах, хранятся в extra.
+    """
+
+    __slots__ = ("flags", "lat", "lon", "city", "last_check", "alert_state", "digest_time", "tz_offset",
+                 "last_digest_date", "extra")
+
+    def __init__(self, flags=0, lat=None, lon=None, city=None, last_check=None, alert_state=None,
+                 digest_time=None, tz_offset=None, last_digest_date=None, extra=None):
+        self.flags = flags
+        self.lat = lat
+        self.lon = lon
+        self.city = city
+        self.last_check = last_check
+        self.alert_state = alert_state
+        self.digest_time = digest_time
+        self.tz_offset = tz_offset
+        self.last_digest_date = last_digest_date
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, record: dict) -> "UserRecord":
+        record = dict(record)
+        location = record.pop("location", None)
+        flags = FLAG_NOTIFICATIONS if record.pop("notifications", False) else 0
+        lat = lon = city = None
+        if location:
+            flags |= FLAG_LOCATION
+            lat, lon, city = location.get("lat"), location.get("lon"), _intern(location.get("city"))
+        return cls(
+            flags=flags,
+            lat=lat,
+            lon=lon,
+            city=city,
+            last_check=to_timestamp(record.pop("last_check", None)),
+            alert_state=_intern(record.pop("alert_state", None)),
+            digest_time=record.pop("digest_time", None),
+            tz_offset=record.pop("tz_offset", None),
+            last_digest_date=record.pop("last_digest_date", None),
+            extra=record or None
+        )
+
+    def to_dict(self) -> dict:
+        record = {
+            "notifications": bool(self.flags & FLAG_NOTIFICATIONS),
+            "location": ({"lat": self.lat, "lon": self.lon, "city": self.city}
+                         if self.flags & FLAG_LOCATION else None),
+            "last_check": self.last_check,
+            "alert_state": self.alert_state,
+            "digest_time": self.digest_time,
+            "tz_offset": self.tz_offset,
+            "last_digest_date": self.last_digest_date
+        }
+        if self.extra:
+            record.update(self.extra)
+        return record
+
+    @property
+    def is_subscriber(self) -> bool:
+        flags = FLAG_NOTIFICATIONS | FLAG_LOCATION
+        return self.flags & flags == flags
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, UserRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+
+class UserStateRegistry:
+    """
+    Потокобезопасное хранилище состояния пользователей.
+    Структура словаря защищена отдельной блокировкой, а записи пользователей -
+    набором "полосатых" блокировок (одна блокировка на группу пользователей),
+    поэтому обработчики разных пользователей не ждут друг друга.
+    Каждое изменение записи сразу передается в UserStore.
+    Если задан index_key(record), поддерживается вторичный индекс
+    ключ -> множество пользователей (например, ячейка местоположения подписчика).
+    В памяти пользователи хранятся компактно: ID - int, запись - UserRecord;
+    методы принимают ID строкой и отдают записи словарями.
+    """
+
+    def __init__(self, store: UserStore, stripes: int = 64, index_key=None):
+        self.store = store
+        self._users = {}
+        self._index_lock = threading.Lock()
+        self._stripes = [threading.RLock() for _ in range(stripes)]
+        self._index_key = index_key
+        self._index = {}
+        self._user_index_key = {}
+
+    def _lock_for(self, user_id: int) -> threading.RLock:
+        return self._stripes[hash(user_id) % len(self._stripes)]
+
+    def load(self, owns=None) -> None:
+        """
+        Загружает пользователей из хранилища.
+        owns(user_id) -> bool ограничивает загрузку долей пользователей (процесс-шард).
+        """
+        data = self.store.load_all()
+        users = {}
+        for user_id, record in data.items():
+            if owns is None or owns(user_id):
+                users[int(user_id)] = UserRecord.from_dict(record)
+        del data
+        with self._index_lock:
+            self._users = users
+            self._index = {}
+            self._user_index_key = {}
+            for user_id, record in users.items():
+                self._reindex(user_id, record)
+
+    def _reindex(self, user_id: int, record: UserRecord) -> None:
+        """Обновляет вторичный индекс для пользователя (под _index_lock)."""
+        if self._index_key is None:
+            return
+        new_key = self._index_key(record.to_dict()) if record is not None else None
+        old_key = self._user_index_key.get(user_id)
+        if old_key == new_key:
+            return
+        if old_key is not None:
+            members = self._index.get(old_key)
+            if members is not None:
+                members.discard(user_id)
+                if not members:
+                    del self._index[old_key]
+            del self._user_index_key[user_id]
+        if new_key is not None:
+            self._index.setdefault(new_key, set()).add(user_id)
+            self._user_index_key[user_id] = new_key
+
+    def members(self, key) -> list:
+        """Возвращает пользователей (ID строкой) с данным ключом вторичного индекса."""
+        with self._index_lock:
+            return [str(user_id) for user_id in self._index.get(key, ())]
+
+    def index_keys(self) -> list:
+        """Возвращает все ключи вторичного индекса."""
+        with self._index_lock:
+            return list(self._index)
+
+    def indexed_count(self) -> int:
+        """Количество пользователей с ключом вторичного индекса (например, подписчиков)."""
+        with self._index_lock:
+            return len(self._user_index_key)
+
+    def __contains__(self, user_id: str) -> bool:
+        with self._index_lock:
+            return int(user_id) in self._users
+
+    def __len__(self) -> int:
+        with self._index_lock:
+            return len(self._users)
+
+    def get(self, user_id: str) -> dict:
+        """Возвращает копию записи пользователя или None."""
+        key = int(user_id)
+        with self._index_lock:
+            record = self._users.get(key)
+        if record is None:
+            return None
+        with self._lock_for(key):
+            return record.to_dict()
+
+    def ensure(self, user_id: str) -> dict:
+        """Создает запись пользователя, если ее нет, и возвращает копию."""
+        with self.edit(user_id, create=True) as record:
+            return dict(record)
+
+    @contextmanager
+    def edit(self, user_id: str, create: bool = False):
+        """
+        Контекстный менеджер для изменения записи пользователя под блокировкой.
+        Отдает запись словарем (или None, если пользователя нет и create=False);
+        по выходе изменения переносятся в компактную запись и сохраняются в хранилище.
+        """
+        key = int(user_id)
+        with self._lock_for(key):
+            with self._index_lock:
+                before = self._users.get(key)
+            if before is None and not create:
+                yield None
+                return
+            record = before.to_dict() if before is not None else new_user_record()
+            yield record
+            after = UserRecord.from_dict(record)
+            if before is None or after != before:
+                with self._index_lock:
+                    self._users[key] = after
+                    self._reindex(key, after)
+                self.store.upsert(str(user_id), after.to_dict())
+
+    def update(self, user_id: str, create: bool = True, **fields) -> dict:
+        """Обновляет поля записи пользователя и возвращает ее копию."""
+        with self.edit(user_id, create=create) as record:
+            if record is None:
+                return None
+            record.update(fields)
+            return UserRecord.from_dict(record).to_dict()
+
+    def snapshot(self) -> list:
+        """
+        Возвращает список (user_id, копия записи) для фоновых задач.
+        Итерация по снимку безопасна при одновременных изменениях.
+        """
+        with self._index_lock:
+            items = list(self._users.items())
+        return [(str(user_id), record.to_dict()) for user_id, record in items]
+
+    def subscribers_snapshot(self) -> list:
+        """Снимок пользователей с включенными уведомлениями и местоположением."""
+        with self._index_lock:
+            items = [(user_id, record) for user_id, record in self._users.items() if record.is_subscriber]
+        return [(str(user_id), record.to_dict()) for user_id, record in items]
@@ -0,0 +1,435 @@
+import atexit
+import json
+from abc import ABC, abstractmethod
+import os
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+from pathlib import Path
+
+# Файлы хранения данных пользователей
+BASE_DIR = Path(__file__).resolve().parent
+USER_DATA_FILE = BASE_DIR / "user_data.json"
+USER_DB_FILE = BASE_DIR / "user_data.db"
+
+
+def to_timestamp(value):
+    """Время проверки в секундах epoch (int); строки ISO из старых записей переводятся один раз."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp())
+    return int(value)
+
+
+class UserStore(ABC):
+    """
+    Интерфейс хранилища данных пользователей.
+    Запись пользователя - словарь вида
+    {"notifications": bool, "location": {...} | None, "last_check": int | None}
+    (last_check - секунды epoch; в старых записях - строка ISO).
+    """
+
+    @abstractmethod
+    def load_all(self) -> dict:
+        """Возвращает словарь {user_id: запись} со всеми пользователями."""
+
+    @abstractmethod
+    def get(self, user_id: str) -> dict:
+        """Возвращает запись пользователя или None."""
+
+    @abstractmethod
+    def upsert(self, user_id: str, record: dict) -> None:
+        """Создает или обновляет запись одного пользователя."""
+
+    def upsert_many(self, records: dict) -> None:
+        """Создает или обновляет записи нескольких пользователей."""
+        for user_id, record in records.items():
+            self.upsert(user_id, record)
+
+    @abstractmethod
+    def delete(self, user_id: str) -> None:
+        """Удаляет запись пользователя."""
+
+    def get_subscribers(self) -> dict:
+        """Возвращает пользователей с включенными уведомлениями."""
+        return {
+            user_id: record
+            for user_id, record in self.load_all().items()
+            if record.get("notifications")
+        }
+
+    def count(self) -> int:
+        """Возвращает количество пользователей."""
+        return len(self.load_all())
+
+    def close(self) -> None:
+        """Освобождает ресурсы хранилища."""
+
+
+class JsonUserStore(UserStore):
+    """
+    Хранилище в одном JSON-файле (прежний формат user_data.json).
+    Каждое изменение переписывает файл целиком через временный файл
+    и атомарное переименование, поэтому файл никогда не остается недописанным.
+    """
+
+    def __init__(self, path: Path = USER_DATA_FILE):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._data = self._read()
+
+    def _read(self) -> dict:
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Ошибка при загрузке данных пользователей: {e}")
+            return {}
+
+    def _write(self) -> None:
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.path.parent, prefix=self.path.name + ".", suffix=".tmp"
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Ошибка при сохранении данных пользователей: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load_all(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self._data))
+
+    def get(self, user_id: str) -> dict:
+        with self._lock:
+            record = self._data.get(user_id)
+            return json.loads(json.dumps(record)) if record is not None else None
+
+    def upsert(self, user_id: str, record: dict) -> None:
+        self.upsert_many({user_id: record})
+
+    def upsert_many(self, records: dict) -> None:
+        if not records:
+            return
+        with self._lock:
+            for user_id, record in records.items():
+                self._data[user_id] = json.loads(json.dumps(record))
+            self._write()
+
+    def delete(self, user_id: str) -> None:
+        with self._lock:
+            if self._data.pop(user_id, None) is not None:
+                self._write()
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class SQLiteUserStore(UserStore):
+    """
+    Хранилище в SQLite (режим WAL).
+    Каждое изменение - построчный upsert в одной транзакции,
+    поэтому сбой во время записи не портит остальные данные.
+    """
+
+    def __init__(self, path: Path = USER_DB_FILE):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                notifications INTEGER NOT NULL DEFAULT 0,
+                lat REAL,
+                lon REAL,
+                last_check INTEGER,
+                data TEXT NOT NULL
+            )
+            """
+        )
+        self._migrate_last_check()
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_notifications "
+            "ON users(notifications) WHERE notifications = 1"
+        )
+        self._conn.commit()
+
+    def _migrate_last_check(self) -> None:
+        """
+        Однократно переводит таблицу со столбцом last_check TEXT (строки ISO)
+        в last_check INTEGER (секунды epoch) - и столбец, и поле в data.
+        """
+        columns = {row[1]: row[2] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if columns.get("last_check", "").upper() == "INTEGER":
+            return
+        # Блокировка записи: другой процесс не перестроит таблицу одновременно
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1]: row[2] for row in self._conn.execute("PRAGMA table_info(users)")}
+            if columns.get("last_check", "").upper() != "INTEGER":
+                rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+                self._conn.execute(
+                    """
+                    CREATE TABLE users_migrated (
+                        user_id TEXT PRIMARY KEY,
+                        notifications INTEGER NOT NULL DEFAULT 0,
+                        lat REAL,
+                        lon REAL,
+                        last_check INTEGER,
+                        data TEXT NOT NULL
+                    )
+                    """
+                )
+                self._conn.executemany(
+                    "INSERT INTO users_migrated (user_id, notifications, lat, lon, last_check, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [self._row(user_id, self._record(data)) for user_id, data in rows],
+                )
+                self._conn.execute("DROP TABLE users")
+                self._conn.execute("ALTER TABLE users_migrated RENAME TO users")
+                print(f"📦 last_check переведен в секунды epoch: {len(rows)} пользователей")
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+
+    @staticmethod
+    def _record(data: str) -> dict:
+        # Строка ISO в last_check (запись старой версии) переводится в секунды epoch
+        record = json.loads(data)
+        if isinstance(record.get("last_check"), str):
+            record["last_check"] = to_timestamp(record["last_check"])
+        return record
+
+    @staticmethod
+    def _row(user_id: str, record: dict) -> tuple:
+        location = record.get("location") or {}
+        return (
+            user_id,
+            1 if record.get("notifications") else 0,
+            location.get("lat"),
+            location.get("lon"),
+            to_timestamp(record.get("last_check")),
+            json.dumps(record, ensure_ascii=False),
+        )
+
+    def load_all(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+        return {user_id: self._record(data) for user_id, data in rows}
+
+    def get(self, user_id: str) -> dict:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return self._record(row[0]) if row else None
+
+    def upsert(self, user_id: str, record: dict) -> None:
+        self.upsert_many({user_id: record})
+
+    def upsert_many(self, records: dict) -> None:
+        if not records:
+            return
+        rows = [self._row(user_id, record) for user_id, record in records.items()]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    """
+                    INSERT INTO users (user_id, notifications, lat, lon, last_check, data)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        notifications = excluded.notifications,
+                        lat = excluded.lat,
+                        lon = excluded.lon,
+                        last_check = excluded.last_check,
+                        data = excluded.data
+                    """,
+                    rows,
+                )
+
+    def delete(self, user_id: str) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+    def get_subscribers(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, data FROM users WHERE notifications = 1"
+            ).fetchall()
+        return {user_id: self._record(data) for user_id, data in rows}
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class WriteBehindUserStore(UserStore):
+    """
+    Отложенная запись поверх другого хранилища.
+    Изменения помечают пользователя "грязным" и копятся в памяти; фоновый поток
+    сбрасывает их одной пакетной записью раз в flush_interval секунд или сразу,
+    как только накопилось max_batch пользователей. При close() (и при выходе
+    из процесса) все накопленные изменения гарантированно записываются.
+    """
+
+    def __init__(self, inner: UserStore, flush_interval: float = 2.0, max_batch: int = 500):
+        self.inner = inner
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _flush_loop(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """Записывает все накопленные изменения одной пакетной операцией."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._dirty = self._dirty, {}
+            if not batch:
+                return
+            try:
+                self.inner.upsert_many(batch)
+            except Exception as e:
+                print(f"Ошибка при сохранении данных пользователей: {e}")
+                # Возвращаем несохраненные записи, не затирая более новые
+                with self._lock:
+                    for user_id, record in batch.items():
+                        self._dirty.setdefault(user_id, record)
+
+    def load_all(self) -> dict:
+        data = self.inner.load_all()
+        with self._lock:
+            data.update(json.loads(json.dumps(self._dirty)))
+        return data
+
+    def get(self, user_id: str) -> dict:
+        with self._lock:
+            record = self._dirty.get(user_id)
+            if record is not None:
+                return json.loads(json.dumps(record))
+        return self.inner.get(user_id)
+
+    def upsert(self, user_id: str, record: dict) -> None:
+        self.upsert_many({user_id: record})
+
+    def upsert_many(self, records: dict) -> None:
+        if not records:
+            return
+        with self._lock:
+            for user_id, record in records.items():
+                self._dirty[user_id] = json.loads(json.dumps(record))
+            full = len(self._dirty) >= self.max_batch
+        if full:
+            self._wakeup.set()
+
+    def delete(self, user_id: str) -> None:
+        # Ждем идущий сброс: иначе уже взятый им пакет запишет пользователя
+        # обратно после удаления (или вернет его в _dirty при ошибке записи)
+        with self._flush_lock:
+            with self._lock:
+                self._dirty.pop(user_id, None)
+            self.inner.delete(user_id)
+
+    def get_subscribers(self) -> dict:
+        self.flush()
+        return self.inner.get_subscribers()
+
+    def count(self) -> int:
+        self.flush()
+        return self.inner.count()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        self.inner.close()
+
+
+def migrate_json_to_store(store: UserStore, json_path: Path = USER_DATA_FILE) -> int:
+    """
+    Однократно переносит пользователей из user_data.json в хранилище.
+    Перенос выполняется, только если хранилище пустое; после успешного
+    переноса файл переименовывается в user_data.json.migrated.
+    Возвращает количество перенесенных пользователей.
+    """
+    json_path = Path(json_path)
+    if not json_path.exists() or store.count() > 0:
+        return 0
+
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            legacy_data = json.load(f)
+    except Exception as e:
+        print(f"Ошибка при чтении {json_path} для миграции: {e}")
+        return 0
+
+    store.upsert_many(legacy_data)
+    try:
+        json_path.rename(json_path.with_name(json_path.name + ".migrated"))
+    except FileNotFoundError:
+        # Файл уже перенес другой процесс; записи те же, повторная запись безвредна
+        return 0
+    return len(legacy_data)
+
+
+def create_user_store(write_behind: bool = False) -> UserStore:
+    """
+    Создает хранилище по переменной окружения USER_STORE:
+    "sqlite" (по умолчанию) или "json".
+    USER_STORE_FLUSH_INTERVAL (секунды, по умолчанию 2) включает отложенную
+    пакетную запись; значение 0 отключает ее. write_behind=True оставляет
+    отложенную запись включенной всегда - для асинхронного бота, где запись
+    на диск внутри обработчика блокировала бы цикл событий.
+    """
+    backend = os.getenv("USER_STORE", "sqlite").lower()
+
+    if backend == "json":
+        store = JsonUserStore(Path(os.getenv("USER_DATA_FILE", USER_DATA_FILE)))
+    else:
+        store = SQLiteUserStore(Path(os.getenv("USER_DB_FILE", USER_DB_FILE)))
+        migrated = migrate_json_to_store(store)
+        if migrated:
+            print(f"📦 Перенесено пользователей из user_data.json: {migrated}")
+
+    flush_interval = float(os.getenv("USER_STORE_FLUSH_INTERVAL", "2"))
+    if write_behind and flush_interval <= 0:
+        print("⚠️  USER_STORE_FLUSH_INTERVAL=0 не поддерживается асинхронным ботом, используется 2 с")
+        flush_interval = 2
+    if flush_interval > 0:
+        max_batch = int(os.getenv("USER_STORE_FLUSH_BATCH", "500"))
+        store = WriteBehindUserStore(store, flush_interval=flush_interval, max_batch=max_batch)
+    return store
@@ -0,0 +1,50 @@
+import threading
+import time
+from collections import OrderedDict
+
+from message_dispatcher import TokenBucket
+
+
+class UserThrottle:
+    """
+    Ограничение запросов к погодным API на пользователя: у каждого свое
+    "ведро токенов" (burst запросов подряд, затем rate запросов в секунду).
+    Ведра хранятся в LRU не больше max_users штук. Ведро, простоявшее
+    burst / rate секунд, снова полное и ничем не отличается от нового,
+    поэтому такие ведра удаляются без потери состояния.
+    """
+
+    def __init__(self, rate: float = 0.2, burst: float = 5, max_users: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.idle_seconds = burst / rate
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, user_id) -> TokenBucket:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            self._buckets.move_to_end(user_id)
+            # Старые ведра - в начале: удаляем простаивающие и лишние
+            while self._buckets:
+                oldest = next(iter(self._buckets.values()))
+                if oldest is bucket:
+                    break
+                if len(self._buckets) <= self.max_users and now - oldest.updated < self.idle_seconds:
+                    break
+                self._buckets.popitem(last=False)
+            return bucket
+
+    def try_acquire(self, user_id, cost: float = 1) -> float:
+        """
+        Списывает cost токенов пользователя. Возвращает 0, если запрос разрешен,
+        иначе через сколько секунд его можно повторить.
+        """
+        return self._bucket(user_id).try_acquire(cost)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
@@ -0,0 +1,39 @@
+from weather_app import get_location_cell
+
+
+# Тексты предупреждений по классам погоды
+ALERT_MESSAGES = {
+    "thunderstorm": "⛈️ Внимание! Ожидается гроза!",
+    "rain": "🌧️ Внимание! Ожидается дождь!",
+    "snow": "❄️ Внимание! Ожидается снег!"
+}
+
+
+def classify_weather_alert(weather_data):
+    """Возвращает класс предупреждения для погоды или None, если предупреждать не о чем"""
+    weather_id = weather_data.get("weather", [{}])[0].get("id", 0)
+    
+    # Коды погоды: 2xx - гроза, 3xx - морось, 5xx - дождь, 6xx - снег
+    if 200 <= weather_id < 300:
+        return "thunderstorm"
+    elif 300 <= weather_id < 600:
+        return "rain"
+    elif 600 <= weather_id < 700:
+        return "snow"
+    return None
+
+
+def alert_state_changed(previous_state, current_state):
+    """
+    Нужно ли уведомлять: только при появлении или смене класса погоды
+    (например, дождь → гроза). Пока класс не меняется, повторов нет
+    """
+    return current_state is not None and current_state != previous_state
+
+
+def subscriber_cell(user_info):
+    """Возвращает ячейку местоположения подписчика (None, если уведомления выключены)"""
+    location = user_info.get("location")
+    if not user_info.get("notifications") or not location:
+        return None
+    return get_location_cell(location["lat"], location["lon"])
@@ -1,11 +1,24 @@
 import requests
 from dotenv import load_dotenv 
 import os
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
 from pathlib import Path
 import json
+import atexit
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+
+from metrics import metrics
+from city_index import city_index, normalize_city_name
+from observation_store import create_observation_store
+from profiling import profiled
+from tracing import KIND_CLIENT, span, bind
 
 # Получаем путь к директории, где находится скрипт
 BASE_DIR = Path(__file__).resolve().parent
@@ -19,6 +32,101 @@ if not env_loaded:
     env_path = BASE_DIR.parent / '.env'
     env_loaded = load_dotenv(dotenv_path=env_path)
 
+# Общий срок по умолчанию на получение данных (все запросы цепочки вместе), секунды
+FETCH_DEADLINE = float(os.getenv("FETCH_DEADLINE", "8"))
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """Срок цепочки запросов истек до отправки очередного запроса."""
+
+
+class Deadline:
+    """
+    Общий срок цепочки запросов (погода, затем геокодер, затем запасной геокодер):
+    каждый следующий запрос получает только оставшееся время, поэтому цепочка
+    в целом не дольше исходного срока. Передается в функции получения данных
+    вместо отдельных таймаутов; число секунд превращается в Deadline через of().
+    """
+
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def of(cls, value=None) -> "Deadline":
+        """Deadline как есть; число секунд - новый срок; None - FETCH_DEADLINE."""
+        if isinstance(value, Deadline):
+            return value
+        return cls(FETCH_DEADLINE if value is None else value)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+def upstream_span(url: str):
+    """Спан запроса к внешнему API: имя по адресу без параметров (в них ключ API)."""
+    parts = urlsplit(url)
+    return span(f"GET {parts.hostname}{parts.path}", KIND_CLIENT, **{
+        "http.request.method": "GET",
+        "server.address": parts.hostname,
+        "url.path": parts.path
+    })
+
+
+# Потоки HTTP-запросов: таймаут requests действует на каждую операцию с сокетом,
+# а не на весь запрос, поэтому вызывающий ждет ответа не дольше остатка срока,
+# а медленный запрос дорабатывает здесь до своего таймаута.
+# Отдельно от _fetch_executor: его задачи сами вызывают http_get.
+_http_executor = ThreadPoolExecutor(max_workers=int(os.getenv("HTTP_WORKERS", "32")),
+                                    thread_name_prefix="http")
+
+
+def _timed_get(url: str, deadline: Deadline, kwargs: dict):
+    """requests.get в потоке _http_executor с таймаутом по остатку срока."""
+    # Задача могла ждать свободного потока - срок проверяется еще раз
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded(f"Срок истек до запроса {urlsplit(url).path}")
+    return requests.get(url, timeout=remaining, **kwargs)
+
+
+def http_get(url: str, deadline=None, **kwargs):
+    """
+    GET-запрос к внешнему API (учитывается в метриках как выполняющийся и в трассировке).
+    Весь запрос, включая чтение ответа, укладывается в остаток срока deadline; если
+    срок истек до или во время запроса - DeadlineExceeded (подкласс requests Timeout,
+    его ловят те же обработчики ошибок).
+    """
+    deadline = Deadline.of(deadline)
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded(f"Срок истек до запроса {urlsplit(url).path}")
+    with metrics.upstream(), upstream_span(url) as current_span:
+        future = _http_executor.submit(_timed_get, url, deadline, kwargs)
+        try:
+            response = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            raise DeadlineExceeded(f"Срок истек во время запроса {urlsplit(url).path}") from None
+        current_span.set_attribute("http.response.status_code", response.status_code)
+        return response
+
+
+def upstream_unavailable(status_code) -> bool:
+    """
+    API погоды недоступен: ответа нет (None - сетевая ошибка или истек срок), 429 или 5xx.
+    В этих случаях фоновые вызовы берут последнюю известную погоду из кэша.
+    """
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+# Запись кэша из нескольких потоков (например, параллельное /compare) идет по очереди
+_cache_lock = threading.Lock()
+
 
 def save_weather_cache(data: dict, city: str = None, lat: float = None, lon: float = None) -> None:
     """
@@ -32,11 +140,18 @@ def save_weather_cache(data: dict, city: str = None, lat: float = None, lon: flo
         "weather_data": data
     }
     
+    tmp_path = None
     try:
-        with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache_data, f, ensure_ascii=False, indent=2)
+        with _cache_lock:
+            # Пишем во временный файл и подменяем - читатель не увидит файл наполовину
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_FILE.parent, prefix=CACHE_FILE.name + ".", suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(cache_data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, CACHE_FILE)
     except Exception as e:
         print(f"Ошибка при сохранении кэша: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def load_weather_cache() -> dict:
@@ -107,9 +222,14 @@ def format_cached_weather(cache_data: dict) -> None:
             print(f"(Данные из кэша, получены {hours}ч {minutes}мин назад)")
 
 # 
-def get_weather(city: str) -> dict:
+@profiled()
+def get_weather(city: str, interactive: bool = False, deadline=None) -> dict:
     """
     Получает текущую погоду для указанного города.
+    При сетевой ошибке, 429 и 5xx возвращается последняя известная погода города
+    (cached_city_weather); interactive=True (консольный режим) вместо этого
+    спрашивает, показать ли данные из файла кэша.
+    deadline - общий срок в секундах или Deadline (по умолчанию FETCH_DEADLINE).
     """
     api_key = os.getenv("API_KEY")
     
@@ -128,8 +248,7 @@ def get_weather(city: str) -> dict:
         url = f"https://api.openweathermap.org/data/2.5/weather?q={encoded_city}&appid={api_key}&units=metric&lang=ru"
         
         try:
-            # Добавляем таймаут 10 секунд для запроса
-            response = requests.get(url, timeout=30)
+            response = http_get(url, deadline=deadline)
             if response.status_code == 200:
                 data = response.json()
                 # Сохраняем в кэш
@@ -159,9 +278,13 @@ def get_weather(city: str) -> dict:
                 return None
             else:
                 print(f"Ошибка: {response.status_code} - {response.text}")
+                if not interactive and upstream_unavailable(response.status_code):
+                    return cached_city_weather(city)
                 return None
         except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.RequestException) as e:
             print(f"Ошибка: Не удалось получить данные о погоде. {type(e).__name__}")
+            if not interactive:
+                return cached_city_weather(city)
             
             # Предлагаем использовать кэш
             cache_data = load_weather_cache()
@@ -176,10 +299,95 @@ def get_weather(city: str) -> dict:
             return None
 
 
-def get_weather_by_coordinates(latitude: float, longitude: float) -> dict:
+# Точность округления координат для ячейки местоположения (2 знака ≈ 1 км)
+LOCATION_CELL_PRECISION = 2
+
+
+def get_location_cell(latitude: float, longitude: float) -> str:
+    """
+    Возвращает ключ ячейки местоположения: координаты, округленные до
+    LOCATION_CELL_PRECISION знаков. Пользователи из одной ячейки получают
+    одни и те же погодные данные.
+    """
+    return f"{round(latitude, LOCATION_CELL_PRECISION)}:{round(longitude, LOCATION_CELL_PRECISION)}"
+
+
+def parse_location_cell(cell: str) -> tuple:
+    """
+    Возвращает координаты (lat, lon) центра ячейки местоположения.
+    """
+    lat, lon = cell.split(":")
+    return float(lat), float(lon)
+
+
+@profiled()
+def reverse_geocode(latitude: float, longitude: float, default_name: str = "Неизвестно",
+                    deadline=None) -> str:
+    """
+    Получает название места на русском по координатам.
+    Сначала пробует Nominatim (OpenStreetMap), затем OpenWeatherMap Geocoding;
+    если оба не сработали или общий срок deadline истек, возвращает default_name.
+    """
+    deadline = Deadline.of(deadline)
+    api_key = os.getenv("API_KEY")
+    city_name = default_name
+    try:
+        # Используем Nominatim для получения локализованного названия на русском
+        nominatim_url = f"https://nominatim.openstreetmap.org/reverse?lat={latitude}&lon={longitude}&format=json&accept-language=ru&addressdetails=1"
+        headers = {'User-Agent': 'WeatherApp/1.0'}  # Требуется для Nominatim
+        nominatim_response = http_get(nominatim_url, deadline=deadline, headers=headers)
+        if nominatim_response.status_code == 200:
+            nominatim_data = nominatim_response.json()
+            address = nominatim_data.get("address", {})
+            # Пробуем получить название города из разных полей
+            city_name = (address.get("city") or 
+                        address.get("town") or 
+                        address.get("village") or 
+                        address.get("municipality") or
+                        address.get("county") or
+                        nominatim_data.get("display_name", "").split(",")[0] if nominatim_data.get("display_name") else None)
+            
+            # Если не получили название из Nominatim, пробуем OpenWeatherMap Geocoding
+            if not city_name:
+                geocode_url = f"http://api.openweathermap.org/geo/1.0/reverse?lat={latitude}&lon={longitude}&limit=1&appid={api_key}&lang=ru"
+                geocode_response = http_get(geocode_url, deadline=deadline)
+                if geocode_response.status_code == 200:
+                    geocode_data = geocode_response.json()
+                    if geocode_data and len(geocode_data) > 0:
+                        city_name = geocode_data[0].get("name", default_name)
+            
+            # Если все еще нет названия, используем значение по умолчанию
+            if not city_name:
+                city_name = default_name
+        else:
+            # Если Nominatim не сработал, пробуем OpenWeatherMap Geocoding
+            geocode_url = f"http://api.openweathermap.org/geo/1.0/reverse?lat={latitude}&lon={longitude}&limit=1&appid={api_key}&lang=ru"
+            geocode_response = http_get(geocode_url, deadline=deadline)
+            if geocode_response.status_code == 200:
+                geocode_data = geocode_response.json()
+                if geocode_data and len(geocode_data) > 0:
+                    city_name = geocode_data[0].get("name", default_name)
+    except Exception as e:
+        # Если все методы не сработали, используем значение по умолчанию
+        city_name = default_name
+    return city_name
+
+
+@profiled()
+def get_weather_by_coordinates(latitude: float, longitude: float,
+                               resolve_city_name: bool = True, interactive: bool = False,
+                               deadline=None, stale_fallback: bool = True) -> dict:
     """
     Получает текущую погоду по координатам.
+    resolve_city_name=False пропускает запросы к геокодерам (название берется из ответа погоды).
+    При сетевой ошибке, 429 и 5xx, как и get_weather, возвращает последнюю известную
+    погоду места (cached_coordinates_weather); stale_fallback=False - None (LocationSnapshot
+    сам решает, отдать ли устаревшие данные). interactive=True (консольный режим) вместо
+    этого спрашивает, показать ли данные из файла кэша.
+    deadline - общий срок на погоду и геокодеры: геокодеры получают остаток после
+    запроса погоды, а если он исчерпан - название берется из ответа погоды.
     """
+    deadline = Deadline.of(deadline)
     api_key = os.getenv("API_KEY")
     
     if not api_key:
@@ -192,57 +400,17 @@ def get_weather_by_coordinates(latitude: float, longitude: float) -> dict:
     url = f"https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={api_key}&units=metric&lang=ru"
     
     try:
-        # Добавляем таймаут 10 секунд для запроса
-        response = requests.get(url, timeout=10)
+        response = http_get(url, deadline=deadline)
         if response.status_code == 200:
             data = response.json()
             # Сохраняем в кэш
             save_weather_cache(data, lat=latitude, lon=longitude)
             
             # Получаем название города на русском через Nominatim (OpenStreetMap)
-            city_name = "Неизвестно"
-            try:
-                # Используем Nominatim для получения локализованного названия на русском
-                nominatim_url = f"https://nominatim.openstreetmap.org/reverse?lat={latitude}&lon={longitude}&format=json&accept-language=ru&addressdetails=1"
-                headers = {'User-Agent': 'WeatherApp/1.0'}  # Требуется для Nominatim
-                nominatim_response = requests.get(nominatim_url, headers=headers, timeout=10)
-                if nominatim_response.status_code == 200:
-                    nominatim_data = nominatim_response.json()
-                    address = nominatim_data.get("address", {})
-                    # Пробуем получить название города из разных полей
-                    city_name = (address.get("city") or 
-                                address.get("town") or 
-                                address.get("village") or 
-                                address.get("municipality") or
-                                address.get("county") or
-                                nominatim_data.get("display_name", "").split(",")[0] if nominatim_data.get("display_name") else None)
-                    
-                    # Если не получили название из Nominatim, пробуем OpenWeatherMap Geocoding
-                    if not city_name:
-                        geocode_url = f"http://api.openweathermap.org/geo/1.0/reverse?lat={latitude}&lon={longitude}&limit=1&appid={api_key}&lang=ru"
-                        geocode_response = requests.get(geocode_url, timeout=10)
-                        if geocode_response.status_code == 200:
-                            geocode_data = geocode_response.json()
-                            if geocode_data and len(geocode_data) > 0:
-                                city_name = geocode_data[0].get("name", data.get("name", "Неизвестно"))
-                    
-                    # Если все еще нет названия, используем из weather API
-                    if not city_name:
-                        city_name = data.get("name", "Неизвестно")
-                else:
-                    # Если Nominatim не сработал, пробуем OpenWeatherMap Geocoding
-                    geocode_url = f"http://api.openweathermap.org/geo/1.0/reverse?lat={latitude}&lon={longitude}&limit=1&appid={api_key}&lang=ru"
-                    geocode_response = requests.get(geocode_url, timeout=10)
-                    if geocode_response.status_code == 200:
-                        geocode_data = geocode_response.json()
-                        if geocode_data and len(geocode_data) > 0:
-                            city_name = geocode_data[0].get("name", data.get("name", "Неизвестно"))
-                        else:
-                            city_name = data.get("name", "Неизвестно")
-                    else:
-                        city_name = data.get("name", "Неизвестно")
-            except Exception as e:
-                # Если все методы не сработали, используем название из weather API
+            if resolve_city_name and not deadline.expired:
+                city_name = reverse_geocode(latitude, longitude, default_name=data.get("name", "Неизвестно"),
+                                            deadline=deadline)
+            else:
                 city_name = data.get("name", "Неизвестно")
             
             # Извлекаем данные из ответа
@@ -257,9 +425,13 @@ def get_weather_by_coordinates(latitude: float, longitude: float) -> dict:
             return None
         else:
             print(f"Ошибка: {response.status_code} - {response.text}")
+            if not interactive and stale_fallback and upstream_unavailable(response.status_code):
+                return cached_coordinates_weather(latitude, longitude)
             return None
     except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.RequestException) as e:
         print(f"Ошибка: Не удалось получить данные о погоде. {type(e).__name__}")
+        if not interactive:
+            return cached_coordinates_weather(latitude, longitude) if stale_fallback else None
         
         # Предлагаем использовать кэш
         cache_data = load_weather_cache()
@@ -274,8 +446,10 @@ def get_weather_by_coordinates(latitude: float, longitude: float) -> dict:
         return None
 
 #погода по часам ---------------------------------------
-def get_weather_by_hour(latitude: float, longitude: float) -> dict:
-    
+@profiled()
+def get_weather_by_hour(latitude: float, longitude: float, deadline=None) -> dict:
+    """Прогноз на 5 дней с шагом 3 часа; deadline - срок в секундах или Deadline."""
+
     api_key = os.getenv("API_KEY")
     
     if not api_key:
@@ -289,7 +463,7 @@ def get_weather_by_hour(latitude: float, longitude: float) -> dict:
     print(url) 
     
     try:
-        response = requests.get(url, timeout=10)
+        response = http_get(url, deadline=deadline)
         if response.status_code == 200:
             data = response.json()
             return data
@@ -506,9 +680,11 @@ def format_pollution_data(data: dict) -> None:
             pass
 
 
-def get_weather_pollution(latitude: float, longitude: float) -> dict:
+@profiled()
+def get_weather_pollution(latitude: float, longitude: float, deadline=None) -> dict:
     """
     Получает данные о загрязнении воздуха по координатам.
+    deadline - срок в секундах или Deadline.
     """
     api_key = os.getenv("API_KEY")
     
@@ -522,7 +698,7 @@ def get_weather_pollution(latitude: float, longitude: float) -> dict:
     url = f"https://api.openweathermap.org/data/2.5/air_pollution?lat={latitude}&lon={longitude}&appid={api_key}"
     
     try:
-        response = requests.get(url, timeout=10)
+        response = http_get(url, deadline=deadline)
         if response.status_code == 200:
             data = response.json()
             # Форматируем и выводим данные
@@ -536,6 +712,326 @@ def get_weather_pollution(latitude: float, longitude: float) -> dict:
         return None
 #загрязнение воздуха --------------------------------------- end
 
+#снимок местоположения ---------------------------------------
+# Сколько секунд текущая погода считается свежей
+CURRENT_WEATHER_TTL = int(os.getenv("CURRENT_WEATHER_TTL", "600"))
+# Прогноз OWM обновляется шагами по 3 часа, загрязнение воздуха - раз в час
+FORECAST_SLOT_SECONDS = 3 * 3600
+POLLUTION_SLOT_SECONDS = 3600
+# Сколько секунд устаревшие данные места еще можно отдать, если свежие не успели получить
+STALE_DATA_MAX_AGE = int(os.getenv("STALE_DATA_MAX_AGE", "10800"))
+# Сколько мест держать в памяти
+SNAPSHOT_CACHE_SIZE = int(os.getenv("SNAPSHOT_CACHE_SIZE", "10000"))
+
+
+class SharedSnapshotCache:
+    """
+    Общий для процессов бота кэш частей LocationSnapshot в SQLite (режим WAL).
+    Процесс, которому нужны свежие данные места, сначала смотрит сюда,
+    поэтому несколько процессов не запрашивают одно и то же у API.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS snapshot_cache (
+                cell TEXT NOT NULL,
+                part TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (cell, part)
+            )
+            """
+        )
+        self._conn.commit()
+        self._closed = False
+        atexit.register(self.close)
+
+    def get(self, cell: str, part: str):
+        """Возвращает (data, fetched_at) или None."""
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT data, fetched_at FROM snapshot_cache WHERE cell = ? AND part = ?", (cell, part)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения общего кэша: {e}")
+            return None
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def put(self, cell: str, part: str, data: dict, fetched_at: float) -> None:
+        """Сохраняет часть снимка места для остальных процессов."""
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO snapshot_cache (cell, part, fetched_at, data) VALUES (?, ?, ?, ?)",
+                    (cell, part, fetched_at, json.dumps(data, ensure_ascii=False))
+                )
+        except sqlite3.Error as e:
+            print(f"Ошибка записи общего кэша: {e}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._conn.close()
+
+
+# Общий кэш включается переменной SHARED_CACHE_FILE (ее задает supervisor.py для процессов-шардов)
+_shared_cache = SharedSnapshotCache(os.getenv("SHARED_CACHE_FILE")) if os.getenv("SHARED_CACHE_FILE") else None
+
+
+def close_shared_cache() -> None:
+    """Закрывает соединение с общим кэшем процессов (при остановке шарда)."""
+    if _shared_cache is not None:
+        _shared_cache.close()
+
+
+# Временной ряд всех полученных наблюдений и слотов прогноза (для /history).
+# Создается при первом обращении: импорт weather_app (консольный режим,
+# async_weather, дочерние процессы supervisor.py) не открывает observations.db
+_observation_store = None
+_observation_store_created = False
+_observation_store_lock = threading.Lock()
+
+
+def get_observation_store():
+    """Возвращает хранилище наблюдений (создает при первом вызове) или None, если оно отключено."""
+    global _observation_store, _observation_store_created
+    if not _observation_store_created:
+        with _observation_store_lock:
+            if not _observation_store_created:
+                _observation_store = create_observation_store()
+                _observation_store_created = True
+    return _observation_store
+
+
+class LocationSnapshot:
+    """
+    Данные одного места (ячейки местоположения): текущая погода, прогноз
+    и загрязнение воздуха. Каждая часть обновляется в своем ритме - текущая
+    погода раз в CURRENT_WEATHER_TTL секунд, прогноз раз в 3-часовой слот,
+    загрязнение раз в час, - поэтому /weather, /forecast, /extended и уведомления
+    для одного места используют одни и те же ответы API.
+    """
+
+    PARTS = ("current", "forecast", "pollution")
+
+    def __init__(self, cell: str):
+        self.cell = cell
+        self.latitude, self.longitude = parse_location_cell(cell)
+        self.city_name = None
+        self._data = {}
+        self._fetched_at = {}
+        # Отдельная блокировка на часть: одновременные запросы одной части ждут один ответ API
+        self._locks = {part: threading.Lock() for part in self.PARTS}
+
+    @staticmethod
+    def _is_fresh(part: str, fetched_at: float, now: float) -> bool:
+        if part == "current":
+            return now - fetched_at < CURRENT_WEATHER_TTL
+        if part == "forecast":
+            return fetched_at // FORECAST_SLOT_SECONDS == now // FORECAST_SLOT_SECONDS
+        return fetched_at // POLLUTION_SLOT_SECONDS == now // POLLUTION_SLOT_SECONDS
+
+    def cached(self, part: str, shared: bool = True):
+        """
+        Возвращает свежие данные части (из памяти или общего кэша процессов) или None.
+        shared=False - только из памяти (без запроса к SQLite общего кэша).
+        """
+        now = time.time()
+        fetched_at = self._fetched_at.get(part)
+        if fetched_at is not None and self._is_fresh(part, fetched_at, now):
+            return self._data[part]
+        if shared and _shared_cache is not None:
+            entry = _shared_cache.get(self.cell, part)
+            if entry and self._is_fresh(part, entry[1], now):
+                self._data[part], self._fetched_at[part] = entry
+                return entry[0]
+        return None
+
+    def latest(self, part: str, max_age: float = STALE_DATA_MAX_AGE):
+        """Последние полученные данные части, даже устаревшие, но не старше max_age секунд."""
+        fetched_at = self._fetched_at.get(part)
+        if fetched_at is not None and time.time() - fetched_at < max_age:
+            return self._data[part]
+        return None
+
+    def put(self, part: str, data: dict) -> None:
+        """Сохраняет ответ API для части (например, погоду, полученную по названию города)."""
+        if data:
+            fetched_at = time.time()
+            self._data[part] = data
+            self._fetched_at[part] = fetched_at
+            if _shared_cache is not None:
+                _shared_cache.put(self.cell, part, data, fetched_at)
+            if part in ("current", "forecast"):
+                store = get_observation_store()
+                if store is not None:
+                    store.add(self.cell, part, data)
+
+    def _fetch(self, part: str, deadline: Deadline):
+        if part == "current":
+            return get_weather_by_coordinates(self.latitude, self.longitude, resolve_city_name=False,
+                                              deadline=deadline, stale_fallback=False)
+        if part == "forecast":
+            return get_weather_by_hour(self.latitude, self.longitude, deadline=deadline)
+        return get_weather_pollution(self.latitude, self.longitude, deadline=deadline)
+
+    def get(self, part: str, deadline=None):
+        """
+        Возвращает свежие данные части, при необходимости запрашивая API.
+        deadline - общий срок (секунды или Deadline): ожидание чужого запроса той же
+        части и собственный запрос укладываются в него. Если свежие данные не удалось
+        получить вовремя, возвращаются последние известные (latest), иначе None.
+        """
+        deadline = Deadline.of(deadline)
+        with span("cache.snapshot", part=part, cell=self.cell) as current_span:
+            data = self.cached(part)
+            current_span.set_attribute("cache.hit", data is not None)
+            if data is not None:
+                metrics.incr("snapshot_hits")
+                return data
+            metrics.incr("snapshot_misses")
+            lock = self._locks[part]
+            if not lock.acquire(timeout=deadline.remaining()):
+                # Запрос той же части другим потоком не успел завершиться
+                return self._fallback(part, current_span)
+            try:
+                # Пока ждали блокировку, данные мог получить другой поток
+                data = self.cached(part)
+                if data is None:
+                    data = self._fetch(part, deadline)
+                    self.put(part, data)
+            finally:
+                lock.release()
+            if data is None:
+                return self._fallback(part, current_span)
+            return data
+
+    def _fallback(self, part: str, current_span):
+        data = self.latest(part)
+        current_span.set_attribute("cache.stale", data is not None)
+        if data is not None:
+            metrics.incr("snapshot_stale")
+        return data
+
+
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+
+
+def get_location_snapshot(latitude: float, longitude: float) -> LocationSnapshot:
+    """
+    Возвращает общий LocationSnapshot для ячейки, в которую попадают координаты.
+    """
+    cell = get_location_cell(latitude, longitude)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(cell)
+        if snapshot is None:
+            snapshot = _snapshots[cell] = LocationSnapshot(cell)
+        _snapshots.move_to_end(cell)
+        while len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+            _snapshots.popitem(last=False)
+        return snapshot
+
+
+def snapshot_cache_size() -> int:
+    """Количество мест в кэше снимков."""
+    return len(_snapshots)
+
+
+def remember_weather(data: dict) -> None:
+    """
+    Сохраняет текущую погоду (например, полученную по названию города) в снимок ее места
+    и добавляет город в индекс подсказок inline-режима.
+    """
+    coord = (data or {}).get("coord", {})
+    if coord.get("lat") is not None and coord.get("lon") is not None:
+        get_location_snapshot(coord["lat"], coord["lon"]).put("current", data)
+        city_index.add(data.get("name"), coord["lat"], coord["lon"])
+
+
+def cached_city_weather(city: str):
+    """
+    Последняя известная погода города, если получить свежую не удалось: из снимка
+    места города (город известен индексу городов) или из файла кэша; иначе None.
+    """
+    key = normalize_city_name(city)
+    for name, lat, lon in city_index.search(city, limit=1):
+        if normalize_city_name(name) == key:
+            data = get_location_snapshot(lat, lon).latest("current")
+            if data is not None:
+                return data
+    cache_data = load_weather_cache()
+    if cache_data and normalize_city_name(cache_data.get("city")) == key:
+        return cache_data.get("weather_data")
+    return None
+
+
+def cached_coordinates_weather(latitude: float, longitude: float):
+    """
+    Последняя известная погода места, если получить свежую не удалось: из снимка
+    ячейки места или из файла кэша (если он записан для той же ячейки); иначе None.
+    """
+    data = get_location_snapshot(latitude, longitude).latest("current")
+    if data is not None:
+        return data
+    cache_data = load_weather_cache()
+    if (cache_data and cache_data.get("lat") is not None and cache_data.get("lon") is not None
+            and get_location_cell(cache_data["lat"], cache_data["lon"]) == get_location_cell(latitude, longitude)):
+        return cache_data.get("weather_data")
+    return None
+
+
+def _resolve_city_name(snapshot: LocationSnapshot, deadline: Deadline):
+    if snapshot.city_name is None:
+        snapshot.city_name = reverse_geocode(snapshot.latitude, snapshot.longitude,
+                                             default_name=None, deadline=deadline)
+    return snapshot.city_name
+
+
+# Общий пул для одновременных запросов к погодным API и геокодерам
+_fetch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("FETCH_WORKERS", "16")),
+                                     thread_name_prefix="fetch")
+
+
+def fetch_location_snapshot(latitude: float, longitude: float, deadline=None,
+                            resolve_city_name: bool = True) -> dict:
+    """
+    Одновременно получает текущую погоду, загрязнение воздуха и название места
+    по координатам с общим сроком deadline (секунды или Deadline) на все запросы.
+    Свежие части берутся из LocationSnapshot без обращения к API.
+    Возвращает {"weather": ..., "pollution": ..., "city_name": ...}; вместо частей,
+    которые не удалось получить вовремя, - последние известные данные места или None.
+    """
+    deadline = Deadline.of(deadline)
+    location = get_location_snapshot(latitude, longitude)
+    parts = {"weather": "current", "pollution": "pollution"}
+    jobs = {key: _fetch_executor.submit(bind(location.get), part, deadline=deadline) for key, part in parts.items()}
+    if resolve_city_name:
+        jobs["city_name"] = _fetch_executor.submit(bind(_resolve_city_name), location, deadline)
+    wait(jobs.values(), timeout=deadline.remaining())
+    
+    snapshot = {"weather": None, "pollution": None, "city_name": None}
+    for key, future in jobs.items():
+        if future.done() and future.exception() is None:
+            snapshot[key] = future.result()
+            continue
+        if not future.done():
+            future.cancel()
+            print(f"Ошибка: {key} для ({latitude}, {longitude}) не получен в срок")
+        if key in parts:
+            snapshot[key] = location.latest(parts[key])
+    return snapshot
+#снимок местоположения --------------------------------------- end
+
 if __name__ == "__main__":
     print("=== Программа погоды ===")
     choice = input("Выберите опцию:\n1 - Погода по городу\n2 - Погода по координатам\n3 - Прогноз погоды по часам\n4 - Загрязнение воздуха\nВаш выбор: ")
@@ -543,7 +1039,7 @@ if __name__ == "__main__":
     if choice == "1":
         city = input("Введите название города: ")
         if city:
-            get_weather(city=city)
+            get_weather(city=city, interactive=True)
         else:
             print("Город не указан!")
     
@@ -551,7 +1047,7 @@ if __name__ == "__main__":
         try:
             latitude = float(input("Введите широту (latitude): "))
             longitude = float(input("Введите долготу (longitude): "))
-            get_weather_by_coordinates(latitude, longitude)
+            get_weather_by_coordinates(latitude, longitude, interactive=True)
              
         except ValueError:
             print("Ошибка: введите корректные числовые значения для координат!")
@@ -0,0 +1,181 @@
+import itertools
+import json
+import queue
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from telebot import types
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """WSGI-сервер, обрабатывающий каждый запрос в отдельном потоке."""
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Обработчик запросов без записи каждого запроса в консоль."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+def health_response(start_response, health):
+    """Отвечает на проверку /healthz: JSON из health() со статусом 200 или 503 при ошибке."""
+    try:
+        body = json.dumps({"status": "ok", **health()}, ensure_ascii=False)
+        status = "200 OK"
+    except Exception as e:
+        body = json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
+        status = "503 Service Unavailable"
+    return WebhookServer._respond(start_response, status, body.encode("utf-8"), "application/json")
+
+
+class HealthServer:
+    """
+    HTTP-сервер только для проверки /healthz (в режиме polling, где нет webhook-сервера).
+    health() возвращает словарь показателей бота.
+    """
+
+    def __init__(self, health, host: str = "0.0.0.0", port: int = 8081, path: str = "/healthz"):
+        self.health = health
+        self.host = host
+        self.port = port
+        self.path = path
+        self._server = None
+
+    def __call__(self, environ, start_response):
+        """WSGI-приложение."""
+        if environ.get("PATH_INFO") != self.path:
+            return WebhookServer._respond(start_response, "404 Not Found")
+        return health_response(start_response, self.health)
+
+    def start(self) -> None:
+        """Запускает сервер в фоновом потоке."""
+        self._server = make_server(self.host, self.port, self,
+                                   server_class=ThreadingWSGIServer,
+                                   handler_class=QuietRequestHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="healthz").start()
+
+    def shutdown(self) -> None:
+        if self._server:
+            self._server.shutdown()
+
+
+class WebhookServer:
+    """
+    Прием обновлений Telegram через webhook.
+    HTTP-сервер кладет обновления в ограниченную очередь, а рабочие потоки
+    передают их в bot.process_new_updates. Если очередь заполнена, сервер
+    отвечает 503 - Telegram повторит доставку позже (обратное давление),
+    вместо того чтобы процесс копил необработанные обновления в памяти.
+    """
+
+    def __init__(self, bot, host: str = "0.0.0.0", port: int = 8080, path: str = "/webhook",
+                 secret_token: str = None, queue_size: int = 1000, workers: int = 8,
+                 health=None, health_path: str = "/healthz"):
+        self.bot = bot
+        # health() - показатели для GET health_path (None - проверка отключена)
+        self.health = health
+        self.health_path = health_path
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self.updates = queue.Queue(maxsize=queue_size)
+        self._server = None
+
+    def __call__(self, environ, start_response):
+        """WSGI-приложение."""
+        if self.health and environ.get("PATH_INFO") == self.health_path:
+            return health_response(start_response, self.health)
+        if environ.get("PATH_INFO") != self.path:
+            return self._respond(start_response, "404 Not Found")
+        if environ.get("REQUEST_METHOD") != "POST":
+            return self._respond(start_response, "405 Method Not Allowed")
+        if self.secret_token and environ.get("HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN") != self.secret_token:
+            return self._respond(start_response, "403 Forbidden")
+
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            body = environ["wsgi.input"].read(length).decode("utf-8")
+            update = types.Update.de_json(body)
+        except Exception as e:
+            print(f"Ошибка разбора обновления webhook: {e}")
+            return self._respond(start_response, "400 Bad Request")
+
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            return self._respond(start_response, "503 Service Unavailable")
+        return self._respond(start_response, "200 OK")
+
+    @staticmethod
+    def _respond(start_response, status: str, body: bytes = b"", content_type: str = "text/plain"):
+        start_response(status, [("Content-Type", content_type), ("Content-Length", str(len(body)))])
+        return [body]
+
+    def _worker(self) -> None:
+        while True:
+            update = self.updates.get()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                print(f"Ошибка обработки обновления: {e}")
+
+    def serve_forever(self) -> None:
+        """Запускает рабочие потоки и HTTP-сервер (блокирует текущий поток)."""
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True, name=f"webhook-{i}").start()
+        self._server = make_server(self.host, self.port, self,
+                                   server_class=ThreadingWSGIServer,
+                                   handler_class=QuietRequestHandler)
+        self._server.serve_forever()
+
+    def shutdown(self) -> None:
+        if self._server:
+            self._server.shutdown()
+
+
+# ==================== ЗАГЛУШКА TELEGRAM ДЛЯ ЛОКАЛЬНОЙ ПРОВЕРКИ ====================
+
+class StubResponse:
+    """Минимальный ответ, совместимый с разбором в telebot.apihelper."""
+
+    def __init__(self, payload: dict):
+        self.status_code = 200
+        self.reason = "OK"
+        self.text = json.dumps(payload, ensure_ascii=False)
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+_stub_message_ids = itertools.count(1)
+
+
+def stub_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    """
+    Заглушка запросов к Telegram Bot API для telebot.apihelper.CUSTOM_REQUEST_SENDER.
+    Печатает вызванный метод и возвращает правдоподобный успешный ответ,
+    поэтому бот можно проверить локально, отправляя обновления на webhook curl'ом.
+    """
+    params = params or {}
+    api_method = url.rsplit("/", 1)[-1]
+    print(f"[stub] {api_method}: {params.get('text') or params}")
+
+    if api_method == "getMe":
+        result = {"id": 1, "is_bot": True, "first_name": "WeatherBot", "username": "weather_stub_bot"}
+    elif api_method in ("sendMessage", "editMessageText"):
+        result = {
+            "message_id": int(params.get("message_id") or next(_stub_message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "text": params.get("text", "")
+        }
+    else:
+        result = True
+    return StubResponse({"ok": True, "result": result})